@@ -1,5 +1,6 @@
 # Avoiding MPI-dependent imports by default
 import lib_deconvolve_em
+import lib_deconvolve_serial
 import lib_detect
 import lib_template
 
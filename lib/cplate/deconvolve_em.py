@@ -1,16 +1,13 @@
 import sys
 import time
+import collections
 
 import numpy as np
-from scipy import sparse
-from scipy.sparse import linalg as splinalg
-try:
-    from scikits.sparse import cholmod
-except:
-    print >> sys.stderr, "Failed to load cholmod"
 from mpi4py import MPI
 
 import lib_deconvolve_em as lib
+import lib_deconvolve_serial as serial
+import lib_warm_start
 
 # Set constants
 
@@ -20,7 +17,7 @@ MPIROOT     = 0
 STOPTAG     = 0
 SYNCTAG     = 1
 WORKTAG     = 2
-UPDATETAG   = 3
+STATSTAG    = 3
 
 # Interval between M-steps
 INTERVAL    = 1
@@ -81,42 +78,10 @@ def load_data(chrom, cfg, null=False):
                 region_types = np.fromstring(line.strip(), sep=' ', dtype=int)
                 break
     
-    # Get length of chromosome; important if regions and reads disagree
-    chrom_length = min(region_types.size, reads.size)
-    
-    # Truncate region types to chromosome length
-    region_types = region_types[:chrom_length]
-    
-    # Set region types to start at 0 for consistent array indexing
-    region_types -= region_types.min()
-    
-    # Get unique region identifiers
-    n_regions = region_types.max() + 1
-    region_ids = np.unique(region_types)
-    
-    # Build map of regions by r
-    region_list = [None]*n_regions
-    region_sizes = np.ones(n_regions, dtype=np.int)
-    for r in region_ids:
-        region = np.where(region_types==r)[0]
-        region_list[r] = slice(region.min(), region.max()+1)
-        region_sizes[r] = region.size
-    
-    # Setup y variable
-    y = reads[:chrom_length]
-    
-    # Build dictionary of data to return
-    data = {'chrom' : chrom,
-            'y' : y,
-            'template' : template,
-            'region_types' : region_types,
-            'region_list' : region_list,
-            'region_sizes' : region_sizes,
-            'region_ids' : region_ids
-            }
-    return data
-
-def initialize(data, cfg, rank=None):
+    return serial.make_data(reads, template, region_types=region_types,
+                            chrom=chrom)
+
+def initialize(data, cfg, rank=None, null=False):
     '''
     Initialize parameters across all nodes.
 
@@ -128,7 +93,11 @@ def initialize(data, cfg, rank=None):
             Dictionary containing (at least) prior and estimation_params
             sections with appropriate entries.
         - rank : int
-            If not None, rank of node to print in diagnostic output.
+            If not None, rank of node to print in diagnostic output. Only the
+            master uses the initial values, so multiresolution initialization
+            and the warm start are skipped on other nodes.
+        - null : bool
+            If null, warm starts use previous runs on null reads.
 
     Returns
     -------
@@ -140,44 +109,91 @@ def initialize(data, cfg, rank=None):
         - sigmasq : ndarray
             Starting values for log-variance (sigmasq) parameters.
     '''
-    # Create references to frequently-accessed config information
-    # Prior on 1 / sigmasq
-    a0  = cfg['prior']['a0']
-    b0  = cfg['prior']['b0']
-    # Verbosity
-    verbose = cfg['estimation_params']['verbose']
+    init = serial.initialize(data, cfg, null=null,
+                             master=(rank is None or rank == MPIROOT))
     
-    # Create references to relevant data entries in local namespace
-    y            = data['y']
-    region_list  = data['region_list']
-    region_ids   = data['region_ids']
+    verbose = cfg['estimation_params']['verbose']
+    if verbose:
+        print "Node %d initialization complete" % rank
+        if verbose > 2: print init['mu'], init['sigmasq']
     
-    # Compute needed data properties
-    n_regions = region_ids.size
+    return init
+
     
-    # Initialize nucleotide-level occupancies
-    theta = (y+1.0)
+def q_function(theta, y, region_types, template, mu, sigmasq, var_theta, k0,
+               log=False):
+    '''
+    Value of the Q-function tracked across EM iterations, on the scale given
+    by log.
+    '''
+    q = -lib.loglik_convolve(theta, y, region_types, template, slice(None),
+                             theta, mu, sigmasq, log=log)
+    if not log:
+        # Q-function is on the density of b without the Jacobian term
+        q += np.sum( np.log(theta) )
+    q += -np.sum( var_theta / 2.0 / sigmasq[region_types] )
+    q += -np.sum(0.5/sigmasq*k0*mu**2)
+    q += -np.sum( np.log(sigmasq) )
+    return q
+
+def em_objective(logb, y, region_types, template, mu, sigmasq, prior_mean,
+                 region_sizes, k0, a0, b0):
+    '''
+    Laplace approximation to the log-posterior of (mu, sigmasq), with
+    log-occupancies logb at (or near) their conditional mode and the diagonal
+    approximation to the Hessian. The EM updates on the log scale share its
+    fixed points; those on the unlogged scale do not. Unlike the Q-function,
+    it is comparable between points with different var(theta), so it is used
+    to safeguard extrapolation.
+    '''
+    Hdiag = lib.ddloglik_diag_convolve(logb, y, region_types, template,
+                                       slice(None), logb, mu, sigmasq,
+                                       log=True)
+    val = -lib.loglik_convolve(logb, y, region_types, template, slice(None),
+                               logb, mu, sigmasq, log=True)
+    val += -np.sum( np.log(Hdiag) ) / 2.0
+    val += -np.sum( region_sizes*k0*(mu - prior_mean)**2 / 2.0 / sigmasq )
+    val += -np.sum( (1.5 + a0)*np.log(sigmasq) + b0/sigmasq )
+    return val
+
+def squarem_step(x0, x1, x2, step_max=16.):
+    '''
+    SQUAREM extrapolation (scheme S3 of Varadhan & Roland, 2008) from a point
+    x0 and two successive EM updates x1 and x2.
+
+    Returns the extrapolated point and the steplength alpha, which is bounded
+    to [-step_max, -1]. With alpha = -1, the extrapolated point is x2.
+    '''
+    r = x1 - x0
+    v = x2 - 2.*x1 + x0
+    norm_v = np.sqrt(np.sum(v**2))
+    if norm_v == 0:
+        return x2, -1.
     
-    # Initialize mu using method-of-moments estimator based on prior variance
-    sigmasq0 = b0 / a0
-    mu = np.ones(n_regions)
-    mu[region_ids] = np.array([np.log(theta[region_list[r]].mean()) -
-                              sigmasq0 / 2.0 for r in region_ids])
+    alpha = -np.sqrt(np.sum(r**2)) / norm_v
+    alpha = min(max(alpha, -step_max), -1.)
+    return x0 - 2.*alpha*r + alpha**2*v, alpha
+
+def send_block(comm, worker, start, log, theta, block_width, w,
+               theta_send_buf, tag=WORKTAG):
+    '''
+    Send block start and corresponding slice of theta, including buffers of
+    width w on either side, to worker to execute an approximate E-step (tag
+    WORKTAG) or compute M-step statistics (tag STATSTAG).
+    '''
+    chrom_length = theta.size
     
-    # Initialize sigmasq based upon prior mean
-    sigmasq = np.ones(n_regions)*sigmasq0
+    # Setup block to send
+    end = min(chrom_length, start + block_width)
+    block = slice(max(start - w, 0), min(end+w, chrom_length))
+    theta_send_buf[:block.stop-block.start] = theta[block]
     
-    if verbose:
-        print "Node %d initialization complete" % rank
-        if verbose > 2: print mu, sigmasq
+    # Tell worker to update slice of theta and execute optimization
+    comm.send((start,log), dest=worker, tag=tag)
     
-    # Build dictionary of initial params to return
-    init = {'theta' : theta,
-            'mu' : mu,
-            'sigmasq' : sigmasq}
-    return init
+    # Update theta slice on worker node
+    comm.Send(theta_send_buf, dest=worker, tag=MPIROOT)
 
-    
 def master(comm, n_proc, data, init, cfg):
     '''
     Master node process for parallel approximate EM. Coordinates estimation and
@@ -224,8 +240,6 @@ def master(comm, n_proc, data, init, cfg):
     # Iteration limits
     min_iter = cfg['estimation_params']['min_iter']
     max_iter = cfg['estimation_params']['max_iter']    
-    # Memory limits
-    max_dense_mem = cfg['estimation_params']['max_mem'] * 2.**20
     # Verbosity
     verbose = cfg['estimation_params']['verbose']
     timing = cfg['estimation_params']['timing']
@@ -234,6 +248,9 @@ def master(comm, n_proc, data, init, cfg):
     # Debugging flags to fix hyperparameters
     fix_mu = cfg['estimation_params']['fix_mu']
     fix_sigmasq = cfg['estimation_params']['fix_sigmasq']
+    # Extrapolation of EM updates: None or 'squarem'
+    acceleration = cfg['estimation_params'].get('acceleration', None)
+    step_max = cfg['estimation_params'].get('squarem_step_max', 16.)
     
     # Compute derived quantities from config information
     sigmasq0 = b0 / a0
@@ -250,6 +267,7 @@ def master(comm, n_proc, data, init, cfg):
     # Compute needed data properties
     chrom_length = y.size
     n_regions = region_ids.size
+    w = template.size/2 + 1
     
     # Reference initialized quantities in local scope
     theta   = init['theta']
@@ -263,13 +281,6 @@ def master(comm, n_proc, data, init, cfg):
     else:
         block_width = cfg['estimation_params']['block_width']
     
-    # Compute block width and limits for bounded-memory inversion of Hessian
-    var_block_width = max_dense_mem / (8*chrom_length)
-    if (chrom_length / var_block_width) * var_block_width < chrom_length:
-        var_max = chrom_length
-    else:
-        var_max = chrom_length - var_block_width
-    
     # Setup prior means
     prior_mean = np.zeros(n_regions)
     if adapt_prior:
@@ -284,24 +295,23 @@ def master(comm, n_proc, data, init, cfg):
     else:
          prior_mean += mu0
     
-    # Build sparse basis
-    basis = sparse.spdiags(
-            (np.ones((template.size,chrom_length)).T * template).T,
-            np.arange(-(template.size/2), template.size/2 + 1),
-            chrom_length, chrom_length )
-    
-    # Setup basis matrix
-    basis = basis.tocsr()
-    basist = basis.T
-    basist = basist.tocsr()
-    
     # Initialize information for optimization
     iter = 0
     ret_val = np.empty(block_width)
     status = MPI.Status()
     
+    # Setup buffer for sending slices of theta, including buffers of width w
+    theta_send_buf = np.empty(block_width + 2*w, dtype=np.float)
+    
+    # Setup buffers for M-step statistics computed by workers: slices of
+    # theta with buffers of width 2*w, and returned variances for each block
+    # followed by region_stats
+    theta_stats_buf = np.empty(block_width + 4*w, dtype=np.float)
+    stats_buf = np.empty(block_width + 3*n_regions, dtype=np.float)
+    
     # Start with optimization on unlogged scale
     last_switch = -1
+    b_last_switch = None
     log = False
     
     # Setup initial values of parameters and var(theta | params)
@@ -310,16 +320,16 @@ def master(comm, n_proc, data, init, cfg):
     
     # Compute initial value of Q-function
     q_vec = np.empty(max_iter+1, dtype='d')
-    q_vec[iter] = -lib.loglik(theta, y, region_types,
-                         basis, basist,
-                         slice(None), theta,
-                         mu, sigmasq,
-                         log=log)
-    q_vec[iter] += -np.sum( var_theta / 2.0 / sigmasq[region_types] )
-    q_vec[iter] += -np.sum(0.5/sigmasq*k0*mu**2)
-    q_vec[iter] += -np.sum( np.log(sigmasq) )
+    q_vec[iter] = q_function(theta, y, region_types, template, mu, sigmasq,
+                             var_theta, k0, log=log)
     converged = False
     
+    # States (log(b), mu, log(sigmasq)) since the last SQUAREM extrapolation,
+    # and the objective and state to fall back to if its stabilization step
+    # decreases the objective
+    squarem_states = []
+    squarem_fallback = None
+    
     if log: b_previous_interval = np.exp(theta.copy())
     else:   b_previous_interval = theta.copy()
     
@@ -331,6 +341,20 @@ def master(comm, n_proc, data, init, cfg):
                            dtype=np.int)]
     start_vec = np.concatenate(start_vec)
     
+    # Setup dependencies between blocks and the contiguous chunks used for
+    # M-step statistics. Once every block writing within 2*w of a chunk has
+    # returned, its log-occupancies and their Hessian diagonal are final for
+    # the iteration, so its statistics can be computed while other blocks are
+    # still out.
+    chunk_starts = np.arange(0, chrom_length, block_width, dtype=np.int)
+    n_chunks = chunk_starts.size
+    block_chunks = {}
+    for start in start_vec:
+        end = min(start + block_width, chrom_length)
+        block_chunks[start] = slice(max((start - 2*w) // block_width, 0),
+                                    min(-(-(end + 2*w) // block_width),
+                                        n_chunks))
+    
     while iter < max_iter and (not converged or iter < min_iter):
         # Store estimates from last iteration for convergence check
         if log: b_previous_iteration = np.exp(theta.copy())
@@ -341,8 +365,8 @@ def master(comm, n_proc, data, init, cfg):
         for k in range(1, n_workers+1):
             comm.send((0,log), dest=k, tag=SYNCTAG)
             
-        # Broadcast theta and parameter values to all workers
-        comm.Bcast(theta, root=MPIROOT)
+        # Broadcast parameter values to all workers. Slices of theta are sent
+        # along with each job.
         params[0], params[1] = (mu, sigmasq)
         comm.Bcast(params, root=MPIROOT)
         
@@ -354,87 +378,87 @@ def master(comm, n_proc, data, init, cfg):
         # Randomize block ordering
         np.random.shuffle(start_vec)
         
-        # Send first batch of jobs
-        for k in range(1,min(n_workers, start_vec.size)+1):
-            comm.send((start_vec[n_started],log), dest=k, tag=WORKTAG)
-            n_started += 1
+        # Run M-step at appropriate intervals. If only the diagonal of the
+        # Hessian is needed, workers compute variances and sufficient
+        # statistics for each chunk as soon as it is final, between E-step
+        # blocks, and the master only reduces them; the full Hessian needs all
+        # of theta.
+        m_step = (iter % INTERVAL == 0 and iter > 0)
+        pipeline = m_step and (diag_approx or fix_sigmasq)
+        n_unfinished = np.zeros(n_chunks, dtype=np.int)
+        if pipeline:
+            for start in start_vec:
+                n_unfinished[block_chunks[start]] += 1
+            n_stats_jobs = n_chunks
+        else:
+            n_stats_jobs = 0
+        ready = collections.deque()
+        n_stats_completed = 0
+        stats = np.zeros((n_regions, 3))
+        stats_job = np.zeros(n_proc, dtype=np.bool)
+        idle = range(1, n_workers+1)
         
         # Collect results from workers and dispatch additional jobs until
-        # complete
-        while n_completed < n_jobs:
+        # complete, sending E-step blocks before ready chunks
+        while n_completed < n_jobs or n_stats_completed < n_stats_jobs:
+            while len(idle) > 0 and (n_started < n_jobs or len(ready) > 0):
+                worker = idle.pop()
+                stats_job[worker] = (n_started == n_jobs)
+                if stats_job[worker]:
+                    send_block(comm, worker, chunk_starts[ready.popleft()],
+                               log, theta, block_width, 2*w, theta_stats_buf,
+                               tag=STATSTAG)
+                else:
+                    send_block(comm, worker, start_vec[n_started], log, theta,
+                               block_width, w, theta_send_buf)
+                    n_started += 1
+            
             # Collect any complete results
-            comm.Recv(ret_val, source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG,
-                      status=status)
-            n_completed += 1
+            comm.Probe(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status)
+            worker = status.Get_source()
             start = status.Get_tag()
             end = min(start+block_width, chrom_length)
-            theta[start:end] = ret_val[:end-start]
-            
-            # If all jobs are not complete, update theta on the just-finished
-            # worker and send another job.
-            if n_started < n_jobs:
-                # Update theta on given worker
-                worker = status.Get_source()
-                comm.send((0,log), dest=worker, tag=UPDATETAG)
-                comm.Send(theta, dest=worker, tag=MPIROOT)
+            idle.append(worker)
+            if stats_job[worker]:
+                comm.Recv(stats_buf, source=worker, tag=start)
+                n_stats_completed += 1
+                if not fix_sigmasq:
+                    var_theta[start:end] = stats_buf[:end-start]
+                stats += stats_buf[block_width:].reshape((n_regions, 3))
+            else:
+                comm.Recv(ret_val, source=worker, tag=start)
+                n_completed += 1
+                theta[start:end] = ret_val[:end-start]
                 
-                # Start next job on worker
-                comm.send((start_vec[n_started],log), dest=worker, tag=WORKTAG)
-                n_started += 1
-        
+                # Queue chunks made final by this block
+                chunks = block_chunks[start]
+                n_unfinished[chunks] -= 1
+                if pipeline:
+                    ready.extend(np.flatnonzero(n_unfinished[chunks] == 0) +
+                                 chunks.start)
+            
         # Exponentiate resulting theta if needed
         if log:
             logb = theta
         else:
             logb = np.log(theta)
         
-        # Run M-step at appropriate intervals
-        if iter % INTERVAL == 0 and iter > 0:
+        if m_step:
             if verbose and timing: tme = time.clock()
-            if not fix_sigmasq:
-                if diag_approx:
-                    Hdiag = lib.ddloglik_diag(logb, y, region_types, basis,
-                                              basist, slice(None),
-                                              logb, mu, sigmasq, log=True)
-                    var_theta = 1.0/Hdiag
-                else:
-                    H = lib.ddloglik(logb, y, region_types, basis, basist,
-                                     slice(None), logb,
-                                     mu, sigmasq, log=True)
-                    try:
-                        Hfactor = cholmod.cholesky(H)
-                        for start in xrange(0, var_max, var_block_width):
-                            stop = min(chrom_length, start+var_block_width)
-                            var_theta[start:stop] = Hfactor.solve_A(
-                                    np.eye(chrom_length, stop - start, -start)
-                                    ).diagonal()
-                    except:
-                        if verbose: print 'Cholesky fail'
-                        Hfactor = splinalg.splu(H)
-                        for start in xrange(0, var_max, var_block_width):
-                            stop = min(chrom_length, start+var_block_width)
-                            print (start, stop)
-                            var_theta[start:stop] = Hfactor.solve(
-                                    np.eye(chrom_length, stop - start, -start)
-                                    ).diagonal()
-                if verbose and timing:
-                    print >> sys.stderr, ( "var_theta time: %s" %
-                                           (time.clock() - tme) )
-                    tme = time.clock()
+            if not pipeline:
+                var_theta = serial.banded_var_theta(logb, y, region_types,
+                                                    template, mu, sigmasq,
+                                                    verbose=verbose)
+                stats = lib.region_stats(logb, var_theta, region_types,
+                                         n_regions)
+            if verbose and timing:
+                print >> sys.stderr, ( "var_theta time: %s" %
+                                       (time.clock() - tme) )
+                tme = time.clock()
             
-            for r in region_ids:
-                region = region_list[r]
-                if not fix_mu:
-                    mu[r] = np.mean(logb[region]) + prior_mean[r]*k0
-                    mu[r] /= 1.0 + k0
-                
-                if not fix_sigmasq:
-                    sigmasq[r] = np.mean( (logb[region]-mu[r])**2 )
-                    sigmasq[r] += np.mean( var_theta[region] )
-                    sigmasq[r] += k0*(mu[r]-prior_mean[r])**2
-                    sigmasq[r] += 2.*b0/region_sizes[r]
-                    sigmasq[r] /= (1 + 3./region_sizes[r] +
-                                   2.*a0/region_sizes[r])
+            serial.update_params(stats, region_ids, mu, sigmasq, prior_mean,
+                                 region_sizes, k0, a0, b0, fix_mu=fix_mu,
+                                 fix_sigmasq=fix_sigmasq)
             
             if verbose:
                 if timing: print >> sys.stderr, ( "Mean & variance time: %s" %
@@ -445,14 +469,61 @@ def master(comm, n_proc, data, init, cfg):
         # NOTE: This need not increase at each iteration; indeed, it can
         # monotonically decrease in common cases (e.g. normal-normal model)
         iter += 1
-        q_vec[iter] = -lib.loglik(theta, y, region_types,
-                             basis, basist,
-                             slice(None), theta,
-                             mu, sigmasq,
-                             log=log)
-        q_vec[iter] += -np.sum( var_theta / 2.0 / sigmasq[region_types] )
-        q_vec[iter] += -np.sum(0.5/sigmasq*k0*mu**2)
-        q_vec[iter] += -np.sum( np.log(sigmasq) )
+        q_vec[iter] = q_function(theta, y, region_types, template, mu,
+                                 sigmasq, var_theta, k0, log=log)
+        
+        # Extrapolate from the last two EM updates with SQUAREM, over log(b)
+        # and log(sigmasq) to stay in bounds. The EM iteration following an
+        # extrapolation is its stabilization step, which returns
+        # log-occupancies to their conditional modes and updates var(theta).
+        # Its result is kept only if em_objective there is no lower than at
+        # the point extrapolated from; otherwise, estimation resumes from that
+        # point. Only the log-scale phases are extrapolated, as em_objective
+        # does not share the fixed points of the unlogged EM updates.
+        if acceleration == 'squarem' and m_step and log:
+            if squarem_fallback is not None:
+                objective = em_objective(logb, y, region_types, template, mu,
+                                         sigmasq, prior_mean, region_sizes, k0,
+                                         a0, b0)
+                accepted = (objective >= squarem_fallback[0])
+                if not accepted:
+                    theta[:], mu[:], sigmasq[:] = squarem_fallback[1:4]
+                    var_theta = squarem_fallback[4]
+                    q_vec[iter] = q_function(theta, y, region_types,
+                                             template, mu, sigmasq,
+                                             var_theta, k0, log=log)
+                    if log: logb = theta
+                    else:   logb = np.log(theta)
+                if verbose > 1: print 'SQUAREM stabilized: %s' % accepted
+                squarem_fallback = None
+                squarem_states = [np.concatenate((logb, mu,
+                                                  np.log(sigmasq)))]
+            else:
+                squarem_states.append(np.concatenate((logb, mu,
+                                                      np.log(sigmasq))))
+            
+            if len(squarem_states) == 3:
+                x, alpha = squarem_step(*squarem_states, step_max=step_max)
+                squarem_states = squarem_states[-1:]
+                if alpha < -1:
+                    squarem_fallback = (
+                        em_objective(logb, y, region_types, template, mu,
+                                     sigmasq, prior_mean, region_sizes, k0, a0,
+                                     b0),
+                        theta.copy(), mu.copy(), sigmasq.copy(),
+                        var_theta.copy())
+                    logb_x = x[:chrom_length]
+                    mu[:] = x[chrom_length:chrom_length+mu.size]
+                    sigmasq[:] = np.exp(x[chrom_length+mu.size:])
+                    if log: theta[:] = logb_x
+                    else:   theta[:] = np.exp(logb_x)
+                    q_vec[iter] = q_function(theta, y, region_types,
+                                             template, mu, sigmasq,
+                                             var_theta, k0, log=log)
+                    if log: logb = theta
+                    else:   logb = np.log(theta)
+                    squarem_states = []
+                if verbose > 1: print 'SQUAREM: %g' % alpha
         
         # Using L_2 convergence criterion on estimated parameters of interest
         # (theta)
@@ -470,36 +541,342 @@ def master(comm, n_proc, data, init, cfg):
         
         # Switch between optimizing over log(b) and b
         if converged:
-            if last_switch < 0:
+            theta, log, converged, last_switch, b_last_switch = \
+                    serial.switch_scale(theta, logb, iter, log, last_switch,
+                                        b_last_switch, tol, verbose=verbose)
+            if not converged:
+                squarem_states = []
+                squarem_fallback = None
+        
+    
+    # Halt all workers
+    for k in range(1,n_proc):
+        comm.send((None,None), dest=k, tag=STOPTAG)
+    
+    # Exponentiate coefficients, if needed
+    if log: theta = np.exp(theta)
+    
+    # Return results
+    out = {'theta' : theta,
+           'var_theta' : var_theta,
+           'mu' : mu,
+           'sigmasq' : sigmasq,
+           'region_ids' : region_ids}
+    return out
+
+def master_async(comm, n_proc, data, init, cfg):
+    '''
+    Master node process for asynchronous approximate EM. Workers continuously
+    pull blocks without iteration barriers, each receiving the latest values of
+    theta around its block and the latest (mu, sigmasq).
+
+    Blocks are dispatched in a fixed random order, skipping blocks that have
+    converged and blocks that overlap a block still out on another worker.
+    When a block returns, only the coefficients it optimized are written back,
+    sufficient statistics of the regions it touches are updated incrementally,
+    and the M-step runs for those regions. Convergence is tracked per block: a
+    block is converged once its last update moved b by less than tol (in L_2).
+    Updates larger than tol reopen overlapping blocks, and parameter changes
+    larger than tol reopen the blocks of that region. As in master, estimation
+    starts on the unlogged scale and switches scales on convergence.
+
+    Approximate variances of log-occupancies always use the diagonal
+    approximation to the Hessian.
+
+    Parameters and return value are as for master.
+    '''
+    # Create references to frequently-accessed config information
+    # Prior on mu - sigmasq / 2
+    mu0 = cfg['prior']['mu0']
+    k0  = cfg['prior']['k0']
+    # Prior on 1 / sigmasq
+    a0  = cfg['prior']['a0']
+    b0  = cfg['prior']['b0']
+    # Tolerance for convergence
+    tol = cfg['estimation_params']['tol']
+    # Iteration limits, in sweeps of block updates
+    min_iter = cfg['estimation_params']['min_iter']
+    max_iter = cfg['estimation_params']['max_iter']
+    # Verbosity
+    verbose = cfg['estimation_params']['verbose']
+    timing = cfg['estimation_params']['timing']
+    # Debugging flags to fix hyperparameters
+    fix_mu = cfg['estimation_params']['fix_mu']
+    fix_sigmasq = cfg['estimation_params']['fix_sigmasq']
+    
+    # Compute derived quantities from config information
+    sigmasq0 = b0 / a0
+    adapt_prior = (mu0 is None)
+    
+    # Create references to relevant data entries in local scope
+    y           = data['y']
+    template    = data['template']
+    region_types = data['region_types']
+    region_list  = data['region_list']
+    region_sizes = data['region_sizes']
+    region_ids   = data['region_ids']
+    
+    # Compute needed data properties
+    chrom_length = y.size
+    n_regions = region_ids.size
+    w = template.size/2 + 1
+    
+    # Reference initialized quantities in local scope
+    theta   = init['theta']
+    mu      = init['mu']
+    sigmasq = init['sigmasq']
+    params  = np.array([mu, sigmasq])
+    
+    # Compute block width for parallel approximate E-step
+    n_workers = n_proc - 1
+    if cfg['estimation_params']['block_width'] is None:
+        block_width = chrom_length / n_workers
+    else:
+        block_width = cfg['estimation_params']['block_width']
+    
+    # Setup prior means
+    prior_mean = np.zeros(n_regions)
+    if adapt_prior:
+        # Get coverage by region
+        coverage = np.zeros(n_regions)
+        for i in region_ids:
+            coverage[i] = np.mean(y[region_list[i]])
+        
+        # Translate to prior means
+        prior_mean[coverage>0] = np.log(coverage[coverage>0]) - sigmasq0 / 2.0
+    else:
+         prior_mean += mu0
+    
+    # Initialize information for optimization
+    ret_val = np.empty(block_width)
+    theta_send_buf = np.empty(block_width + 2*w, dtype=np.float)
+    status = MPI.Status()
+    
+    # Start with optimization on unlogged scale
+    log = False
+    last_switch = -1
+    
+    # Setup blocks from both tilings in a fixed random order. Blocks read
+    # theta over [start-w, end+w) and write only the coefficients they
+    # optimize, [start+w, end-w) away from the ends of the chromosome. Blocks
+    # conflict if either writes what the other reads.
+    start_vec = np.concatenate([
+        np.arange(0, chrom_length, block_width, dtype=np.int),
+        np.arange(block_width/2, chrom_length, block_width, dtype=np.int)])
+    np.random.shuffle(start_vec)
+    n_jobs = start_vec.size
+    end_vec = np.minimum(start_vec + block_width, chrom_length)
+    read_lo = np.maximum(start_vec - w, 0)
+    read_hi = np.minimum(end_vec + w, chrom_length)
+    write_lo = start_vec + w*(start_vec != 0)
+    write_hi = end_vec - w*(end_vec != chrom_length)
+    
+    # Blocks reading from each block's written coefficients, via sorted read
+    # ranges; these are reopened when the block changes
+    order = np.argsort(start_vec)
+    readers = [order[np.searchsorted(read_hi[order], write_lo[j], 'right'):
+                     np.searchsorted(read_lo[order], write_hi[j], 'left')]
+               for j in xrange(n_jobs)]
+    
+    # Regions each block's update affects (within 2*w of its written
+    # coefficients, through the Hessian diagonal), from runs of constant
+    # region type located by binary search, and blocks writing to each region
+    run_starts = np.r_[0, np.flatnonzero(np.diff(region_types)) + 1]
+    run_types = region_types[run_starts]
+    first_run = np.searchsorted(run_starts, np.maximum(write_lo - 2*w, 0),
+                                'right') - 1
+    last_run = np.searchsorted(run_starts,
+                               np.minimum(write_hi + 2*w, chrom_length),
+                               'left')
+    block_writes = [np.unique(run_types[first_run[j]:last_run[j]])
+                    for j in xrange(n_jobs)]
+    region_blocks = [[] for r in xrange(n_regions)]
+    for j in xrange(n_jobs):
+        for r in block_writes[j]:
+            region_blocks[r].append(j)
+    region_blocks = [np.array(jobs, dtype=np.int) for jobs in region_blocks]
+    
+    # Setup initial values of var(theta | params) and region statistics
+    var_theta = sigmasq[region_types]
+    
+    def refresh_stats():
+        if log:
+            logb = theta
+        else:
+            logb = np.log(theta)
+        return lib.region_stats(logb, var_theta, region_types, n_regions)
+    
+    def update_var_theta(lo, hi):
+        # Hessian diagonal over [lo-2*w, hi+2*w), computed from theta over a
+        # window wide enough to get the rates there exactly
+        affected = slice(max(lo - 2*w, 0), min(hi + 2*w, chrom_length))
+        window = slice(max(affected.start - 2*w, 0),
+                       min(affected.stop + 2*w, chrom_length))
+        inner = slice(affected.start - window.start,
+                      affected.stop - window.start)
+        if log:
+            logb_window = theta[window]
+        else:
+            logb_window = np.log(theta[window])
+        var_theta[affected] = 1.0/lib.ddloglik_diag_convolve(
+            logb_window[inner], y[window], region_types[window], template,
+            inner, logb_window, mu, sigmasq, log=True)
+        return affected
+    
+    stats = refresh_stats()
+    
+    # Per-block convergence flags and bookkeeping for running blocks. Open
+    # blocks wait in a ready queue, in the fixed random order at first and
+    # then in the order they are reopened.
+    open_blocks = np.ones(n_jobs, dtype=np.bool)
+    queued = np.ones(n_jobs, dtype=np.bool)
+    ready = collections.deque(xrange(n_jobs))
+    running = -np.ones(n_workers, dtype=np.int)
+    idle = range(1, n_workers+1)
+    n_completed = 0
+    
+    def reopen(jobs):
+        jobs = np.atleast_1d(jobs)
+        open_blocks[jobs] = True
+        jobs = jobs[~queued[jobs]]
+        queued[jobs] = True
+        ready.extend(jobs)
+    n_sweeps = 0
+    done = False
+    
+    # Start timing, if requested
+    if timing:
+        tme = time.clock()
+    
+    while not done:
+        # Dispatch open, non-conflicting blocks to idle workers from the ready
+        # queue. Blocks conflicting with running ones keep their place; blocks
+        # closed or running since they were queued are dropped, and requeued
+        # when reopened or finished.
+        deferred = []
+        while len(idle) > 0 and len(ready) > 0:
+            job = ready.popleft()
+            if not open_blocks[job] or job in running:
+                queued[job] = False
+                continue
+            busy = running[running >= 0]
+            if np.any(((write_lo[job] < read_hi[busy]) &
+                       (write_hi[job] > read_lo[busy])) |
+                      ((read_lo[job] < write_hi[busy]) &
+                       (read_hi[job] > write_lo[busy]))):
+                deferred.append(job)
+                continue
+            
+            queued[job] = False
+            worker = idle.pop()
+            running[worker-1] = job
+            send_block(comm, worker, start_vec[job], log, theta, block_width,
+                       w, theta_send_buf)
+            params[0], params[1] = (mu, sigmasq)
+            comm.Send(params, dest=worker, tag=MPIROOT)
+        ready.extendleft(reversed(deferred))
+        
+        if np.all(running < 0):
+            # Nothing open and nothing out: converged on this scale
+            if last_switch < 0 or lib.l2_error(
+                    np.exp(theta) if log else theta, b_last_switch) >= tol:
+                # Switch between optimizing over log(b) and b
+                b_last_switch = np.exp(theta) if log else theta.copy()
+                last_switch = n_sweeps
                 log = not log
-                converged = False
-                last_switch = iter
-                b_last_switch = np.exp(logb)
-                
                 if log: theta = np.log(theta)
                 else: theta = np.exp(theta)
-                
+                reopen(np.arange(n_jobs))
                 if verbose:
                     print 'Last switch: %d' % last_switch
                     print 'Log: %s' % str(log)
-            else:
-                # Check if switching space helped
-                delta = lib.l2_error( np.exp(logb), b_last_switch )
-                converged = (delta < tol)
-                
-                if not converged:
-                    # If it did help, keep going
-                    b_last_switch = np.exp(logb)
-                    last_switch = iter
-                    log = not log
-                    
-                    if log: theta = np.log(theta)
-                    else: theta = np.exp(theta)
-                    
-                    if verbose:
-                        print 'Last switch: %d' % last_switch
-                        print 'Log: %s' % str(log)
+                continue
+            done = True
+            break
+        
+        # Collect a result
+        comm.Recv(ret_val, source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG,
+                  status=status)
+        worker = status.Get_source()
+        job = running[worker-1]
+        running[worker-1] = -1
+        idle.append(worker)
+        n_completed += 1
+        
+        # Write back optimized coefficients, tracking the change in b
+        written = slice(write_lo[job], write_hi[job])
+        new = ret_val[write_lo[job]-start_vec[job]:
+                      write_hi[job]-start_vec[job]]
+        if log:
+            delta = lib.l2_error(np.exp(new), np.exp(theta[written]))
+            logb_old = theta[written].copy()
+            logb_new = new
+        else:
+            delta = lib.l2_error(new, theta[written])
+            logb_old = np.log(theta[written])
+            logb_new = np.log(new)
+        theta[written] = new
+        
+        # Update region statistics incrementally for the written coefficients
+        # and the variances they affect
+        stats[:,0] += np.bincount(region_types[written],
+                                  weights=logb_new - logb_old,
+                                  minlength=n_regions)
+        stats[:,1] += np.bincount(region_types[written],
+                                  weights=logb_new**2 - logb_old**2,
+                                  minlength=n_regions)
+        if not fix_sigmasq:
+            affected = slice(max(write_lo[job] - 2*w, 0),
+                             min(write_hi[job] + 2*w, chrom_length))
+            var_old = var_theta[affected].copy()
+            update_var_theta(write_lo[job], write_hi[job])
+            stats[:,2] += np.bincount(region_types[affected],
+                                      weights=var_theta[affected] - var_old,
+                                      minlength=n_regions)
         
+        # Rolling M-step for regions touched by this block
+        for r in block_writes[job]:
+            mu_old, sigmasq_old = mu[r], sigmasq[r]
+            lib.update_region_params_stats(stats, r, mu, sigmasq,
+                                           prior_mean, region_sizes[r], k0,
+                                           a0, b0, fix_mu=fix_mu,
+                                           fix_sigmasq=fix_sigmasq)
+            if (np.abs(mu[r] - mu_old) >= tol or
+                np.abs(sigmasq[r] - sigmasq_old) >= tol*sigmasq_old):
+                reopen(region_blocks[r])
+        
+        # Update per-block convergence
+        open_blocks[job] = (delta >= tol)
+        if delta >= tol:
+            reopen(readers[job])
+        
+        # Count sweeps of n_jobs block updates
+        if n_completed % n_jobs == 0:
+            n_sweeps += 1
+            
+            # Recompute region statistics to avoid drift in running sums
+            stats = refresh_stats()
+            
+            if verbose:
+                print n_sweeps
+                print np.sum(open_blocks)
+                if verbose > 1: print mu, sigmasq
+                if timing: print >> sys.stderr, ("Sweep time: %s" %
+                                                 (time.clock() - tme))
+            if timing: tme = time.clock()
+            
+            if n_sweeps >= max_iter:
+                done = True
+        
+        # Keep blocks open until the minimum number of sweeps is done
+        if n_sweeps < min_iter:
+            open_blocks[job] = True
+        if open_blocks[job]:
+            reopen(job)
+    
+    # Collect any remaining results
+    for worker in np.flatnonzero(running >= 0) + 1:
+        comm.Recv(ret_val, source=worker, tag=MPI.ANY_TAG)
     
     # Halt all workers
     for k in range(1,n_proc):
@@ -548,10 +925,10 @@ def worker(comm, rank, n_proc, data, init, cfg):
     
     # Compute needed data properties
     chrom_length = y.size
+    n_regions = data['region_ids'].size
     w = template.size/2 + 1
     
     # Extract needed initializations for parameters
-    theta   = init['theta']
     mu      = init['mu']
     sigmasq = init['sigmasq']
     params  = np.array([mu, sigmasq])
@@ -563,6 +940,39 @@ def worker(comm, rank, n_proc, data, init, cfg):
     else:
         block_width = cfg['estimation_params']['block_width']
     
+    # Only the slice of theta for the current block, including buffers of
+    # width w, is kept
+    theta = np.empty(block_width + 2*w, dtype=np.float)
+    
+    # Slices of theta for M-step statistics carry buffers of width 2*w, the
+    # reach of the Hessian diagonal
+    theta_stats = np.empty(block_width + 4*w, dtype=np.float)
+    stats_ret = np.empty(block_width + 3*n_regions, dtype=np.float)
+    fix_sigmasq = cfg['estimation_params']['fix_sigmasq']
+    
+    # Set coefficients without reads in their footprint in closed form?
+    fast_inactive = cfg['estimation_params'].get('fast_inactive', True)
+    
+    # Block solver: 'tnc' (scipy) or 'newton-cg' (matrix-free)
+    solver = cfg['estimation_params'].get('solver', 'tnc')
+    
+    # With the asynchronous master, the latest parameters come with each job
+    asynchronous = cfg['estimation_params'].get('asynchronous', False)
+    params_buf = np.empty_like(params)
+    
+    # Compute Newton-CG Hessian-vector products in single precision?
+    hessp_dtype = np.dtype(cfg['estimation_params'].get('precision',
+                                                        'float64'))
+    
+    # Workspaces by block start, with gathered parameters refreshed after each
+    # synchronization. Single-precision workspaces for Hessian-vector products
+    # are kept alongside if requested. At most workspace_cache_size of each
+    # are kept, evicting the least recently used.
+    workspaces = collections.OrderedDict()
+    hessp_workspaces = collections.OrderedDict()
+    cache_size = cfg['estimation_params'].get('workspace_cache_size', 1024)
+    params_version = 0
+    
     # Prepare to receive tasks
     working = True
     status = MPI.Status()
@@ -575,10 +985,20 @@ def worker(comm, rank, n_proc, data, init, cfg):
             working = False
         elif status.Get_tag() == SYNCTAG:
             # Synchronize parameters (conditioning information)
-            comm.Bcast(theta, root=MPIROOT)
             comm.Bcast(params, root=MPIROOT)
             mu, sigmasq = params
-        elif status.Get_tag() == WORKTAG:            
+            params_version += 1
+        elif status.Get_tag() == WORKTAG:
+            # Receive slice of theta for this block
+            comm.Recv(theta, source=MPIROOT, tag=MPI.ANY_TAG)
+            
+            if asynchronous:
+                comm.Recv(params_buf, source=MPIROOT, tag=MPI.ANY_TAG)
+                if not np.array_equal(params_buf, params):
+                    params[:] = params_buf
+                    mu, sigmasq = params
+                    params_version += 1
+            
             # Calculate subset of data to work on
             end = min(chrom_length, start + block_width)
             block = slice(max(start-w, 0), min(end+w, chrom_length))
@@ -592,26 +1012,195 @@ def worker(comm, rank, n_proc, data, init, cfg):
             # Setup initial return value
             ret_val[end-start:] = 0
             
-            # Run optimization
-            result = lib.deconvolve(lib.loglik_convolve, lib.dloglik_convolve,
-                                    y[block], region_types[block], template,
-                                    mu, sigmasq,
-                                    subset=subset, theta0=theta[block],
-                                    log=log,
-                                    messages=0)
+            theta_new = theta[:size_block]
+            
+            # Coefficients with no reads in their footprint decouple from
+            # the rest of the block; set them to their conditional mode.
+            if fast_inactive:
+                active = lib.find_active(y[block], w=w)[subset]
+            else:
+                active = np.ones(size_block, dtype=np.bool)[subset]
+            
+            if not np.all(active):
+                inactive = np.arange(subset.start, subset.stop)[~active]
+                region_inactive = region_types[block][inactive]
+                weight = lib.inactive_weights(template, size_block)[inactive]
+                theta_new[inactive] = lib.inactive_mode(
+                        mu[region_inactive], sigmasq[region_inactive], weight,
+                        log=log)
+            
+            # Run optimization over active coefficients only, holding inactive
+            # ones at their closed-form values. Skip entirely if nothing is
+            # active.
+            if np.any(active):
+                workspace = lib.cached(
+                    workspaces, start,
+                    lambda: lib.BlockWorkspace(y[block], region_types[block]),
+                    cache_size)
+                if workspace.version != params_version:
+                    workspace.set_params(mu, sigmasq, params_version)
+                
+                hessp_workspace = None
+                if solver == 'newton-cg' and hessp_dtype != np.float64:
+                    hessp_workspace = lib.cached(
+                        hessp_workspaces, start,
+                        lambda: lib.BlockWorkspace(y[block],
+                                                   region_types[block],
+                                                   dtype=hessp_dtype),
+                        cache_size)
+                    if hessp_workspace.version != params_version:
+                        hessp_workspace.set_params(mu, sigmasq, params_version)
+                
+                result = lib.deconvolve(lib.loglik_dloglik_convolve, None,
+                                        y[block], region_types[block],
+                                        template, mu, sigmasq,
+                                        subset=subset, theta0=theta_new,
+                                        log=log, workspace=workspace,
+                                        method=solver,
+                                        active=(None if np.all(active)
+                                                else active),
+                                        hessp_workspace=hessp_workspace,
+                                        messages=0)
+                theta_new[subset] = result[0]
             
             # Build resulting subset of new theta
-            theta_new = theta[block]
-            theta_new[subset] = result[0]
             ret_val[:end-start] = theta_new[original]
             
             # Transmit result
             comm.Send(ret_val, dest=MPIROOT, tag=start)
-        elif status.Get_tag() == UPDATETAG:
-            # Update value of theta for next job within given outer loop
-            comm.Recv(theta, source=MPIROOT, tag=MPI.ANY_TAG)
+        elif status.Get_tag() == STATSTAG:
+            # Receive slice of theta for this block
+            comm.Recv(theta_stats, source=MPIROOT, tag=MPI.ANY_TAG)
+            
+            end = min(chrom_length, start + block_width)
+            block = slice(max(start-2*w, 0), min(end+2*w, chrom_length))
+            size_block = block.stop - block.start
+            original = slice(start-block.start, end-block.start)
+            
+            logb = theta_stats[:size_block]
+            if not log: logb = np.log(logb)
+            
+            # Approximate variances of log-occupancies conditional on
+            # (mu, sigmasq) from the diagonal of the Hessian
+            var_block = stats_ret[:end-start]
+            if fix_sigmasq:
+                var_block[:] = 0.
+            else:
+                var_block[:] = 1.0/lib.ddloglik_diag_convolve(
+                        logb[original], y[block], region_types[block],
+                        template, original, logb, mu, sigmasq, log=True)
+            
+            stats_ret[block_width:] = lib.region_stats(
+                    logb[original], var_block, region_types[start:end],
+                    n_regions).ravel()
+            
+            # Transmit result
+            comm.Send(stats_ret, dest=MPIROOT, tag=start)
+
+def check_solver(cfg, chrom=1, null=False, tol=1e-6):
+    '''
+    Check block conditional modes from Newton-CG against fmin_tnc on a
+    reference chromosome, following the scales of the E-step.
+
+    Each block of both tilings is solved from the initial values and
+    parameters of initialize, first on the unlogged scale, then on the log
+    scale from the fmin_tnc solution of the first, by each solver. The final
+    values of the negative log-target over the block are compared.
+
+    Parameters
+    ----------
+        - cfg : dictionary
+            Dictionary containing (at least) prior and estimation_params
+            sections with appropriate entries.
+        - chrom : int
+            Index (starting from 1) of chromosome to extract.
+        - null : bool
+            If null, use null reads instead of actual.
+        - tol : float
+            Largest allowed excess of the Newton-CG objective over that of
+            fmin_tnc, relative to max(1, |fmin_tnc objective|).
+
+    Returns
+    -------
+        Dictionary containing
+        - objective : ndarray
+            Final objectives with shape (2, 2, n_blocks), indexed by scale
+            (unlogged, log) and solver (fmin_tnc, Newton-CG).
+        - n_eval : ndarray
+            Numbers of function evaluations, with the same shape.
+        - excess : ndarray
+            Largest relative excess of the Newton-CG objective by scale.
+        - passed : bool
+            True if all excesses are within tol.
+    '''
+    # Load data and initialize as for a run
+    data = load_data(chrom=chrom, cfg=cfg, null=null)
+    init = initialize(data=data, cfg=cfg, rank=MPIROOT, null=null)
+    
+    # Create references to relevant data entries in local scope
+    y           = data['y']
+    template    = data['template']
+    region_types = data['region_types']
+    mu          = init['mu']
+    sigmasq     = init['sigmasq']
+    
+    # Compute needed data properties
+    chrom_length = y.size
+    w = template.size/2 + 1
+    if cfg['estimation_params']['block_width'] is None:
+        block_width = chrom_length
+    else:
+        block_width = cfg['estimation_params']['block_width']
+    
+    # Setup the same two tilings as master
+    start_vec = np.concatenate([
+        np.arange(0, chrom_length, block_width, dtype=np.int),
+        np.arange(block_width/2, chrom_length, block_width, dtype=np.int)])
+    
+    objective = np.zeros((2, 2, start_vec.size))
+    n_eval = np.zeros((2, 2, start_vec.size), dtype=np.int)
+    for k, start in enumerate(start_vec):
+        end = min(chrom_length, start + block_width)
+        block = slice(max(start-w, 0), min(end+w, chrom_length))
+        size_block = block.stop - block.start
+        subset = slice(w*(start!=0)+start-block.start,
+                       size_block-w*(end!=chrom_length) - (block.stop-end))
+        if subset.stop <= subset.start:
+            continue
+        
+        workspace = lib.BlockWorkspace(y[block], region_types[block])
+        workspace.set_params(mu, sigmasq)
+        theta0 = init['theta'][block].copy()
+        for scale, log in enumerate((False, True)):
+            if log:
+                # Start from the unlogged fmin_tnc solution, as after the
+                # first switch of scales in master
+                theta0 = np.log(theta_tnc)
+            
+            for j, solver in enumerate(('tnc', 'newton-cg')):
+                result = lib.deconvolve(lib.loglik_dloglik_convolve, None,
+                                        y[block], region_types[block],
+                                        template, mu, sigmasq, subset=subset,
+                                        theta0=theta0, log=log,
+                                        workspace=workspace, method=solver,
+                                        messages=0)
+                theta = theta0.copy()
+                theta[subset] = result[0]
+                objective[scale, j, k] = lib.loglik_convolve(
+                    result[0], y[block], region_types[block], template,
+                    subset, theta, mu, sigmasq, log=log)
+                n_eval[scale, j, k] = result[1]
+                if j == 0: theta_tnc = theta
+    
+    excess = np.max((objective[:,1] - objective[:,0]) /
+                    np.maximum(1., np.abs(objective[:,0])), 1)
+    out = {'objective' : objective,
+           'n_eval' : n_eval,
+           'excess' : excess,
+           'passed' : np.all(excess <= tol)}
+    return out
 
-def run(cfg, comm=None, chrom=1, null=False):
+def run(cfg, comm=None, chrom=1, null=False, data=None):
     '''
     Coordinate parallel estimation based upon process rank.
 
@@ -627,10 +1216,16 @@ def run(cfg, comm=None, chrom=1, null=False):
             Index (starting from 1) of chromosome to extract.
         - null : bool
             If null, use null reads instead of actual.
+        - data : dictionary
+            Data as output from load_data, if already loaded for chrom and
+            null.
 
     Returns
     -------
         For master process, dictionary from master() function. Else, None.
+        Chromosomes no longer than estimation_params.serial_max_length are
+        estimated by the master alone with the single-process EM of
+        lib_deconvolve_serial, and the dictionary comes from its estimate().
     '''
     if comm is None:
         # Start MPI communications if no comm provided
@@ -640,23 +1235,35 @@ def run(cfg, comm=None, chrom=1, null=False):
     rank = comm.Get_rank()
     n_proc = comm.Get_size()
     
-    # Load data
-    data = load_data(chrom=chrom, cfg=cfg, null=null)
+    # Load data, if needed
+    if data is None:
+        data = load_data(chrom=chrom, cfg=cfg, null=null)
     
     # Run global initialization
-    init = initialize(data=data, cfg=cfg, rank=rank)
+    init = initialize(data=data, cfg=cfg, rank=rank, null=null)
+    
+    # Short sequences are solved jointly in a single process
+    serial_max_length = cfg['estimation_params'].get('serial_max_length', 0)
+    if data['y'].size <= serial_max_length:
+        if rank == MPIROOT:
+            return serial.estimate(data=data, init=init, cfg=cfg)
+        return
     
     if rank == MPIROOT:
         # Run estimation
-        results = master(comm=comm, n_proc=n_proc, data=data, init=init,
-                         cfg=cfg)
+        if cfg['estimation_params'].get('asynchronous', False):
+            results = master_async(comm=comm, n_proc=n_proc, data=data,
+                                   init=init, cfg=cfg)
+        else:
+            results = master(comm=comm, n_proc=n_proc, data=data, init=init,
+                             cfg=cfg)
         return results
     else:
         worker(comm=comm, rank=rank, n_proc=n_proc, data=data, init=init,
                cfg=cfg)
         return
 
-def write_results(results, cfg, chrom=1, null=False):
+def write_results(results, data, cfg, chrom=1, null=False):
     '''
     Write results from estimation to appropriate files.
 
@@ -664,6 +1271,8 @@ def write_results(results, cfg, chrom=1, null=False):
     ----------
         - results : dictionary
             Estimation results as output from master() function.
+        - data : dictionary
+            Data as output from load_data, recorded in the manifest.
         - cfg : dictionary
             Dictionary containing (at least) prior and estimation_params
             sections with appropriate entries.
@@ -715,4 +1324,9 @@ def write_results(results, cfg, chrom=1, null=False):
                                   results['sigmasq'][int(region_type)]) ]
         param_file.write('\t'.join(line) + '\n')
     param_file.close()
+    
+    # Record inputs and results for warm starts of later runs
+    lib_warm_start.write_manifest(coef_path + '.manifest', 'em', data, cfg,
+                                  null, {'coef' : coef_path,
+                                         'param' : param_path})
 
@@ -0,0 +1,228 @@
+import sys
+import time
+
+import numpy as np
+from scipy import linalg
+
+import lib_deconvolve_em as lib
+import deconvolve_mcmc
+
+def load_em_results(data, cfg, null=False):
+    '''
+    Load EM estimates to center the Laplace approximation on.
+
+    Parameters
+    ----------
+        - data : dictionary
+            Data as output from deconvolve_mcmc.load_data.
+        - cfg : dictionary
+            Dictionary containing (at least) estimation_output section with
+            coef_pattern and param_pattern entries.
+        - null : bool
+            If null, load EM estimates for null data instead.
+
+    Returns
+    -------
+        Dictionary containing
+        - theta : ndarray
+            Posterior mode of log-occupancies from EM.
+        - mu : ndarray
+            MAP estimates of log-mean (mu) parameters by region id.
+        - sigmasq : ndarray
+            MAP estimates of log-variance (sigmasq) parameters by region id.
+    '''
+    if null:
+        coef_pattern = cfg['estimation_output']['null_coef_pattern']
+        param_pattern = cfg['estimation_output']['null_param_pattern']
+    else:
+        coef_pattern = cfg['estimation_output']['coef_pattern']
+        param_pattern = cfg['estimation_output']['param_pattern']
+
+    coef_path = coef_pattern.strip().format(**cfg) % data['chrom']
+    param_path = param_pattern.strip().format(**cfg) % data['chrom']
+
+    theta = np.log(np.loadtxt(coef_path))
+
+    # Index parameters by the region_type column, not by row
+    param_dtype = [('region_type', np.int), ('mu', np.float),
+                   ('sigmasq', np.float)]
+    params = np.loadtxt(param_path, skiprows=1, dtype=param_dtype, ndmin=1)
+
+    n_regions = max(params['region_type'].max(),
+                    data['region_ids'].max()) + 1
+    mu = np.zeros(n_regions)
+    sigmasq = np.ones(n_regions)
+    mu[params['region_type']] = params['mu']
+    sigmasq[params['region_type']] = params['sigmasq']
+
+    em = {'theta' : theta,
+          'mu' : mu,
+          'sigmasq' : sigmasq}
+    return em
+
+def hessian_banded(theta, y, region_types, template, mu, sigmasq):
+    '''
+    Compute the Hessian of the negative log-posterior of log-occupancies given
+    (mu, sigmasq) in upper banded storage for use with scipy.linalg. Built by
+    convolutions, without a chromosome-sized basis matrix.
+
+    Parameters
+    ----------
+        - theta : ndarray
+            Log-occupancies at which to evaluate the Hessian.
+        - y : ndarray
+            Counts of read centers per base pair.
+        - region_types : integer ndarray
+            Vector of region types by base pair.
+        - template : ndarray
+            Vector containing coefficients for template.
+        - mu : ndarray
+            Log-mean (mu) parameters.
+        - sigmasq : ndarray
+            Log-variance (sigmasq) parameters.
+
+    Returns
+    -------
+        - H : ndarray
+            Hessian in upper banded form, with shape (template.size, N).
+            H[template.size - 1 - d, j] holds entry (j - d, j).
+    '''
+    return lib.ddloglik_banded_convolve(theta, y, region_types, template, mu,
+                                        sigmasq)
+
+def cholesky_hessian(theta, y, region_types, template, mu, sigmasq,
+                     verbose=0):
+    '''
+    Upper banded Cholesky factor of the Hessian from hessian_banded.
+
+    Falls back to the Gauss-Newton approximation, dropping the first-order
+    term from the log-transformation, if the Hessian is not positive definite
+    (e.g. if the EM output is not exactly at the mode).
+    '''
+    H_banded = hessian_banded(theta, y, region_types, template, mu, sigmasq)
+    try:
+        return linalg.cholesky_banded(H_banded, lower=False)
+    except linalg.LinAlgError:
+        if verbose: print >> sys.stderr, 'Using Gauss-Newton approximation'
+
+    H_banded = lib.ddloglik_banded_convolve(theta, y, region_types, template,
+                                            mu, sigmasq, gauss_newton=True)
+    return linalg.cholesky_banded(H_banded, lower=False)
+
+def run(cfg, chrom=1, null=False, data=None):
+    '''
+    Draw approximate posterior samples of log-occupancies from a Laplace
+    approximation centered at the EM estimates. Draws are conditional on the
+    EM estimates of (mu, sigmasq).
+
+    Parameters
+    ----------
+        - cfg : dictionary
+            Dictionary containing (at least) data, prior, estimation_params,
+            estimation_output, and mcmc_params sections with appropriate
+            entries. Settings are read from an optional laplace_params section.
+        - chrom : int
+            Index (starting from 1) of chromosome to extract.
+        - null : bool
+            If null, use null reads instead of actual.
+        - data : dictionary
+            Data as output from deconvolve_mcmc.load_data, if already loaded
+            for chrom and null.
+
+    Returns
+    -------
+        Dictionary of results in the same format as deconvolve_mcmc.master
+        containing:
+        - theta : ndarray
+            Draws of log-occupancies, one row per draw. Written with
+            deconvolve_mcmc.save_results, no burnin is removed from them.
+        - mu : ndarray
+            EM estimates of log-mean (mu) parameters, repeated for each draw.
+        - sigmasq : ndarray
+            EM estimates of log-variance (sigmasq) parameters, repeated for
+            each draw.
+        - region_ids : integer ndarray
+            Vector of distinct region ids.
+        - ess : float
+            Effective sample size of importance weights. Equal to n_draws if
+            importance reweighting is not used.
+    '''
+    # Create references to frequently-accessed config information
+    laplace_params = cfg.get('laplace_params', {}) or {}
+    n_draws = laplace_params.get('n_draws', 1000)
+    batch_size = laplace_params.get('batch_size', 100)
+    importance = laplace_params.get('importance', False)
+    # Verbosity
+    verbose = cfg['estimation_params']['verbose']
+    timing = cfg['estimation_params']['timing']
+
+    # Load data, if needed, and EM estimates
+    if data is None:
+        data = deconvolve_mcmc.load_data(chrom=chrom, cfg=cfg, null=null)
+    em = load_em_results(data=data, cfg=cfg, null=null)
+
+    # Create references to relevant data entries in local scope
+    y = data['y']
+    template = data['template']
+    region_types = data['region_types']
+    region_ids = data['region_ids']
+    theta_hat = em['theta']
+    mu = em['mu']
+    sigmasq = em['sigmasq']
+
+    # Compute needed data properties
+    chrom_length = y.size
+    bandwidth = template.size - 1
+
+    if verbose and timing: tme = time.clock()
+
+    # Factor Hessian at mode
+    U = cholesky_hessian(theta_hat, y, region_types, template, mu, sigmasq,
+                         verbose=verbose)
+
+    if verbose and timing:
+        print >> sys.stderr, "Cholesky time: %s" % (time.clock() - tme)
+        tme = time.clock()
+
+    # Draw from N(theta_hat, H^-1) by back-substitution, H = U'U
+    theta = np.empty((n_draws, chrom_length))
+    log_weights = np.zeros(n_draws)
+    for start in xrange(0, n_draws, batch_size):
+        end = min(start + batch_size, n_draws)
+        z = np.random.randn(chrom_length, end - start)
+        draws = linalg.solve_banded((0, bandwidth), U, z).T
+        draws += theta_hat
+        theta[start:end] = draws
+
+        if importance:
+            # Log-ratio of target to proposal, up to a constant
+            for i in xrange(end - start):
+                log_weights[start + i] = -lib.loglik_convolve(
+                    theta=draws[i], y=y, region_types=region_types,
+                    template=template, subset=slice(None), theta0=draws[i],
+                    mu=mu, sigmasq=sigmasq, log=True)
+                log_weights[start + i] += 0.5*np.sum(z[:,i]**2)
+
+    ess = float(n_draws)
+    if importance:
+        # Sampling-importance-resampling to keep draws equally weighted
+        weights = np.exp(log_weights - log_weights.max())
+        weights /= weights.sum()
+        ess = 1./np.sum(weights**2)
+        resampled = np.searchsorted(np.cumsum(weights),
+                                    np.random.uniform(size=n_draws))
+        resampled = np.minimum(resampled, n_draws - 1)
+        theta = theta[resampled]
+
+    if verbose:
+        if timing: print >> sys.stderr, ("Sampling time: %s" %
+                                         (time.clock() - tme))
+        if importance: print 'Importance ESS: %g' % ess
+
+    # Return results
+    out = {'theta' : theta,
+           'mu' : np.tile(mu, (n_draws, 1)),
+           'sigmasq' : np.tile(sigmasq, (n_draws, 1)),
+           'region_ids' : region_ids,
+           'ess' : np.array(ess)}
+    return out
@@ -2,6 +2,7 @@ import os
 import sys
 import time
 import bz2
+import collections
 import contextlib
 import cPickle
 
@@ -14,6 +15,7 @@ except:
 from mpi4py import MPI
 
 import lib_deconvolve_em as lib
+import lib_warm_start
 import libio
 
 # Set constants
@@ -24,6 +26,26 @@ MPIROOT = 0
 STOPTAG = 0
 SYNCTAG = 1
 WORKTAG = 2
+# Default range of HMC step sizes
+EPS_MAX = 0.1
+EPS_MIN = 0.001
+# Cap on divergence counts packed into result tags; keeps tags well below the
+# minimum MPI_TAG_UB of 32767
+MAX_DIVERGENT = 1000
+
+def encode_tag(accept, n_divergent):
+    '''
+    Pack acceptance indicator and number of divergent trajectories for a block
+    into a single MPI tag.
+    '''
+    return accept + 2*min(n_divergent, MAX_DIVERGENT)
+
+def decode_tag(tag):
+    '''
+    Unpack acceptance indicator and number of divergent trajectories from an
+    MPI tag built by encode_tag.
+    '''
+    return tag % 2, tag / 2
 
 def load_data(chrom, cfg, null=False):
     '''
@@ -130,7 +152,9 @@ def initialize(data, cfg, rank=None, null=False):
             Dictionary containing (at least) prior and estimation_params
             sections with appropriate entries.
         - rank : int
-            If not None, rank of node to print in diagnostic output.
+            If not None, rank of node to print in diagnostic output. Only the
+            master uses the initial values, so multiresolution initialization
+            and the warm start are skipped on other nodes.
 
     Returns
     -------
@@ -148,6 +172,10 @@ def initialize(data, cfg, rank=None, null=False):
     b0 = cfg['prior']['b0']
     # Verbosity
     verbose = cfg['estimation_params']['verbose']
+    # Number of coarse levels for multiresolution initialization
+    levels = cfg['estimation_params'].get('multiresolution_levels', 0)
+    # Patterns for manifests of previous runs to warm start from
+    warm_start = cfg['estimation_params'].get('warm_start', None)
 
     # Create references to relevant data entries in local namespace
     y = data['y']
@@ -158,6 +186,12 @@ def initialize(data, cfg, rank=None, null=False):
     # Compute needed data properties
     n_regions = region_ids.max() + 1
 
+    # Look up the previous run with the best-matching inputs, if any
+    manifest = None
+    if warm_start is not None and rank in (None, MPIROOT):
+        manifest = lib_warm_start.previous_run(warm_start, data, cfg,
+                                               null=null, verbose=verbose)
+
     # Initialize nucleotide-level occupancies
     if cfg['mcmc_params']['initialize_theta_from_em']:
         # Load estimates from EM iterations
@@ -170,6 +204,18 @@ def initialize(data, cfg, rank=None, null=False):
         coef_path = coef_pattern.format(**cfg) % data['chrom']
 
         theta = np.log(np.loadtxt(coef_path))
+    elif levels > 0 and manifest is None and rank in (None, MPIROOT):
+        # Coarse-to-fine solutions given method-of-moments parameters, as for
+        # the EM initialization
+        sigmasq0 = b0 / a0
+        mu = np.zeros(n_regions)
+        for r in region_ids:
+            mu[r] = np.log(np.mean(y[region_list[r]] + 1.)) - sigmasq0 / 2.0
+        sigmasq = np.ones(n_regions)*sigmasq0
+        theta = np.log(lib.multiresolution_init(
+                y, data['region_types'], data['template'], mu, sigmasq, levels,
+                cfg['estimation_params']['block_width'],
+                method=cfg['estimation_params'].get('solver', 'tnc')))
     else:
         theta = np.log(y + 1.)
 
@@ -208,6 +254,11 @@ def initialize(data, cfg, rank=None, null=False):
             var_mu = sigmasq[r] / region_sizes[r]
             mu[r] = mean_mu + np.sqrt(var_mu)*np.random.randn(1)
 
+    # Start from the previous run, if found
+    if manifest is not None:
+        theta, mu, sigmasq = lib_warm_start.warm_start(manifest, data, theta,
+                                                       mu, sigmasq)
+
     if verbose:
         print "Node %d initialization complete" % rank
         if verbose > 2: print mu, sigmasq
@@ -218,6 +269,327 @@ def initialize(data, cfg, rank=None, null=False):
             'sigmasq' : sigmasq}
     return init
 
+def temperature_ladder(n_temps, max_temperature):
+    '''
+    Geometric ladder of inverse temperatures for parallel tempering, running
+    from 1 (the cold chain) to 1 / max_temperature.
+    '''
+    if n_temps < 2:
+        return np.ones(1)
+    return max_temperature**(-np.arange(n_temps) / (n_temps - 1.))
+
+def replica_of(rank, n_temps):
+    '''
+    Tempered replica handled by the worker with the given rank. Workers are
+    assigned to replicas round-robin.
+    '''
+    return (rank - 1) % n_temps
+
+def send_block(comm, worker, start, theta, block_width, w, theta_send_buf):
+    '''
+    Send block start and corresponding slice of theta, including buffers of
+    width w on either side, to worker to execute a theta draw.
+    '''
+    chrom_length = theta.size
+
+    # Setup block to send
+    end = min(chrom_length, start + block_width)
+    block = slice(max(start - w, 0), min(end+w, chrom_length))
+    theta_send_buf[:block.stop-block.start] = theta[block]
+
+    # Tell worker to update slice of theta and execute theta draw
+    comm.Send(np.array(start, dtype=np.int), dest=worker, tag=WORKTAG)
+
+    # Update theta slice on worker node
+    comm.Send(theta_send_buf, dest=worker, tag=MPIROOT)
+
+def sync_worker(comm, worker, t, mu, sigmasq):
+    '''
+    Synchronize a worker to the given iteration and its replica's current
+    region-level parameters.
+    '''
+    comm.Send([np.array(t, dtype=np.int), MPI.INT], dest=worker, tag=SYNCTAG)
+    comm.Send(mu, dest=worker, tag=MPIROOT)
+    comm.Send(sigmasq, dest=worker, tag=MPIROOT)
+
+def new_schedule(tilings, n_temps, region_ids, n_regions, block_writes):
+    '''
+    Setup the schedule of blocks for one iteration of all replicas, with colors
+    in random order for each replica.
+
+    Returns
+    -------
+        Dictionary containing
+        - color_queues : list
+            Remaining colors, as lists of block starts, by replica.
+        - queues : list
+            Blocks of the current color not yet dispatched, by replica.
+        - n_pending : integer ndarray
+            Number of blocks dispatched but not returned, by replica.
+        - n_unfinished : integer ndarray
+            Number of blocks writing within 2*w of each region not yet
+            returned, by replica and region id.
+        - region_done : boolean ndarray
+            Indicators of region-level parameters drawn, by replica and region
+            id.
+    '''
+    color_queues = []
+    queues = []
+    for j in xrange(n_temps):
+        color_queues.append([list(tilings[c]) for c in
+                             np.random.permutation(len(tilings))])
+        queues.append(color_queues[j].pop())
+
+    n_unfinished = np.zeros((n_temps, n_regions), dtype=np.int)
+    for tiling in tilings:
+        for start in tiling:
+            n_unfinished[:, block_writes[start]] += 1
+
+    region_done = np.ones((n_temps, n_regions), dtype=np.bool)
+    region_done[:, region_ids] = False
+
+    schedule = {'color_queues' : color_queues,
+                'queues' : queues,
+                'n_pending' : np.zeros(n_temps, dtype=np.int),
+                'n_unfinished' : n_unfinished,
+                'region_done' : region_done}
+    return schedule
+
+def dispatch_blocks(comm, idle, schedule, t, assigned, assigned_iter, synced,
+                    version, mu_rep, sigmasq_rep, theta_rep, block_width, w,
+                    theta_send_buf, ready=None, block_reads=None,
+                    preconditioners=None):
+    '''
+    Send queued blocks of the current color to idle workers, each taking blocks
+    only for its own replica. Workers are synchronized to iteration t and the
+    current parameters first if needed.
+
+    If ready is given, only blocks for which ready[replica, block_reads[start]]
+    all hold are sent. This is used to start blocks of the next iteration once
+    the parameters of every region they read have been drawn.
+
+    If preconditioners is given, the frozen preconditioner for each block,
+    by (replica, start), is sent with it.
+
+    Updates schedule, assigned, assigned_iter, and synced in place.
+
+    Returns
+    -------
+        - idle : list
+            Ranks of workers left idle.
+    '''
+    n_temps = len(schedule['queues'])
+    still_idle = []
+    for worker in idle:
+        j = replica_of(worker, n_temps)
+        queue = schedule['queues'][j]
+
+        # Find last eligible block in queue
+        k = len(queue) - 1
+        if ready is not None:
+            while k >= 0 and not np.all(ready[j, block_reads[queue[k]]]):
+                k -= 1
+        if k < 0:
+            still_idle.append(worker)
+            continue
+
+        if synced[worker-1, 0] != t or synced[worker-1, 1] != version[j]:
+            sync_worker(comm=comm, worker=worker, t=t, mu=mu_rep[j],
+                        sigmasq=sigmasq_rep[j])
+            synced[worker-1] = (t, version[j])
+
+        assigned[worker-1] = queue.pop(k)
+        assigned_iter[worker-1] = t
+        schedule['n_pending'][j] += 1
+        send_block(comm=comm, worker=worker, start=assigned[worker-1],
+                   theta=theta_rep[j], block_width=block_width, w=w,
+                   theta_send_buf=theta_send_buf)
+        if preconditioners is not None:
+            comm.Send(preconditioners[j, assigned[worker-1]], dest=worker,
+                      tag=MPIROOT)
+    return still_idle
+
+def draw_region_params(theta, mu, sigmasq, region_ids, region_list,
+                       region_sizes, prior_mean, a0, b0, k0):
+    '''
+    Draw region-level parameters (mu, sigmasq) given log-occupancies from their
+    conditional posterior. Updates mu and sigmasq in place.
+    '''
+    for r in region_ids:
+        region = region_list[r]
+
+        # Draw sigmasq from marginal distribution
+        shape_sigmasq = region_sizes[r]/2. + a0
+        rate_sigmasq = (np.var(theta[region])*region_sizes[r]/2. + b0
+                        + k0*region_sizes[r]/2./(1.+k0)*
+                        (np.mean(theta[region]) - prior_mean[r])**2)
+        sigmasq[r] = rate_sigmasq/np.random.gamma(shape=shape_sigmasq,
+                                                  scale=1.)
+
+        # Draw mu | sigmasq
+        mean_mu = (np.mean(theta[region]) + prior_mean[r]*k0)/(1.0 + k0)
+        var_mu = sigmasq[r] / (1. + k0) / region_sizes[r]
+        mu[r] = mean_mu + np.sqrt(var_mu)*np.random.randn(1)
+
+def centering_weights(parameterization, coverage, sigmasq, template):
+    '''
+    Centering weights by region for the parameterization of log-occupancies,
+    as used by lib.affine_centering.
+
+    With 'adaptive', the weight for each region is the one that is optimal for
+    a Gaussian approximation to the likelihood, sigmasq*I / (1 + sigmasq*I),
+    where I is the Fisher information for a single log-occupancy at the
+    region's mean coverage. Low-coverage regions are then close to
+    non-centered and high-coverage regions close to centered.
+    '''
+    if parameterization == 'centered':
+        return np.ones_like(sigmasq)
+    elif parameterization == 'noncentered':
+        return np.zeros_like(sigmasq)
+    elif parameterization == 'adaptive':
+        information = coverage * np.sum(template**2)
+        return sigmasq*information / (1. + sigmasq*information)
+    raise ValueError('Unknown parameterization %s' % parameterization)
+
+def interweave_region_params(theta, mu, sigmasq, centering, y, template,
+                             region_types, region_ids, region_list,
+                             region_sizes, prior_mean, a0, b0, k0, beta=1.):
+    '''
+    Metropolis-Hastings update of region-level parameters (mu, sigmasq) holding
+    the reparameterized log-occupancies u = (theta - loc) / scale fixed, as in
+    lib.affine_centering. Interweaving this with the draw of (mu, sigmasq) given
+    theta avoids the slow mixing of either parameterization alone. Proposals
+    are random walks on (mu, log(sigmasq)), with the mu step scaled by the
+    current sigmasq and corrected for in the acceptance ratio, evaluated
+    exactly over each region and a window of width 2*w around it.
+
+    Updates theta, mu, and sigmasq in place.
+
+    Returns
+    -------
+        - accepted : integer ndarray
+            Indicators of accepted proposals by region id. Regions with a
+            centering weight of 1 are not updated.
+    '''
+    # Compute needed data properties
+    chrom_length = theta.size
+    w = template.size/2 + 1
+
+    accepted = np.zeros(mu.size, dtype=np.int)
+
+    for r in region_ids:
+        c = centering[r]
+        if c >= 1.:
+            continue
+
+        region = region_list[r]
+        window = slice(max(region.start - 2*w, 0),
+                       min(region.stop + 2*w, chrom_length))
+        in_region = (region_types[window] == r)
+        n = region_sizes[r]
+
+        # Reparameterized log-occupancies to hold fixed
+        theta_old = theta[window]
+        u = ((theta_old[in_region] - (1. - c)*mu[r]) /
+             sigmasq[r]**((1. - c)/2.))
+
+        # Random-walk proposal, scaled by the conditional posterior given theta
+        mu_prop = mu.copy()
+        sigmasq_prop = sigmasq.copy()
+        step = np.sqrt(sigmasq[r]/(1. + k0)/n)*np.random.randn()
+        mu_prop[r] += step
+        sigmasq_prop[r] *= np.exp(np.sqrt(2./n)*np.random.randn())
+
+        theta_new = theta_old.copy()
+        theta_new[in_region] = ((1. - c)*mu_prop[r] +
+                                sigmasq_prop[r]**((1. - c)/2.)*u)
+
+        # Negative log-target in (u, mu, log(sigmasq)) after and before move
+        energy = 0.
+        for sign, theta_window, mu_window, sigmasq_window in (
+            (1., theta_new, mu_prop, sigmasq_prop),
+            (-1., theta_old, mu, sigmasq)):
+            energy += sign*lib.loglik_convolve(
+                theta=theta_window, y=y[window],
+                region_types=region_types[window], template=template,
+                subset=None, theta0=theta_window, mu=mu_window,
+                sigmasq=sigmasq_window, log=True, beta=beta)
+
+            # Jacobian from theta to u and from sigmasq to log(sigmasq)
+            log_sigmasq = np.log(sigmasq_window[r])
+            energy -= sign*(n*(1. - c)/2. + 1.)*log_sigmasq
+
+            # Prior on (mu, sigmasq)
+            energy += sign*((a0 + 1.5)*log_sigmasq +
+                            b0/sigmasq_window[r] +
+                            k0*n*(mu_window[r] - prior_mean[r])**2/2./
+                            sigmasq_window[r])
+
+        # Hastings correction: the mu step is scaled by the current sigmasq,
+        # so the reverse move draws it with sigmasq_prop instead
+        energy += (0.5*np.log(sigmasq_prop[r]/sigmasq[r]) +
+                   step**2*(1. + k0)*n/2.*(1./sigmasq_prop[r] - 1./sigmasq[r]))
+
+        if np.log(np.random.uniform()) < -energy:
+            theta[window] = theta_new
+            mu[r] = mu_prop[r]
+            sigmasq[r] = sigmasq_prop[r]
+            accepted[r] = 1
+
+    return accepted
+
+def propose_swaps(theta_rep, mu_rep, sigmasq_rep, betas, y, template,
+                  region_types, block_width):
+    '''
+    Propose exchanging log-occupancies between adjacent temperatures, one
+    non-overlapping block at a time. Swapping a block changes the target only
+    through the block and the rates within w of it, so each proposal is
+    evaluated exactly over a window of width 2*w around the block.
+
+    Updates theta_rep in place.
+
+    Returns
+    -------
+        - n_proposed : integer ndarray
+            Number of swaps proposed between each pair of adjacent temperatures.
+        - n_accepted : integer ndarray
+            Number of swaps accepted between each pair of adjacent temperatures.
+    '''
+    # Compute needed data properties
+    n_temps, chrom_length = theta_rep.shape
+    w = template.size/2 + 1
+
+    n_proposed = np.zeros(n_temps - 1, dtype=np.int)
+    n_accepted = np.zeros(n_temps - 1, dtype=np.int)
+
+    for j in xrange(n_temps - 1):
+        for start in xrange(0, chrom_length, block_width):
+            end = min(start + block_width, chrom_length)
+            window = slice(max(start - 2*w, 0), min(end + 2*w, chrom_length))
+            original = slice(start - window.start, end - window.start)
+
+            # Negative log-targets for each replica before and after swap
+            energy = 0.
+            for k, other in ((j, j+1), (j+1, j)):
+                theta_old = theta_rep[k, window]
+                theta_new = theta_old.copy()
+                theta_new[original] = theta_rep[other, start:end]
+                for sign, theta_window in ((1., theta_new), (-1., theta_old)):
+                    energy += sign*lib.loglik_convolve(
+                        theta=theta_window, y=y[window],
+                        region_types=region_types[window], template=template,
+                        subset=slice(None), theta0=theta_window, mu=mu_rep[k],
+                        sigmasq=sigmasq_rep[k], log=True, beta=betas[k])
+
+            n_proposed[j] += 1
+            if np.log(np.random.uniform()) < -energy:
+                n_accepted[j] += 1
+                swap = theta_rep[j, start:end].copy()
+                theta_rep[j, start:end] = theta_rep[j+1, start:end]
+                theta_rep[j+1, start:end] = swap
+
+    return n_proposed, n_accepted
+
 def master(comm, n_proc, data, init, cfg):
     '''
     Master node process for parallel MCMC. Coordinates draws, handles all
@@ -251,6 +623,12 @@ def master(comm, n_proc, data, init, cfg):
             MAP estimates of log-variance (sigmasq) parameters.
         - region_ids : integer ndarray
             Vector of distinct region ids.
+        - swap_accepted : ndarray
+            Acceptance rates of swaps between adjacent temperatures. Empty
+            without parallel tempering.
+        - interweave_accepted : ndarray
+            Acceptance rates of interweaving updates of (mu, sigmasq) by region
+            id. Zero with the centered parameterization.
     '''
     # Create references to frequently-accessed config information
     # Prior on mu - sigmasq / 2
@@ -261,6 +639,9 @@ def master(comm, n_proc, data, init, cfg):
     b0 = cfg['prior']['b0']
     # Iteration limits
     max_iter = cfg['mcmc_params']['mcmc_iterations']
+    # Preconditioners are frozen after burnin
+    precondition = cfg['mcmc_params'].get('precondition', False)
+    freeze_iter = freeze_precondition_iter(cfg['mcmc_params']['n_burnin'])
     # Verbosity
     verbose = cfg['estimation_params']['verbose']
     timing = cfg['estimation_params']['timing']
@@ -271,6 +652,7 @@ def master(comm, n_proc, data, init, cfg):
 
     # Create references to relevant data entries in local scope
     y = data['y']
+    region_types = data['region_types']
     region_list = data['region_list']
     region_sizes = data['region_sizes']
     region_ids = data['region_ids']
@@ -299,44 +681,100 @@ def master(comm, n_proc, data, init, cfg):
     else:
         block_width = cfg['estimation_params']['block_width']
 
+    # Get coverage by region
+    coverage = np.zeros(n_regions)
+    for i in region_ids:
+        coverage[i] = np.mean(y[region_list[i]])
+
     # Setup prior means
     prior_mean = np.zeros(n_regions)
     if adapt_prior:
         # Adapt prior means if requested
-        # Get coverage by region
-        coverage = np.zeros(n_regions)
-        for i in region_ids:
-            coverage[i] = np.mean(y[region_list[i]])
-
-        # Translate to prior means
+        # Translate coverage to prior means
         prior_mean[coverage>0] = np.log(coverage[coverage>0]) - sigmasq0 / 2.0
     else:
         prior_mean += mu0
 
+    # Setup parameterization of log-occupancies for interweaving updates of
+    # region-level parameters
+    parameterization = cfg['mcmc_params'].get('parameterization', 'centered')
+    n_interweave_accepted = np.zeros(n_regions, dtype=np.int)
+
+    # Setup replicas for parallel tempering. Replica 0 is the cold chain; its
+    # states are stored in theta, mu, and sigmasq. Tempered replicas only keep
+    # their current states.
+    n_temps = cfg['mcmc_params'].get('n_temperatures', 1)
+    betas = temperature_ladder(n_temps,
+                               cfg['mcmc_params'].get('max_temperature', 10.))
+    swap_interval = cfg['mcmc_params'].get('swap_interval', 1)
+    #
+    theta_rep = np.empty((n_temps, chrom_length))
+    theta_rep[:] = init['theta']
+    #
+    mu_rep = np.empty((n_temps, n_regions))
+    mu_rep[:] = init['mu']
+    #
+    sigmasq_rep = np.empty((n_temps, n_regions))
+    sigmasq_rep[:] = init['sigmasq']
+
     # Initialize information for MCMC sampler
     ret_val = np.empty(block_width)
     status = MPI.Status()
 
+    # Latest preconditioners returned by workers, by (replica, block start),
+    # padded to block_width. They are frozen from iteration freeze_iter.
+    preconditioners = {}
+    precond_buf = np.empty(block_width)
+
     # Start timing, if requested
     if timing:
         tme = time.clock()
 
+    # Track blocks assigned to each worker, the iteration they belong to,
+    # and the iteration and parameter version each worker was last
+    # synchronized to
     assigned = np.zeros(n_workers, dtype=np.int)
+    assigned_iter = np.zeros(n_workers, dtype=np.int)
+    synced = -np.ones((n_workers, 2), dtype=np.int)
+    version = np.zeros(n_temps, dtype=np.int)
 
     # Setup blocks for worker nodes
     # This is the scan algorithm with a 2-iteration cycle.
     # It is designed to ensure consistent sampling coverage of the chromosome.
-    start_vec = [np.arange(0, chrom_length, block_width, dtype=np.int),
-                 np.arange(block_width/2, chrom_length, block_width,
-                           dtype=np.int)]
-    start_vec = np.concatenate(start_vec)
+    # Each tiling is a color: the coefficients updated by blocks within a
+    # tiling are 2*w apart, so their conditionals do not depend on each other
+    # and all blocks of a color can run at once. Colors are run one at a time,
+    # giving an exact Gibbs sweep.
+    tilings = [np.arange(0, chrom_length, block_width, dtype=np.int),
+               np.arange(block_width/2, chrom_length, block_width,
+                         dtype=np.int)]
     # Remove any blocks that are too small to buffer by w
-    block_sizes = np.minimum(start_vec + block_width, chrom_length) - start_vec
-    start_vec = start_vec[block_sizes > w]
+    for c in xrange(len(tilings)):
+        block_sizes = (np.minimum(tilings[c] + block_width, chrom_length) -
+                       tilings[c])
+        tilings[c] = tilings[c][block_sizes > w]
+    start_vec = np.concatenate(tilings)
     # Setup buffer for sending and recieving chunks of theta
     theta_buf_size = block_width + 2*w
     theta_send_buf = np.empty(theta_buf_size, dtype=np.float)
 
+    # Setup dependencies between blocks and regions for pipelining. Parameters
+    # for a region can be drawn once every block writing within 2*w of it has
+    # returned, and a block of the next iteration can start once parameters for
+    # every region it reads have been drawn.
+    region_coords = [None]*n_regions
+    for r in region_ids:
+        region_coords[r] = np.where(region_types == r)[0]
+    block_writes = {}
+    block_reads = {}
+    for start in start_vec:
+        end = min(start + block_width, chrom_length)
+        block_writes[start] = [r for r in region_ids if
+                               start < region_list[r].stop + 2*w and
+                               end > region_list[r].start - 2*w]
+        block_reads[start] = np.unique(
+            region_types[max(start - w, 0):min(end + w, chrom_length)])
+
     # Initialize acceptance statistics
     n_prop_per_iteration = np.zeros(chrom_length, dtype=np.int)
     for start in start_vec:
@@ -346,107 +784,171 @@ def master(comm, n_proc, data, init, cfg):
     n_accepted = np.zeros(chrom_length, dtype=np.int)
     n_accepted_tm1 = np.zeros_like(n_accepted)
 
+    # Initialize count of divergent HMC trajectories by iteration
+    n_divergent = np.zeros(max_iter, dtype=np.int)
+
+    # Initialize swap statistics between adjacent temperatures
+    n_swap_proposed = np.zeros(n_temps - 1, dtype=np.int)
+    n_swap_accepted = np.zeros(n_temps - 1, dtype=np.int)
+
     if verbose > 1:
         # Print starting values for parameters
         print mu[0], sigmasq[0]
         # Initialize rough block identifiers
         block_ids = np.arange(chrom_length, dtype=np.int) / block_width
 
-    for t in xrange(1, max_iter):
-        # (1) Distributed draw of theta | mu, sigmasq, y on workers.
-
-        # First, synchronize parameters across all workers
-
-        # Coordinate the workers into the synchronization state
-        for k in range(1, n_workers+1):
-            comm.Send([np.array(0, dtype=np.int), MPI.INT], dest=k, tag=SYNCTAG)
-
-        # Broadcast theta and parameter values to all workers
-        comm.Bcast(mu[t-1], root=MPIROOT)
-        comm.Bcast(sigmasq[t-1], root=MPIROOT)
-
-        # Initialize local theta for current iteration
-        theta[t] = theta[t-1]
+    schedule = new_schedule(tilings=tilings, n_temps=n_temps,
+                            region_ids=region_ids, n_regions=n_regions,
+                            block_writes=block_writes)
+    idle = range(1, n_workers+1)
 
-        # Dispatch jobs to workers until completed
-        n_jobs = start_vec.size
-        n_started = 0
-        n_completed = 0
-
-        # Randomize block ordering
-        np.random.shuffle(start_vec)
-
-        # Send first batch of jobs
-        for worker in range(1,min(n_workers, start_vec.size)+1):
-            # Setup block to send
-            end = min(chrom_length, start_vec[n_started] + block_width)
-            block = slice(max(start_vec[n_started] - w, 0),
-                          min(end+w, chrom_length))
-            theta_send_buf[:block.stop-block.start] = theta[t,block]
-            
-            # Tell worker to update slice of theta and execute theta draw
-            comm.Send(np.array(start_vec[n_started], dtype=np.int),
-                      dest=worker, tag=WORKTAG)
-            
-            # Update theta slice on worker node
-            comm.Send(theta_send_buf, dest=worker, tag=MPIROOT)
-
-            # Update job counter and assignment array
-            assigned[worker-1] = start_vec[n_started]
-            n_started += 1
+    for t in xrange(1, max_iter):
+        # (1) Distributed draw of theta | mu, sigmasq, y on workers, pipelined
+        # with (2) draws of region-level parameters given occupancies for each
+        # region as soon as it is final. Blocks of this iteration may already
+        # have been started during the last one.
+
+        # Blocks of the next iteration can start early unless swaps between
+        # replicas are due at the end of this one
+        swap_due = (n_temps > 1 and t % swap_interval == 0)
+        if t + 1 < max_iter and not swap_due:
+            next_schedule = new_schedule(tilings=tilings, n_temps=n_temps,
+                                         region_ids=region_ids,
+                                         n_regions=n_regions,
+                                         block_writes=block_writes)
+        else:
+            next_schedule = None
+
+        while True:
+            # Draw region-level parameters for any regions that are final
+            for j in xrange(n_temps):
+                ready = np.where(~schedule['region_done'][j] &
+                                 (schedule['n_unfinished'][j] == 0))[0]
+                for r in ready:
+                    draw_region_params(theta=theta_rep[j], mu=mu_rep[j],
+                                       sigmasq=sigmasq_rep[j], region_ids=[r],
+                                       region_list=region_list,
+                                       region_sizes=region_sizes,
+                                       prior_mean=prior_mean, a0=a0, b0=b0,
+                                       k0=k0)
+
+                    # Interweave with a draw holding reparameterized
+                    # log-occupancies fixed
+                    if parameterization != 'centered':
+                        centering = centering_weights(parameterization,
+                                                      coverage,
+                                                      sigmasq_rep[j], template)
+                        accepted = interweave_region_params(
+                            theta=theta_rep[j], mu=mu_rep[j],
+                            sigmasq=sigmasq_rep[j], centering=centering, y=y,
+                            template=template, region_types=region_types,
+                            region_ids=[r], region_list=region_list,
+                            region_sizes=region_sizes, prior_mean=prior_mean,
+                            a0=a0, b0=b0, k0=k0, beta=betas[j])
+                        if j == 0:
+                            n_interweave_accepted += accepted
+
+                    schedule['region_done'][j, r] = True
+                    version[j] += 1
+
+                    # Store state of cold chain for the region before any
+                    # blocks of the next iteration can change it
+                    if j == 0 and not swap_due:
+                        theta[t, region_coords[r]] = theta_rep[0,
+                                                               region_coords[r]]
+
+            # Send jobs to idle workers, starting blocks of the next iteration
+            # once the regions they read are final
+            idle = dispatch_blocks(comm=comm, idle=idle, schedule=schedule, t=t,
+                                   assigned=assigned,
+                                   assigned_iter=assigned_iter, synced=synced,
+                                   version=version, mu_rep=mu_rep,
+                                   sigmasq_rep=sigmasq_rep,
+                                   theta_rep=theta_rep,
+                                   block_width=block_width, w=w,
+                                   theta_send_buf=theta_send_buf,
+                                   preconditioners=(
+                                       preconditioners if precondition and
+                                       t >= freeze_iter else None))
+            if next_schedule is not None:
+                idle = dispatch_blocks(comm=comm, idle=idle,
+                                       schedule=next_schedule, t=t+1,
+                                       assigned=assigned,
+                                       assigned_iter=assigned_iter,
+                                       synced=synced, version=version,
+                                       mu_rep=mu_rep, sigmasq_rep=sigmasq_rep,
+                                       theta_rep=theta_rep,
+                                       block_width=block_width, w=w,
+                                       theta_send_buf=theta_send_buf,
+                                       ready=schedule['region_done'],
+                                       block_reads=block_reads,
+                                       preconditioners=(
+                                           preconditioners if precondition and
+                                           t + 1 >= freeze_iter else None))
+
+            if np.all(schedule['region_done']):
+                break
 
-        # Collect results from workers and dispatch additional jobs until
-        # complete
-        while n_completed < n_jobs:
             # Collect any completed results
             comm.Recv(ret_val, source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG,
                       status=status)
-            n_completed += 1
-            
+
             # Slot updated slice of theta into proper place
             worker = status.Get_source()
+            j = replica_of(worker, n_temps)
             start = assigned[worker-1]
+            t_block = assigned_iter[worker-1]
             end = min(start+block_width, chrom_length)
-            n_accepted[start:end] += status.Get_tag()
-            theta[t,start:end] = ret_val[:end-start]
-
-            # If all jobs are not complete, update theta on the just-finished
-            # worker and send another job.
-            if n_started < n_jobs:
-                # Setup block to send
-                end = min(chrom_length, start_vec[n_started] + block_width)
-                block = slice(max(start_vec[n_started] - w, 0),
-                              min(end+w, chrom_length))
-                theta_send_buf[:block.stop-block.start] = theta[t,block]
-
-                # Tell worker to update slice of theta and execute theta draw
-                comm.Send(np.array(start_vec[n_started], dtype=np.int),
-                          dest=worker, tag=WORKTAG)
-                
-                # Update theta slice on worker node
-                comm.Send(theta_send_buf, dest=worker, tag=MPIROOT)
-
-                # Update job counter and assignment array
-                assigned[worker-1] = start_vec[n_started]
-                n_started += 1
-
-        # (2) Draw region-level parameters given occupancies
-
-        for r in region_ids:
-            region = region_list[r]
-
-            # Draw sigmasq from marginal distribution
-            shape_sigmasq = region_sizes[r]/2. + a0
-            rate_sigmasq = (np.var(theta[t,region])*region_sizes[r]/2. + b0
-                            + k0*region_sizes[r]/2./(1.+k0)*
-                            (np.mean(theta[t,region]) - prior_mean[r])**2)
-            sigmasq[t,r] = rate_sigmasq/np.random.gamma(shape=shape_sigmasq,
-                                                        scale=1.)
-
-            # Draw mu | sigmasq
-            mean_mu = (np.mean(theta[t,region]) + prior_mean[r]*k0)/(1.0 + k0)
-            var_mu = sigmasq[t,r] / (1. + k0) / region_sizes[r]
-            mu[t,r] = mean_mu + np.sqrt(var_mu)*np.random.randn(1)
+            theta_rep[j,start:end] = ret_val[:end-start]
+            idle.append(worker)
+
+            # Keep the block's preconditioner while they are adapted
+            if precondition and t_block < freeze_iter:
+                comm.Recv(precond_buf, source=worker, tag=MPI.ANY_TAG)
+                preconditioners[j, start] = precond_buf.copy()
+
+            # Track acceptance and divergences for the cold chain only
+            if j == 0:
+                accept, n_divergent_block = decode_tag(status.Get_tag())
+                n_accepted[start:end] += accept
+                n_divergent[t_block] += n_divergent_block
+
+            # Update schedule for the block's iteration, moving its replica to
+            # the next color once the current one is complete
+            if t_block == t:
+                block_schedule = schedule
+            else:
+                block_schedule = next_schedule
+            block_schedule['n_pending'][j] -= 1
+            block_schedule['n_unfinished'][j, block_writes[start]] -= 1
+            if (block_schedule['n_pending'][j] == 0 and
+                len(block_schedule['queues'][j]) == 0 and
+                len(block_schedule['color_queues'][j]) > 0):
+                block_schedule['queues'][j] = \
+                        block_schedule['color_queues'][j].pop()
+
+        # (3) Propose exchanges of blocks between adjacent temperatures
+        if swap_due:
+            n_prop, n_acc = propose_swaps(theta_rep=theta_rep, mu_rep=mu_rep,
+                                          sigmasq_rep=sigmasq_rep,
+                                          betas=betas, y=y, template=template,
+                                          region_types=region_types,
+                                          block_width=block_width)
+            n_swap_proposed += n_prop
+            n_swap_accepted += n_acc
+            theta[t] = theta_rep[0]
+
+        # Store parameters of cold chain
+        mu[t] = mu_rep[0]
+        sigmasq[t] = sigmasq_rep[0]
+
+        # Move on to schedule for next iteration
+        if next_schedule is None:
+            next_schedule = new_schedule(tilings=tilings, n_temps=n_temps,
+                                         region_ids=region_ids,
+                                         n_regions=n_regions,
+                                         block_writes=block_writes)
+        schedule = next_schedule
 
         if verbose:
             if timing: print >> sys.stderr, ( "%d:\tIteration time: %s" %
@@ -454,10 +956,13 @@ def master(comm, n_proc, data, init, cfg):
             if verbose > 1:
                 prop_accepted = (n_accepted-n_accepted_tm1)/n_prop_per_iteration
                 print np.mean(prop_accepted)
+                print n_divergent[t]
                 print (np.bincount(block_ids, weights=prop_accepted) /
                        np.bincount(block_ids))
                 print mu[t]
                 print sigmasq[t]
+                if n_temps > 1:
+                    print n_swap_accepted / np.maximum(n_swap_proposed, 1.)
                 n_accepted_tm1 = n_accepted.copy()
 
         if timing:
@@ -473,7 +978,10 @@ def master(comm, n_proc, data, init, cfg):
            'mu' : mu,
            'sigmasq' : sigmasq,
            'region_ids' : region_ids,
-           'prop_accepted' : n_accepted/(max_iter - 1.)/n_prop_per_iteration}
+           'prop_accepted' : n_accepted/(max_iter - 1.)/n_prop_per_iteration,
+           'n_divergent' : n_divergent,
+           'swap_accepted' : n_swap_accepted / np.maximum(n_swap_proposed, 1.),
+           'interweave_accepted' : n_interweave_accepted/(max_iter - 1.)}
     return out
 
 def rmh_worker_theta(comm, block_width, start, y, template, theta, mu, sigmasq,
@@ -595,9 +1103,102 @@ def rmh_worker_theta(comm, block_width, start, y, template, theta, mu, sigmasq,
     # Transmit result
     comm.Send(ret_val, dest=MPIROOT, tag=accept)
 
+def precondition_theta(start, block_width, y, template, theta, mu, sigmasq,
+                       region_types, beta=1., solver='tnc'):
+    '''
+    Compute diagonal mass matrix for HMC on a given block from the Hessian of
+    the log-target at the conditional posterior mode of the block.
+
+    Parameters
+    ----------
+        - start : int
+            Start of block.
+        - block_width : int
+            Width of blocks.
+        - y : ndarray
+            Counts of read centers per base pair for the full chromosome.
+        - template : ndarray
+            Vector containing coefficients for template.
+        - theta : ndarray
+            Current log-occupancies for the block, including buffers.
+        - mu : ndarray
+            Current log-mean (mu) parameters.
+        - sigmasq : ndarray
+            Current log-variance (sigmasq) parameters.
+        - region_types : integer ndarray
+            Vector of region types by base pair for the full chromosome.
+        - beta : float
+            Inverse temperature of the block's target.
+        - solver : str
+            Method for lib.deconvolve to find the mode, 'tnc' or 'newton-cg'.
+
+    Returns
+    -------
+        - theta_hat : ndarray
+            Conditional posterior mode over the block's subset.
+        - sigmasq_p : ndarray
+            Diagonal of the mass matrix over the block's subset. Bounded below
+            by the prior precision, as the observed information at the mode
+            can be indefinite along the diagonal.
+    '''
+    # Compute needed data properties
+    chrom_length = y.size
+    w = template.size/2 + 1
+
+    # Calculate subset of data to work on
+    end = min(chrom_length, start + block_width)
+    block = slice(max(start-w, 0), min(end+w, chrom_length))
+    size_block = block.stop - block.start
+
+    subset = slice(w*(start!=0)+start-block.start,
+                   size_block-w*(end!=chrom_length) - (block.stop-end))
+
+    theta_block = theta[:size_block]
+
+    theta_hat = lib.deconvolve(lib.loglik_dloglik_convolve, None,
+                               y[block], region_types[block], template,
+                               mu, sigmasq,
+                               subset=subset, theta0=theta_block,
+                               log=True, beta=beta, method=solver,
+                               messages=0)[0]
+    sigmasq_p = lib.ddloglik_diag_convolve(theta=theta_hat, y=y[block],
+                                           region_types=region_types[block],
+                                           template=template, mu=mu,
+                                           sigmasq=sigmasq,
+                                           theta0=theta_block,
+                                           subset=subset, log=True, beta=beta)
+    sigmasq_p = np.maximum(sigmasq_p,
+                           1./sigmasq[region_types[block][subset]])
+    return theta_hat, sigmasq_p
+
+def truncate_template(template, mass=0.99):
+    '''
+    Build a cheaper template for surrogate likelihoods by truncating to the
+    smallest symmetric central window holding at least the given fraction of
+    the template's mass, renormalized to preserve the total.
+    '''
+    center = template.size/2
+    total = np.sum(template)
+    k = 0
+    while (k < center and
+           np.sum(template[center-k:center+k+1]) < mass*total):
+        k += 1
+    truncated = template[center-k:center+k+1]
+    return truncated * total / np.sum(truncated)
+
 def rhmc_worker_theta(comm, block_width, start, y, template, theta, mu, sigmasq,
-                      region_types, prop_df=5., eps_max=0.1, eps_min=0.001,
-                      n_steps=100, sigmasq_p=1., adj=10, verbose=0):
+                      region_types, prop_df=5., eps_max=EPS_MAX,
+                      eps_min=EPS_MIN, n_steps=100, sigmasq_p=1., adj=10,
+                      fast_inactive=True,
+                      max_energy_error=1000., energy_check_interval=1,
+                      beta=1., centering=None, surrogate_template=None,
+                      workspace=None, leapfrog_workspace=None, out=None,
+                      verbose=0):
+    # If leapfrog_workspace is given (e.g. a single-precision BlockWorkspace),
+    # gradients and energy checks within trajectories are computed with it.
+    # The first and last steps, and hence the MH log-ratio, always use
+    # workspace. If comm is None, the result is only written to out.
+
     # Compute needed data properties
     chrom_length = y.size
     w = template.size/2 + 1
@@ -613,97 +1214,208 @@ def rhmc_worker_theta(comm, block_width, start, y, template, theta, mu, sigmasq,
                    size_block-w*(end!=chrom_length) - (block.stop-end))
     size_subset = subset.stop - subset.start
     
-    theta_block = theta[:size_block]
-    theta_subset = theta_block[subset]
+    theta_block = theta[:size_block].copy()
+
+    # Setup workspace with the block's data and gathered parameters if not
+    # provided
+    if workspace is None:
+        workspace = lib.BlockWorkspace(y[block], region_types[block])
+        workspace.set_params(mu, sigmasq)
+    if leapfrog_workspace is None:
+        leapfrog_workspace = workspace
 
     # Setup initial return value
-    ret_val = np.empty(block_width)
+    if out is None:
+        ret_val = np.empty(block_width)
+    else:
+        ret_val = out
 
+    # Coefficients with no reads in their footprint are conditionally
+    # independent of the rest of the block given (mu, sigmasq). Draw them
+    # directly and run HMC only over the remaining (active) coefficients.
+    if fast_inactive:
+        active = lib.find_active(y[block], w=w)[subset]
+    else:
+        active = np.ones(size_subset, dtype=np.bool)
+    
+    if not np.all(active):
+        inactive = np.arange(subset.start, subset.stop)[~active]
+        region_inactive = region_types[block][inactive]
+        weight = lib.inactive_weights(template, size_block)[inactive]
+        theta_block[inactive] = lib.rinactive(theta_block[inactive],
+                                              mu[region_inactive],
+                                              sigmasq[region_inactive],
+                                              beta*weight)[0]
+    
+    if not np.any(active):
+        # Nothing left for HMC; the direct draws are always accepted
+        accept = 1
+        ret_val[:end-start] = theta_block[original]
+        if comm is not None:
+            comm.Send(ret_val, dest=MPIROOT, tag=encode_tag(accept, 0))
+        return accept, 0
+    
     # Calculate diagonal of Hessian if requested (by setting sigma.p to None)
     if sigmasq_p is None:
-        result = lib.deconvolve(lib.loglik_convolve, lib.dloglik_convolve,
-                                y[block], region_types[block], template,
-                                mu, sigmasq,
-                                subset=subset, theta0=theta_block,
-                                log=True,
-                                messages=0)
-        sigmasq_p = lib.ddloglik_diag_convolve(theta=result[0], y=y[block],
-                                               region_types=region_types[block],
-                                               template=template, mu=mu,
-                                               sigmasq=sigmasq,
-                                               theta0=theta_block,
-                                               subset=subset, log=True)
+        sigmasq_p = precondition_theta(start=start, block_width=block_width,
+                                       y=y, template=template,
+                                       theta=theta_block, mu=mu,
+                                       sigmasq=sigmasq,
+                                       region_types=region_types,
+                                       beta=beta)[1]
+
+    if not np.all(active):
+        # Restrict HMC to active coefficients
+        subset = np.arange(subset.start, subset.stop)[active]
+        size_subset = subset.size
+        if np.size(sigmasq_p) > 1:
+            sigmasq_p = sigmasq_p[active]
+    
+    # Run HMC on u, where theta = loc + scale*u, with centering weights by
+    # region; the default is the centered parameterization (u = theta). A
+    # Hessian-based mass matrix is transformed to match; a unit mass matrix is
+    # kept in terms of u.
+    if centering is None:
+        loc = np.zeros(size_block)
+        scale = np.ones(size_block)
+    else:
+        loc, scale = lib.affine_centering(mu, sigmasq, region_types[block],
+                                          centering)
+        if np.size(sigmasq_p) > 1:
+            sigmasq_p = sigmasq_p * scale[subset]**2
+    u_block = (theta_block - loc) / scale
+
+    u_subset = u_block[subset]
     sigma_p = np.sqrt(sigmasq_p)
 
     # Draw momentum variables
     p = np.random.randn(size_subset)*sigma_p
     p_0 = p.copy()
 
+    # With delayed acceptance, trajectories run on a surrogate target using a
+    # truncated template. The exact target is evaluated only for proposals
+    # that pass a first MH stage on the surrogate.
+    if surrogate_template is None:
+        template_hmc = template
+    else:
+        template_hmc = surrogate_template
+
+    # Compute log-target and gradient at the current state together. These are
+    # carried in the workspace for the initial Hamiltonian, the first
+    # leapfrog step of every attempt, and the MH step. They are not kept
+    # across calls: by the next visit to a block, the overlapping blocks of
+    # the other tiling have almost always changed its state.
+    workspace.log_target, workspace.grad = lib.loglik_dloglik_convolve_affine(
+        u=u_subset, y=y[block], region_types=region_types[block],
+        template=template_hmc, mu=mu, sigmasq=sigmasq, subset=subset,
+        u0=u_block, loc=loc, scale=scale, beta=beta, workspace=workspace)
+    loglik_current = workspace.log_target
+    energy_0 = loglik_current + 0.5*np.sum(p_0**2/sigmasq_p)
+
     # Repeat leapfrog process until valid result is obtained
     leapfrog_done = False
+    n_divergent = 0
     eps = np.random.uniform(eps_min, eps_max)
     
     while not leapfrog_done:
-        # Initialize new draw of theta
-        theta_draw = theta_subset.copy()
+        # Initialize new draw of u
+        u_draw = u_subset.copy()
 
-        # Run leapfrog iterations
-        grad = lib.dloglik_convolve(theta=theta_draw, y=y[block],
-                                    region_types=region_types[block],
-                                    template=template, mu=mu, sigmasq=sigmasq,
-                                    theta0=theta_block, subset=subset, log=True)
+        # Run leapfrog iterations from cached gradient at current state
+        grad = workspace.grad
         
         # Start with half step for momentum
         p -= eps*grad / 2.
         
-        # Alternate full steps for position and momentum
+        # Alternate full steps for position and momentum, aborting as soon as
+        # the trajectory diverges
+        diverged = False
         for i in xrange(n_steps):
             # Full step for position
-            theta_draw += eps*p/sigmasq_p
-            # Update gradient
-            grad = lib.dloglik_convolve(theta=theta_draw, y=y[block],
-                                        region_types=region_types[block],
-                                        template=template, mu=mu,
-                                        sigmasq=sigmasq, theta0=theta_block,
-                                        subset=subset, log=True)
+            u_draw += eps*p/sigmasq_p
+            # Update gradient, along with the log-target where needed for
+            # energy checks or the final MH step
+            check_energy = (max_energy_error is not None and
+                            (i + 1) % energy_check_interval == 0)
+            if i == n_steps - 1:
+                loglik_draw, grad = lib.loglik_dloglik_convolve_affine(
+                    u=u_draw, y=y[block], region_types=region_types[block],
+                    template=template_hmc, mu=mu, sigmasq=sigmasq, u0=u_block,
+                    subset=subset, loc=loc, scale=scale, beta=beta,
+                    workspace=workspace)
+            elif check_energy:
+                loglik_draw, grad = lib.loglik_dloglik_convolve_affine(
+                    u=u_draw, y=y[block], region_types=region_types[block],
+                    template=template_hmc, mu=mu, sigmasq=sigmasq, u0=u_block,
+                    subset=subset, loc=loc, scale=scale, beta=beta,
+                    workspace=leapfrog_workspace)
+            else:
+                grad = lib.dloglik_convolve_affine(
+                    u=u_draw, y=y[block], region_types=region_types[block],
+                    template=template_hmc, mu=mu, sigmasq=sigmasq, u0=u_block,
+                    subset=subset, loc=loc, scale=scale, beta=beta,
+                    workspace=leapfrog_workspace)
+            if not np.all(np.isfinite(grad)):
+                diverged = True
+                break
+            
+            # Check error in Hamiltonian at given intervals. Momentum is half
+            # a step ahead, which is fine for catching divergences.
+            if check_energy:
+                energy = loglik_draw + 0.5*np.sum(p**2/sigmasq_p)
+                if not np.abs(energy - energy_0) < max_energy_error:
+                    diverged = True
+                    break
+            
             # Full step for momentum, except at the end of the trajectory
             if i<(n_steps - 1): p -= eps*grad
 
-        # Half step for momentum at the end
-        p -= eps*grad/2.
-
-        if np.min(np.isfinite(theta_draw)):
+        if not diverged:
+            # Half step for momentum at the end
+            p -= eps*grad/2.
             leapfrog_done = True
         else:
             # Restart with smaller step size
+            n_divergent += 1
             eps /= adj
             p[:] = p_0
-            theta_draw[:] = theta_subset
 
     # Reverse momentum at end of trajectory to make the proposal symmetric.
     p = -p
 
-    # Construct complete proposal for theta
-    theta_prop = theta_block.copy()
-    theta_prop[subset] = theta_draw
+    # Construct complete proposal for u, and convert back to theta
+    u_prop = u_block.copy()
+    u_prop[subset] = u_draw
+    theta_prop = loc + scale*u_prop
 
-    # Compute log target and kinetic energy differences
-    log_target_ratio = -lib.loglik_convolve(theta=theta_prop, y=y[block],
-                                            region_types=region_types[block],
-                                            template=template, mu=mu,
-                                            sigmasq=sigmasq, subset=None,
-                                            theta0=theta_prop, log=True)
-    log_target_ratio -= -lib.loglik_convolve(theta=theta_block, y=y[block],
-                                             region_types=region_types[block],
-                                             template=template, mu=mu,
-                                             sigmasq=sigmasq, subset=None,
-                                             theta0=theta_block, log=True)
+    # Compute log target and kinetic energy differences. The log-target at the
+    # proposal comes from the last leapfrog step.
+    log_target_ratio = -loglik_draw
+    log_target_ratio -= -loglik_current
 
     log_kinetic_diff = 0.5*np.sum((p**2 - p_0**2)/sigmasq_p)
 
     # Execute MH step
     log_accept_prob = log_target_ratio - log_kinetic_diff
-    if np.log(np.random.uniform()) < log_accept_prob:
+    passed = np.log(np.random.uniform()) < log_accept_prob
+
+    if passed and surrogate_template is not None:
+        # Second stage of delayed acceptance, correcting the surrogate target
+        # to the exact one
+        log_surrogate_ratio = log_target_ratio
+        log_target_ratio = -lib.loglik_convolve_affine(
+            u=u_prop, y=y[block], region_types=region_types[block],
+            template=template, mu=mu, sigmasq=sigmasq, subset=None,
+            u0=u_prop, loc=loc, scale=scale, beta=beta)
+        log_target_ratio -= -lib.loglik_convolve_affine(
+            u=u_block, y=y[block], region_types=region_types[block],
+            template=template, mu=mu, sigmasq=sigmasq, subset=None,
+            u0=u_block, loc=loc, scale=scale, beta=beta)
+
+        log_accept_prob = log_target_ratio - log_surrogate_ratio
+        passed = np.log(np.random.uniform()) < log_accept_prob
+
+    if passed:
         accept = 1
         ret_val[:end-start] = theta_prop[original]
     else:
@@ -719,18 +1431,23 @@ def rhmc_worker_theta(comm, block_width, start, y, template, theta, mu, sigmasq,
                                                   region_types=region_types[block],
                                                   template=template, mu=mu,
                                                   sigmasq=sigmasq, subset=None,
-                                                  theta0=theta_prop, log=True)
+                                                  theta0=theta_prop, log=True,
+                                                  beta=beta)
         print >> sys.stderr, -lib.loglik_convolve(theta=theta_block, y=y[block],
                                                   region_types=region_types[block],
                                                   template=template, mu=mu,
                                                   sigmasq=sigmasq, subset=None,
-                                                  theta0=theta_block, log=True)
+                                                  theta0=theta_block, log=True,
+                                                  beta=beta)
         print >> sys.stderr, log_kinetic_diff
         print >> sys.stderr, log_target_ratio
         print >> sys.stderr, log_accept_prob, accept
 
-    # Transmit result
-    comm.Send(ret_val, dest=MPIROOT, tag=accept)
+    # Transmit result, packing the number of divergent trajectories into the
+    # tag alongside the acceptance indicator
+    if comm is not None:
+        comm.Send(ret_val, dest=MPIROOT, tag=encode_tag(accept, n_divergent))
+    return accept, n_divergent
 
 def rhmc_worker_beta(comm, block_width, start, y, template, theta, mu, sigmasq,
                      region_types, prop_df=5., eps=0.01, n_steps=100,
@@ -847,6 +1564,29 @@ def rhmc_worker_beta(comm, block_width, start, y, template, theta, mu, sigmasq,
     # Transmit result
     comm.Send(ret_val, dest=MPIROOT, tag=accept)
 
+def stale_precondition(entry, t, mu, sigmasq, interval, tol):
+    '''
+    Check whether a cached preconditioner needs to be recomputed, either
+    because it is at least interval iterations old or because mu or
+    log(sigmasq) for any of the block's regions has moved by more than tol
+    since it was computed.
+    '''
+    sigmasq_p, t_computed, regions, mu_computed, sigmasq_computed = entry
+    if t - t_computed >= interval:
+        return True
+    if np.max(np.abs(mu[regions] - mu_computed)) > tol:
+        return True
+    return np.max(np.abs(np.log(sigmasq[regions]/sigmasq_computed))) > tol
+
+def freeze_precondition_iter(n_burnin):
+    '''
+    First iteration from which preconditioners are frozen: the end of burnin,
+    or after the first iteration if there is no burnin. Until then, workers
+    adapt them and return them to the master with each block; from then on,
+    the master sends each block's frozen preconditioner with it.
+    '''
+    return max(n_burnin, 2)
+
 def worker(comm, rank, n_proc, data, init, cfg):
     '''
     Worker-node process for parallel MCMC sampler.
@@ -882,9 +1622,50 @@ def worker(comm, rank, n_proc, data, init, cfg):
     # Compute needed data properties
     chrom_length = y.size
 
-    # Extract needed initializations for parameters
-    mu = init['mu']
-    sigmasq = init['sigmasq']
+    # Setup tempered replica handled by this worker
+    n_temps = cfg['mcmc_params'].get('n_temperatures', 1)
+    replica = replica_of(rank, n_temps)
+    beta = temperature_ladder(n_temps,
+                              cfg['mcmc_params'].get('max_temperature',
+                                                     10.))[replica]
+
+    # Extract needed initializations for parameters. These are synchronized
+    # with the parameters of this worker's replica.
+    n_regions = init['mu'].size
+    mu = init['mu'].copy()
+    sigmasq = init['sigmasq'].copy()
+
+    # Draw coefficients without reads in their footprint directly?
+    fast_inactive = cfg['estimation_params'].get('fast_inactive', True)
+
+    # Block solver for conditional modes used in preconditioning
+    solver = cfg['estimation_params'].get('solver', 'tnc')
+
+    # Settings for cached Hessian-based preconditioning of HMC
+    n_burnin = cfg['mcmc_params']['n_burnin']
+    precondition = cfg['mcmc_params'].get('precondition', False)
+    precondition_interval = cfg['mcmc_params'].get('precondition_interval', 50)
+    precondition_tol = cfg['mcmc_params'].get('precondition_tol', 0.1)
+    freeze_iter = freeze_precondition_iter(n_burnin)
+
+    # Settings for divergence checks within HMC trajectories
+    max_energy_error = cfg['mcmc_params'].get('max_energy_error', 1000.)
+    energy_check_interval = cfg['mcmc_params'].get('energy_check_interval', 1)
+
+    # Run HMC trajectories on a surrogate with a truncated template, with
+    # delayed acceptance?
+    if cfg['mcmc_params'].get('delayed_acceptance', False):
+        surrogate_template = truncate_template(
+            template, cfg['mcmc_params'].get('surrogate_mass', 0.99))
+    else:
+        surrogate_template = None
+
+    # Parameterization of log-occupancies for HMC, with coverage by region for
+    # adaptive centering
+    parameterization = cfg['mcmc_params'].get('parameterization', 'centered')
+    coverage = np.zeros(n_regions)
+    for r in data['region_ids']:
+        coverage[r] = np.mean(y[data['region_list'][r]])
 
     # Compute block width for parallel MH step
     n_workers = n_proc - 1
@@ -899,10 +1680,36 @@ def worker(comm, rank, n_proc, data, init, cfg):
     # Restrict theta to needed size
     theta = np.empty(theta_buf_size, dtype=np.float)
 
+    # Cache of preconditioners by block start while they are adapted. Each
+    # entry holds the diagonal mass matrix, the iteration it was computed at,
+    # the block's regions, and the (mu, sigmasq) for those regions it was
+    # computed under. Preconditioners are exchanged with the master padded to
+    # block_width.
+    precond_cache = {}
+    precond_buf = np.zeros(block_width, dtype=np.float)
+
+    # Upper limits on HMC step sizes by block start. These are reduced during
+    # burnin for blocks whose trajectories diverge.
+    eps_max_cache = {}
+
+    # Compute HMC trajectories in single precision?
+    leapfrog_dtype = np.dtype(cfg['estimation_params'].get('precision',
+                                                           'float64'))
+
+    # Workspaces by block start, with gathered parameters refreshed after each
+    # synchronization. Single-precision workspaces for trajectories are kept
+    # alongside if requested. At most workspace_cache_size of each are kept,
+    # evicting the least recently used.
+    workspaces = collections.OrderedDict()
+    leapfrog_workspaces = collections.OrderedDict()
+    cache_size = cfg['estimation_params'].get('workspace_cache_size', 1024)
+    params_version = 0
+
     # Prepare to receive tasks
     working = True
     status = MPI.Status()
     start = np.array(0)
+    t = 0
 
     while working:
         # Receive task information
@@ -912,20 +1719,267 @@ def worker(comm, rank, n_proc, data, init, cfg):
         if status.Get_tag() == STOPTAG:
             working = False
         elif status.Get_tag() == SYNCTAG:
+            # Record current iteration
+            t = int(start)
+
             # Synchronize parameters (conditioning information)
-            comm.Bcast(mu, root=MPIROOT)
-            comm.Bcast(sigmasq, root=MPIROOT)
+            comm.Recv(mu, source=MPIROOT, tag=MPI.ANY_TAG)
+            comm.Recv(sigmasq, source=MPIROOT, tag=MPI.ANY_TAG)
+            params_version += 1
         elif status.Get_tag() == WORKTAG:
             # Update value of theta for next job within given outer loop
             comm.Recv(theta, source=MPIROOT, tag=MPI.ANY_TAG)
 
+            # Get workspace for block, refreshing parameters if needed
+            key = int(start)
+            block = slice(max(key-w, 0), min(key+block_width+w, chrom_length))
+            workspace = lib.cached(
+                workspaces, key,
+                lambda: lib.BlockWorkspace(y[block], region_types[block]),
+                cache_size)
+            if workspace.version != params_version:
+                workspace.set_params(mu, sigmasq, params_version)
+
+            leapfrog_workspace = None
+            if leapfrog_dtype != np.float64:
+                leapfrog_workspace = lib.cached(
+                    leapfrog_workspaces, key,
+                    lambda: lib.BlockWorkspace(y[block], region_types[block],
+                                               dtype=leapfrog_dtype),
+                    cache_size)
+                if leapfrog_workspace.version != params_version:
+                    leapfrog_workspace.set_params(mu, sigmasq, params_version)
+
+            # Setup mass matrix for HMC. After burnin, the block's frozen
+            # preconditioner comes from the master, so it does not depend on
+            # which worker the block is sent to.
+            if precondition and t >= freeze_iter:
+                comm.Recv(precond_buf, source=MPIROOT, tag=MPI.ANY_TAG)
+                end = min(key+block_width, chrom_length)
+                size_subset = (end - w*(end != chrom_length) -
+                               (key + w*(key != 0)))
+                sigmasq_p = precond_buf[:size_subset].copy()
+            elif precondition:
+                if key not in precond_cache or stale_precondition(
+                        precond_cache[key], t, mu, sigmasq,
+                        precondition_interval, precondition_tol):
+                    sigmasq_p = precondition_theta(
+                        start=key, block_width=block_width, y=y,
+                        template=template, theta=theta, mu=mu,
+                        sigmasq=sigmasq, region_types=region_types,
+                        beta=beta, solver=solver)[1]
+                    regions = np.unique(region_types[block])
+                    precond_cache[key] = (sigmasq_p, t, regions, mu[regions],
+                                          sigmasq[regions])
+                sigmasq_p = precond_cache[key][0]
+            else:
+                sigmasq_p = np.ones(1)
+
+            # Setup centering weights by region from current parameters
+            if parameterization == 'centered':
+                centering = None
+            else:
+                centering = centering_weights(parameterization, coverage,
+                                              sigmasq, template)
+
             # Execute HMC step, including sending result
-            rhmc_worker_theta(comm=comm, block_width=block_width, start=start,
-                              y=y, template=template, theta=theta, mu=mu,
-                              sigmasq=sigmasq, region_types=region_types,
-                              sigmasq_p=np.ones(1))
+            eps_max = eps_max_cache.get(int(start), EPS_MAX)
+            accept, n_divergent = rhmc_worker_theta(
+                comm=comm, block_width=block_width, start=start, y=y,
+                template=template, theta=theta, mu=mu, sigmasq=sigmasq,
+                region_types=region_types, sigmasq_p=sigmasq_p,
+                eps_max=eps_max, eps_min=EPS_MIN,
+                fast_inactive=fast_inactive,
+                max_energy_error=max_energy_error,
+                energy_check_interval=energy_check_interval, beta=beta,
+                centering=centering, surrogate_template=surrogate_template,
+                workspace=workspace, leapfrog_workspace=leapfrog_workspace)
+
+            # Return the block's preconditioner while they are adapted
+            if precondition and t < freeze_iter:
+                precond_buf[:sigmasq_p.size] = sigmasq_p
+                comm.Send(precond_buf, dest=MPIROOT, tag=MPIROOT)
+
+            # Shrink range of step sizes for blocks that diverge during burnin
+            if n_divergent > 0 and t < n_burnin:
+                eps_max_cache[int(start)] = max(eps_max / 2., 2.*EPS_MIN)
+
+def validate_precision(cfg, chrom=1, null=False, dtype='float32',
+                       n_sweeps=100, seed=0, accept_tol=0.05, summary_tol=0.5):
+    '''
+    Check HMC with reduced-precision trajectories against double precision on
+    a reference chromosome.
+
+    Runs the same serial Gibbs sampler (HMC block updates over both tilings
+    followed by draws of (mu, sigmasq)) twice from the same initialization and
+    random seed: once entirely in double precision and once with trajectories
+    computed in dtype. The first half of each run is discarded as burnin.
+
+    Parameters
+    ----------
+        - cfg : dictionary
+            Dictionary containing (at least) prior, estimation_params, and
+            mcmc_params sections with appropriate entries.
+        - chrom : int
+            Index (starting from 1) of chromosome to extract.
+        - null : bool
+            If null, use null reads instead of actual.
+        - dtype : str or numpy dtype
+            Precision of trajectories to check.
+        - n_sweeps : int
+            Number of Gibbs sweeps for each run.
+        - seed : int
+            Seed for numpy's random number generator before each run.
+        - accept_tol : float
+            Largest allowed difference in HMC acceptance rates.
+        - summary_tol : float
+            Largest allowed difference in posterior means, in units of the
+            double-precision posterior standard deviation.
+
+    Returns
+    -------
+        Dictionary containing
+        - accept : ndarray
+            HMC acceptance rates in double precision and dtype.
+        - theta_mean : ndarray
+            Posterior means of log-occupancies, one row per run.
+        - mu_mean : ndarray
+            Posterior means of mu, one row per run.
+        - sigmasq_mean : ndarray
+            Posterior means of sigmasq, one row per run.
+        - theta_error : float
+            Mean standardized absolute difference in posterior means of
+            log-occupancies.
+        - param_error : float
+            Largest standardized absolute difference in posterior means of
+            (mu, sigmasq).
+        - passed : bool
+            True if all differences are within tolerance.
+    '''
+    # Create references to frequently-accessed config information
+    mu0 = cfg['prior']['mu0']
+    k0 = cfg['prior']['k0']
+    a0 = cfg['prior']['a0']
+    b0 = cfg['prior']['b0']
+    fast_inactive = cfg['estimation_params'].get('fast_inactive', True)
+    max_energy_error = cfg['mcmc_params'].get('max_energy_error', 1000.)
+    energy_check_interval = cfg['mcmc_params'].get('energy_check_interval', 1)
+
+    # Load data and create references in local scope
+    data = load_data(chrom=chrom, cfg=cfg, null=null)
+    y = data['y']
+    template = data['template']
+    region_types = data['region_types']
+    region_list = data['region_list']
+    region_sizes = data['region_sizes']
+    region_ids = data['region_ids']
+    w = template.size/2 + 1
+
+    # Compute needed data properties
+    chrom_length = y.size
+    n_regions = region_ids.max() + 1
+    if cfg['estimation_params']['block_width'] is None:
+        block_width = chrom_length
+    else:
+        block_width = cfg['estimation_params']['block_width']
+
+    # Setup prior means as in master
+    prior_mean = np.zeros(n_regions)
+    if mu0 is None:
+        coverage = np.zeros(n_regions)
+        for r in region_ids:
+            coverage[r] = np.mean(y[region_list[r]])
+        prior_mean[coverage>0] = (np.log(coverage[coverage>0]) -
+                                  b0 / a0 / 2.0)
+    else:
+        prior_mean += mu0
+
+    # Setup the same two tilings as master
+    tilings = [np.arange(0, chrom_length, block_width, dtype=np.int),
+               np.arange(block_width/2, chrom_length, block_width,
+                         dtype=np.int)]
+    for c in xrange(len(tilings)):
+        block_sizes = (np.minimum(tilings[c] + block_width, chrom_length) -
+                       tilings[c])
+        tilings[c] = tilings[c][block_sizes > w]
+
+    n_keep = n_sweeps - n_sweeps/2
+    accept = np.zeros(2)
+    theta_draws = np.empty((2, n_keep, chrom_length))
+    mu_draws = np.empty((2, n_keep, n_regions))
+    sigmasq_draws = np.empty((2, n_keep, n_regions))
+    ret_val = np.empty(block_width)
+
+    for run_index, leapfrog_dtype in enumerate((np.float64, dtype)):
+        np.random.seed(seed)
+        init = initialize(data=data, cfg=cfg, rank=MPIROOT, null=null)
+        theta = init['theta'].copy()
+        mu = init['mu'].copy()
+        sigmasq = init['sigmasq'].copy()
+
+        workspaces = {}
+        leapfrog_workspaces = {}
+        n_accepted = 0
+        n_blocks = 0
+        for t in xrange(n_sweeps):
+            for start in np.concatenate(tilings):
+                end = min(chrom_length, start + block_width)
+                block = slice(max(start-w, 0), min(end+w, chrom_length))
+
+                if start not in workspaces:
+                    workspaces[start] = lib.BlockWorkspace(
+                        y[block], region_types[block])
+                    leapfrog_workspaces[start] = lib.BlockWorkspace(
+                        y[block], region_types[block], dtype=leapfrog_dtype)
+                workspaces[start].set_params(mu, sigmasq, t)
+                leapfrog_workspaces[start].set_params(mu, sigmasq, t)
+
+                n_accepted += rhmc_worker_theta(
+                    comm=None, block_width=block_width, start=start, y=y,
+                    template=template, theta=theta[block], mu=mu,
+                    sigmasq=sigmasq, region_types=region_types,
+                    sigmasq_p=np.ones(1), fast_inactive=fast_inactive,
+                    max_energy_error=max_energy_error,
+                    energy_check_interval=energy_check_interval,
+                    workspace=workspaces[start],
+                    leapfrog_workspace=leapfrog_workspaces[start],
+                    out=ret_val)[0]
+                n_blocks += 1
+                theta[start:end] = ret_val[:end-start]
+
+            # Region-level draws are always in double precision
+            draw_region_params(theta, mu, sigmasq, region_ids, region_list,
+                               region_sizes, prior_mean, a0, b0, k0)
+
+            if t >= n_sweeps - n_keep:
+                theta_draws[run_index, t - n_sweeps + n_keep] = theta
+                mu_draws[run_index, t - n_sweeps + n_keep] = mu
+                sigmasq_draws[run_index, t - n_sweeps + n_keep] = sigmasq
+        accept[run_index] = n_accepted / float(n_blocks)
+
+    # Compare posterior means, standardized by double-precision posterior
+    # standard deviations
+    def standardized_error(draws):
+        sd = np.maximum(np.std(draws[0], 0), lib.SQRT_EPS)
+        return np.abs(np.mean(draws[1], 0) - np.mean(draws[0], 0)) / sd
+
+    theta_error = np.mean(standardized_error(theta_draws))
+    param_error = max(np.max(standardized_error(mu_draws[:,:,region_ids])),
+                      np.max(standardized_error(
+                          sigmasq_draws[:,:,region_ids])))
+    passed = (np.abs(accept[1] - accept[0]) <= accept_tol and
+              theta_error <= summary_tol and param_error <= summary_tol)
+
+    out = {'accept' : accept,
+           'theta_mean' : np.mean(theta_draws, 1),
+           'mu_mean' : np.mean(mu_draws, 1),
+           'sigmasq_mean' : np.mean(sigmasq_draws, 1),
+           'theta_error' : theta_error,
+           'param_error' : param_error,
+           'passed' : passed}
+    return out
 
-def run(cfg, comm=None, chrom=1, null=False):
+def run(cfg, comm=None, chrom=1, null=False, data=None):
     '''
     Coordinate parallel estimation based upon process rank.
 
@@ -941,6 +1995,9 @@ def run(cfg, comm=None, chrom=1, null=False):
             Index (starting from 1) of chromosome to extract.
         - null : bool
             If null, use null reads instead of actual.
+        - data : dictionary
+            Data as output from load_data, if already loaded for chrom and
+            null.
 
     Returns
     -------
@@ -954,8 +2011,15 @@ def run(cfg, comm=None, chrom=1, null=False):
     rank = comm.Get_rank()
     n_proc = comm.Get_size()
 
-    # Load data
-    data = load_data(chrom=chrom, cfg=cfg, null=null)
+    # Check that each tempered replica has at least one worker
+    n_temps = cfg['mcmc_params'].get('n_temperatures', 1)
+    if n_proc - 1 < n_temps:
+        raise ValueError('Need at least %d workers for %d temperatures' %
+                         (n_temps, n_temps))
+
+    # Load data, if needed
+    if data is None:
+        data = load_data(chrom=chrom, cfg=cfg, null=null)
 
     # Run global initialization
     init = initialize(data=data, cfg=cfg, rank=rank, null=null)
@@ -1042,7 +2106,14 @@ def pickle_results(results, cfg, chrom=1, null=False):
     with contextlib.closing(bz2.BZ2File(out_path, mode='wb')) as f:
         cPickle.dump(results, f, protocol=-1)
 
-def save_results(results, cfg, chrom=1, null=False):
+def save_results(results, data, cfg, chrom=1, null=False, method='mcmc'):
+    '''
+    Write draws to a tarball of arrays, with a manifest recording data (as
+    output from load_data) for warm starts. method labels the run in the
+    manifest: 'mcmc', or 'laplace' or 'vb' for draws in the same format. The
+    number of burnin draws for summaries is stored as n_burnin; it is zero
+    for methods other than MCMC.
+    '''
     if null:
         out_pattern = cfg['mcmc_output']['null_out_pattern']
     else:
@@ -1054,8 +2125,17 @@ def save_results(results, cfg, chrom=1, null=False):
     # Use a chromosome-specific scratch directory.
     scratch_dir = os.path.join(cfg['mcmc_params']['path_scratch'],
                                str(chrom))
+    if method == 'mcmc':
+        n_burnin = cfg['mcmc_params']['n_burnin']
+    else:
+        n_burnin = 0
     libio.write_arrays_to_tarball(fname=out_path,
                                   compress='',
                                   scratch=scratch_dir,
+                                  n_burnin=np.array(n_burnin),
                                   **results)
 
+    # Record inputs and final chain state for warm starts of later runs
+    lib_warm_start.write_manifest(out_path + '.manifest', method, data, cfg,
+                                  null, {'draws' : out_path})
+
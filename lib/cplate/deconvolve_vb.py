@@ -0,0 +1,534 @@
+import sys
+import time
+
+import numpy as np
+from mpi4py import MPI
+
+import lib_deconvolve_em as lib
+import deconvolve_em
+
+# Set constants
+
+# MPI constants
+MPIROOT     = 0
+# Tags for worker states
+STOPTAG     = 0
+SYNCTAG     = 1
+WORKTAG     = 2
+
+# Constants for Adam updates
+ADAM_BETA1  = 0.9
+ADAM_BETA2  = 0.999
+ADAM_EPS    = 1e-8
+
+def initialize(data, cfg, rank=None, null=False):
+    '''
+    Initialize variational parameters across all nodes.
+
+    Parameters
+    ----------
+        - data : dictionary
+            Data as output from deconvolve_em.load_data.
+        - cfg : dictionary
+            Dictionary containing (at least) prior and estimation_params
+            sections with appropriate entries.
+        - rank : int
+            If not None, rank of node to print in diagnostic output.
+        - null : bool
+            If null, warm starts use previous runs on null reads.
+
+    Returns
+    -------
+        Dictionary of initial parameters containing
+        - m : ndarray
+            Starting values for variational means of log-occupancies.
+        - s : ndarray
+            Starting values for variational standard deviations of
+            log-occupancies.
+        - mu : ndarray
+            Starting values for log-mean (mu) parameters.
+        - sigmasq : ndarray
+            Starting values for log-variance (sigmasq) parameters.
+    '''
+    init = deconvolve_em.initialize(data=data, cfg=cfg, rank=rank, null=null)
+
+    # Start from log of EM initialization with a fraction of the prior scale
+    m = np.log(init['theta'])
+    s = np.sqrt(init['sigmasq'][data['region_types']]) / 10.
+
+    init = {'m' : m,
+            's' : s,
+            'mu' : init['mu'],
+            'sigmasq' : init['sigmasq']}
+    return init
+
+def master(comm, n_proc, data, init, cfg):
+    '''
+    Master node process for parallel stochastic variational inference.
+    Coordinates block updates of a mean-field Gaussian approximation to the
+    posterior of log-occupancies, and runs closed-form updates of (mu,
+    sigmasq) between sweeps.
+
+    Parameters
+    ----------
+        - comm : mpi4py.MPI.COMM
+            Initialized MPI communicator.
+        - n_proc : int
+            Number of processes in communicator.
+        - data : dictionary
+            Data as output from deconvolve_em.load_data.
+        - init : dictionary
+            Initial parameter values as output from initialize.
+        - cfg : dictionary
+            Dictionary containing (at least) prior, estimation_params, and
+            mcmc_params sections with appropriate entries. Settings are read
+            from an optional vb_params section.
+
+    Returns
+    -------
+        Dictionary of results in the same format as deconvolve_mcmc.master
+        containing:
+        - theta : ndarray
+            Draws of log-occupancies from the variational approximation, one
+            row per draw. Written with deconvolve_mcmc.save_results, no burnin
+            is removed from them.
+        - mu : ndarray
+            Estimates of log-mean (mu) parameters, repeated for each draw.
+        - sigmasq : ndarray
+            Estimates of log-variance (sigmasq) parameters, repeated for each
+            draw.
+        - region_ids : integer ndarray
+            Vector of distinct region ids.
+        - m : ndarray
+            Variational means of log-occupancies.
+        - s : ndarray
+            Variational standard deviations of log-occupancies.
+    '''
+    # Create references to frequently-accessed config information
+    # Prior on mu - sigmasq / 2
+    mu0 = cfg['prior']['mu0']
+    k0  = cfg['prior']['k0']
+    # Prior on 1 / sigmasq
+    a0  = cfg['prior']['a0']
+    b0  = cfg['prior']['b0']
+    # Settings for variational iterations
+    vb_params = cfg.get('vb_params', {}) or {}
+    tol = float(vb_params.get('tol', 1e-3))
+    min_iter = vb_params.get('min_iter', 10)
+    max_iter = vb_params.get('max_iter', 200)
+    n_draws = vb_params.get('n_draws', 1000)
+    # Verbosity
+    verbose = cfg['estimation_params']['verbose']
+    timing = cfg['estimation_params']['timing']
+    # Debugging flags to fix hyperparameters
+    fix_mu = cfg['estimation_params']['fix_mu']
+    fix_sigmasq = cfg['estimation_params']['fix_sigmasq']
+
+    # Compute derived quantities from config information
+    sigmasq0 = b0 / a0
+    adapt_prior = (mu0 is None)
+
+    # Create references to relevant data entries in local scope
+    y           = data['y']
+    template    = data['template']
+    region_types = data['region_types']
+    region_list  = data['region_list']
+    region_sizes = data['region_sizes']
+    region_ids   = data['region_ids']
+    w = template.size/2 + 1
+
+    # Compute needed data properties
+    chrom_length = y.size
+    n_regions = region_ids.size
+
+    # Reference initialized quantities in local scope
+    m       = init['m']
+    s       = init['s']
+    mu      = init['mu']
+    sigmasq = init['sigmasq']
+
+    # Compute block width for parallel updates
+    n_workers = n_proc - 1
+    if cfg['estimation_params']['block_width'] is None:
+        block_width = chrom_length / n_workers
+    else:
+        block_width = cfg['estimation_params']['block_width']
+
+    # Setup prior means
+    prior_mean = np.zeros(n_regions)
+    if adapt_prior:
+        # Adapt prior means if requested
+        # Get coverage by region
+        coverage = np.zeros(n_regions)
+        for i in region_ids:
+            coverage[i] = np.mean(y[region_list[i]])
+
+        # Translate to prior means
+        prior_mean[coverage>0] = np.log(coverage[coverage>0]) - sigmasq0 / 2.0
+    else:
+         prior_mean += mu0
+
+    # Setup blocks for worker nodes, using the same 2-iteration scan as EM
+    start_vec = [np.arange(0, chrom_length, block_width, dtype=np.int),
+                 np.arange(block_width/2, chrom_length, block_width,
+                           dtype=np.int)]
+    start_vec = np.concatenate(start_vec)
+
+    # Setup buffers for sending means and standard deviations by block,
+    # including buffers, and receiving them for the block itself
+    buf_size = block_width + 2*w
+    send_buf = np.empty(2*buf_size, dtype=np.float)
+    ret_val = np.empty(2*block_width, dtype=np.float)
+    assigned = np.zeros(n_workers, dtype=np.int)
+    status = MPI.Status()
+    params = np.array([mu, sigmasq])
+
+    iter = 0
+    converged = False
+
+    while iter < max_iter and (not converged or iter < min_iter):
+        if verbose and timing: tme = time.clock()
+        m_previous = m.copy()
+
+        # Synchronize parameters across all workers, passing the iteration
+        # to set the step size schedule
+        for k in range(1, n_workers+1):
+            comm.send((iter, None), dest=k, tag=SYNCTAG)
+        params[0], params[1] = (mu, sigmasq)
+        comm.Bcast(params, root=MPIROOT)
+
+        # Dispatch jobs to workers until completed
+        n_jobs       = start_vec.size
+        n_started    = 0
+        n_completed  = 0
+
+        # Randomize block ordering
+        np.random.shuffle(start_vec)
+
+        # Send first batch of jobs
+        for k in range(1, min(n_workers, start_vec.size)+1):
+            send_block(comm, k, start_vec[n_started], m, s, block_width, w,
+                       send_buf)
+            assigned[k-1] = start_vec[n_started]
+            n_started += 1
+
+        # Collect results from workers and dispatch additional jobs until
+        # complete
+        while n_completed < n_jobs:
+            comm.Recv(ret_val, source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG,
+                      status=status)
+            n_completed += 1
+            worker = status.Get_source()
+            start = assigned[worker-1]
+            end = min(start+block_width, chrom_length)
+            m[start:end] = ret_val[:end-start]
+            s[start:end] = ret_val[block_width:block_width+end-start]
+
+            if n_started < n_jobs:
+                send_block(comm, worker, start_vec[n_started], m, s,
+                           block_width, w, send_buf)
+                assigned[worker-1] = start_vec[n_started]
+                n_started += 1
+
+        # Closed-form updates of (mu, sigmasq), as in the EM M-step with the
+        # variational variances in place of var(theta | params)
+        for r in region_ids:
+            region = region_list[r]
+            if not fix_mu:
+                mu[r] = np.mean(m[region]) + prior_mean[r]*k0
+                mu[r] /= 1.0 + k0
+
+            if not fix_sigmasq:
+                sigmasq[r] = np.mean( (m[region]-mu[r])**2 )
+                sigmasq[r] += np.mean( s[region]**2 )
+                sigmasq[r] += k0*(mu[r]-prior_mean[r])**2
+                sigmasq[r] += 2.*b0/region_sizes[r]
+                sigmasq[r] /= (1 + 3./region_sizes[r] +
+                               2.*a0/region_sizes[r])
+
+        iter += 1
+        delta = lib.l2_error(m, m_previous)
+        converged = (delta < tol)
+
+        if verbose:
+            if timing: print >> sys.stderr, ( "%d:\tIteration time: %s" %
+                                              (iter, time.clock() - tme) )
+            print iter
+            print delta
+            if verbose > 1: print mu, sigmasq
+
+    # Halt all workers
+    for k in range(1,n_proc):
+        comm.send((None,None), dest=k, tag=STOPTAG)
+
+    # Draw from variational approximation
+    theta = np.empty((n_draws, chrom_length))
+    for i in xrange(n_draws):
+        theta[i] = m + s*np.random.randn(chrom_length)
+
+    # Return results
+    out = {'theta' : theta,
+           'mu' : np.tile(mu, (n_draws, 1)),
+           'sigmasq' : np.tile(sigmasq, (n_draws, 1)),
+           'region_ids' : region_ids,
+           'm' : m,
+           's' : s}
+    return out
+
+def send_block(comm, worker, start, m, s, block_width, w, send_buf):
+    '''
+    Send block start and corresponding slices of variational means and
+    standard deviations, including buffers of width w, to worker.
+    '''
+    chrom_length = m.size
+    buf_size = send_buf.size/2
+
+    end = min(chrom_length, start + block_width)
+    block = slice(max(start - w, 0), min(end+w, chrom_length))
+    size_block = block.stop - block.start
+    send_buf[:size_block] = m[block]
+    send_buf[buf_size:buf_size+size_block] = s[block]
+
+    comm.send((start, None), dest=worker, tag=WORKTAG)
+    comm.Send(send_buf, dest=worker, tag=MPIROOT)
+
+def svi_block(start, block_width, y, template, region_types, m, s, mu,
+              sigmasq, n_inner=50, n_samples=1, learning_rate=0.05):
+    '''
+    Stochastic optimization of the ELBO for a block of log-occupancies under
+    a mean-field Gaussian approximation, using reparameterized gradients from
+    dloglik_convolve and Adam updates. Buffers on either side of the block are
+    held at their current variational distributions.
+
+    Parameters
+    ----------
+        - start : int
+            Start of block.
+        - block_width : int
+            Width of blocks.
+        - y : ndarray
+            Counts of read centers per base pair for the full chromosome.
+        - template : ndarray
+            Vector containing coefficients for template.
+        - region_types : integer ndarray
+            Vector of region types by base pair for the full chromosome.
+        - m : ndarray
+            Variational means for the block, including buffers.
+        - s : ndarray
+            Variational standard deviations for the block, including buffers.
+        - mu : ndarray
+            Current log-mean (mu) parameters.
+        - sigmasq : ndarray
+            Current log-variance (sigmasq) parameters.
+        - n_inner : int
+            Number of stochastic gradient steps.
+        - n_samples : int
+            Number of Monte Carlo samples per gradient estimate.
+        - learning_rate : float
+            Step size for Adam updates.
+
+    Returns
+    -------
+        - m : ndarray
+            Updated variational means for the block's original positions.
+        - s : ndarray
+            Updated variational standard deviations for the block's original
+            positions.
+    '''
+    # Compute needed data properties
+    chrom_length = y.size
+    w = template.size/2 + 1
+
+    # Calculate subset of data to work on
+    end = min(chrom_length, start + block_width)
+    block = slice(max(start-w, 0), min(end+w, chrom_length))
+    size_block = block.stop - block.start
+
+    subset = slice(w*(start!=0)+start-block.start,
+                   size_block-w*(end!=chrom_length) - (block.stop-end))
+    size_subset = subset.stop - subset.start
+
+    original = slice(start-block.start, size_block - (block.stop-end))
+
+    m_block = m[:size_block].copy()
+    s_block = s[:size_block].copy()
+
+    # Optimize over means and log-standard deviations
+    log_s = np.log(s_block[subset])
+
+    # Adam moment estimates
+    moment1 = np.zeros((2, size_subset))
+    moment2 = np.zeros((2, size_subset))
+    grad = np.empty((2, size_subset))
+
+    for i in xrange(n_inner):
+        grad[:] = 0.
+        for j in xrange(n_samples):
+            eps = np.random.randn(size_block)
+            theta = m_block + s_block*eps
+            dtheta = lib.dloglik_convolve(theta=theta[subset], y=y[block],
+                                          region_types=region_types[block],
+                                          template=template, subset=subset,
+                                          theta0=theta, mu=mu,
+                                          sigmasq=sigmasq, log=True)
+            grad[0] += dtheta
+            grad[1] += dtheta*eps[subset]*s_block[subset]
+        grad /= n_samples
+        # Entropy term of negative ELBO
+        grad[1] -= 1.
+
+        # Adam update
+        moment1 = ADAM_BETA1*moment1 + (1. - ADAM_BETA1)*grad
+        moment2 = ADAM_BETA2*moment2 + (1. - ADAM_BETA2)*grad**2
+        step = (learning_rate * np.sqrt(1. - ADAM_BETA2**(i+1)) /
+                (1. - ADAM_BETA1**(i+1)))
+        update = step * moment1 / (np.sqrt(moment2) + ADAM_EPS)
+
+        m_block[subset] -= update[0]
+        log_s -= update[1]
+        s_block[subset] = np.exp(log_s)
+
+    return m_block[original], s_block[original]
+
+def worker(comm, rank, n_proc, data, init, cfg):
+    '''
+    Worker-node process for parallel stochastic variational inference.
+    Receives parameters and commands from master node, sends updated
+    variational parameters.
+
+    Parameters
+    ----------
+        - comm : mpi4py.MPI.COMM
+            Initialized MPI communicator.
+        - rank : int
+            Rank (>= MPIROOT) of worker.
+        - n_proc : int
+            Number of processes in communicator.
+        - data : dictionary
+            Data as output from deconvolve_em.load_data.
+        - init : dictionary
+            Initial parameter values as output from initialize.
+        - cfg : dictionary
+            Dictionary containing (at least) prior and estimation_params
+            sections with appropriate entries.
+
+    Returns
+    -------
+        None.
+    '''
+    # Create references to relevant data entries in local namespace
+    y           = data['y']
+    template    = data['template']
+    region_types = data['region_types']
+
+    # Compute needed data properties
+    chrom_length = y.size
+    w = template.size/2 + 1
+
+    # Extract needed initializations for parameters
+    mu      = init['mu']
+    sigmasq = init['sigmasq']
+    params  = np.array([mu, sigmasq])
+
+    # Settings for stochastic optimization
+    vb_params = cfg.get('vb_params', {}) or {}
+    n_inner = vb_params.get('n_inner', 50)
+    n_samples = vb_params.get('n_samples', 1)
+    learning_rate = vb_params.get('learning_rate', 0.05)
+    decay = vb_params.get('decay', 0.5)
+
+    # Compute block width for parallel updates
+    n_workers = n_proc - 1
+    if cfg['estimation_params']['block_width'] is None:
+        block_width = chrom_length / n_workers
+    else:
+        block_width = cfg['estimation_params']['block_width']
+
+    # Setup buffers for receiving and returning variational parameters
+    buf_size = block_width + 2*w
+    recv_buf = np.empty(2*buf_size, dtype=np.float)
+    ret_val = np.zeros(2*block_width, dtype=np.float)
+
+    # Prepare to receive tasks
+    working = True
+    status = MPI.Status()
+    step_size = learning_rate
+    while working:
+        # Receive task information
+        start, _ = comm.recv(source=MPIROOT, tag=MPI.ANY_TAG, status=status)
+
+        if status.Get_tag() == STOPTAG:
+            working = False
+        elif status.Get_tag() == SYNCTAG:
+            # Decay step size with outer iterations
+            step_size = learning_rate / (1. + start)**decay
+
+            # Synchronize parameters (conditioning information)
+            comm.Bcast(params, root=MPIROOT)
+            mu, sigmasq = params
+        elif status.Get_tag() == WORKTAG:
+            comm.Recv(recv_buf, source=MPIROOT, tag=MPI.ANY_TAG)
+            end = min(chrom_length, start + block_width)
+
+            m_new, s_new = svi_block(start=start, block_width=block_width,
+                                     y=y, template=template,
+                                     region_types=region_types,
+                                     m=recv_buf[:buf_size],
+                                     s=recv_buf[buf_size:],
+                                     mu=mu, sigmasq=sigmasq,
+                                     n_inner=n_inner, n_samples=n_samples,
+                                     learning_rate=step_size)
+            ret_val[:end-start] = m_new
+            ret_val[block_width:block_width+end-start] = s_new
+
+            # Transmit result
+            comm.Send(ret_val, dest=MPIROOT, tag=WORKTAG)
+
+def run(cfg, comm=None, chrom=1, null=False, data=None):
+    '''
+    Coordinate parallel estimation based upon process rank.
+
+    Parameters
+    ----------
+        - cfg : dictionary
+            Dictionary containing (at least) prior and estimation_params
+            sections with appropriate entries.
+        - comm : mpi4py.MPI.COMM
+            Initialized MPI communicator. If None, it will be set to
+            MPI.COMM_WORLD.
+        - chrom : int
+            Index (starting from 1) of chromosome to extract.
+        - null : bool
+            If null, use null reads instead of actual.
+        - data : dictionary
+            Data as output from deconvolve_em.load_data, if already loaded
+            for chrom and null.
+
+    Returns
+    -------
+        For master process, dictionary from master() function. Else, None.
+    '''
+    if comm is None:
+        # Start MPI communications if no comm provided
+        comm = MPI.COMM_WORLD
+
+    # Get process information
+    rank = comm.Get_rank()
+    n_proc = comm.Get_size()
+
+    # Load data, if needed
+    if data is None:
+        data = deconvolve_em.load_data(chrom=chrom, cfg=cfg, null=null)
+
+    # Run global initialization
+    init = initialize(data=data, cfg=cfg, rank=rank, null=null)
+
+    if rank == MPIROOT:
+        # Run estimation
+        results = master(comm=comm, n_proc=n_proc, data=data, init=init,
+                         cfg=cfg)
+        return results
+    else:
+        worker(comm=comm, rank=rank, n_proc=n_proc, data=data, init=init,
+               cfg=cfg)
+        return
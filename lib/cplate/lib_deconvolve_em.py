@@ -1,12 +1,36 @@
 # Load libraries
+import sys
+import collections
+
 import numpy as np
-from scipy import optimize, sparse
+from scipy import optimize, sparse, special
 from scipy.sparse import sparsetools
 
 # Define constants
 EPS = np.spacing(1)
 SQRT_EPS = np.sqrt(EPS)
 
+# Convolution engine settings. Direct convolution is used for short templates
+# or small problems, a single FFT for inputs up to FFT_MAX_RATIO template
+# lengths, and overlap-add with segments of OLA_RATIO template lengths beyond.
+DIRECT_MAX_TAPS = 128
+DIRECT_MAX_WORK = 2**19
+FFT_MAX_RATIO = 16
+OLA_RATIO = 4
+
+# Caches of convolution plans by (input length, template length) and of
+# template transforms by (template, transform length). Caches by template are
+# keyed by its identity and bounded to TEMPLATE_CACHE_SIZE entries.
+TEMPLATE_CACHE_SIZE = 32
+_convolve_plans = {}
+_template_transforms = collections.OrderedDict()
+_template_casts = collections.OrderedDict()
+
+# Maximum fraction of nonzero counts in a block for which the sparse-count
+# kernels are used, and cache of template mass by (template, block length)
+SPARSE_MAX_DENSITY = 0.1
+_template_masses = collections.OrderedDict()
+
 # Define functions
 def csr_scale_rows(A, x):
     sparsetools.csr_scale_rows(A.shape[0], A.shape[1],
@@ -17,6 +41,206 @@ def csr_scale_columns(A, x):
                                   A.indptr, A.indices, A.data,
                                   x)
 
+def convolve_plan(n, m):
+    '''
+    Choose method ('direct', 'fft', or 'ola') and transform length for the
+    full convolution of a length-n input with a length-m template. Plans are
+    cached by (n, m).
+    '''
+    key = (n, m)
+    if key not in _convolve_plans:
+        if m <= DIRECT_MAX_TAPS or n*m <= DIRECT_MAX_WORK:
+            plan = ('direct', 0)
+        elif n <= FFT_MAX_RATIO*m:
+            plan = ('fft', 2**int(np.ceil(np.log2(n + m - 1))))
+        else:
+            plan = ('ola', 2**int(np.ceil(np.log2(OLA_RATIO*m))))
+        _convolve_plans[key] = plan
+    return _convolve_plans[key]
+
+def template_cached(cache, template, key, factory):
+    '''
+    Entry for (template, key) in cache, created by factory() if missing.
+    Entries are keyed by id(template) and hold a reference to it, so the id
+    cannot be reused by another array while the entry is cached. Templates are
+    assumed not to be modified in place.
+    '''
+    return cached(cache, (id(template),) + key,
+                  lambda: (template, factory()), TEMPLATE_CACHE_SIZE)[1]
+
+def cast_template(template, dtype):
+    '''
+    Template in the given dtype, cached so that repeated casts return the same
+    array and hit the caches keyed by template.
+    '''
+    if template.dtype == dtype:
+        return template
+    return template_cached(_template_casts, template, (np.dtype(dtype),),
+                           lambda: template.astype(dtype))
+
+def template_transform(template, nfft):
+    '''
+    Real FFT of template zero-padded to length nfft, cached by template and
+    nfft.
+    '''
+    return template_cached(_template_transforms, template, (nfft,),
+                           lambda: np.fft.rfft(template, nfft))
+
+def convolve_full(x, template):
+    '''
+    Full convolution of x with template, equivalent to np.convolve(x, template)
+    but using FFTs or overlap-add for large problems.
+    '''
+    n = x.size
+    m = template.size
+    method, nfft = convolve_plan(n, m)
+    if method == 'direct':
+        return np.convolve(x, template)
+    
+    H = template_transform(template, nfft)
+    if method == 'fft':
+        return np.fft.irfft(np.fft.rfft(x, nfft) * H, nfft)[:n + m - 1]
+    
+    # Overlap-add: transform all segments at once, then add the tail of each
+    # segment's output onto the start of the next
+    seg = nfft - m + 1
+    n_seg = (n + seg - 1) // seg
+    x_seg = np.zeros(n_seg*seg)
+    x_seg[:n] = x
+    out_seg = np.fft.irfft(np.fft.rfft(x_seg.reshape(n_seg, seg), nfft, axis=1)
+                           * H, nfft, axis=1)
+    
+    out = np.zeros(n_seg*seg + m - 1)
+    out[:n_seg*seg] = out_seg[:,:seg].ravel()
+    tail = np.zeros((n_seg, seg))
+    tail[:,:m-1] = out_seg[:,seg:]
+    out[seg:] += tail.ravel()[:out.size - seg]
+    return out[:n + m - 1]
+
+def convolve_same(x, template, valid=slice(None)):
+    '''
+    Equivalent to np.convolve(x, template, mode='same')[valid] for
+    x.size >= template.size, computing only the entries in the slice valid.
+    Only the part of x within reach of valid is used. Other indices for valid
+    are applied to the full output.
+    '''
+    if not isinstance(valid, slice):
+        return convolve_same(x, template)[valid]
+
+    n = x.size
+    m = template.size
+    start, stop, step = valid.indices(n)
+    if n < m or step != 1:
+        return np.convolve(x, template, mode='same')[valid]
+    if stop <= start:
+        return np.zeros(0)
+    
+    # Output i of 'same' mode is output i + hi of full mode, which depends on
+    # x[i-lo:i+hi+1]
+    hi = (m - 1) // 2
+    lo = m - 1 - hi
+    x_start = max(start - lo, 0)
+    x_stop = min(stop + hi, n)
+    full = convolve_full(x[x_start:x_stop], template)
+    return full[start + hi - x_start:stop + hi - x_start]
+
+def subset_reach(subset, n, reach):
+    '''
+    Slice of length-n vectors covering subset extended by reach on each side,
+    and the position of subset relative to it. Returns (None, None) if subset
+    is not a contiguous slice.
+    '''
+    if not isinstance(subset, slice):
+        return None, None
+    start, stop, step = subset.indices(n)
+    if step != 1:
+        return None, None
+    outer = slice(max(start - reach, 0), min(stop + reach, n))
+    inner = slice(start - outer.start, stop - outer.start)
+    return outer, inner
+
+def template_mass(template, n):
+    '''
+    Total template mass each coefficient contributes to the rates of a length-n
+    block, i.e. the column sums of the convolution, so that
+    np.sum(np.convolve(b, template, mode='same')) == np.dot(template_mass, b).
+    Computed in O(n) from cumulative sums and cached by (template, n).
+    '''
+    def factory():
+        m = template.size
+        hi = (m - 1) // 2
+        cum = np.zeros(m + 1)
+        np.cumsum(template, out=cum[1:])
+        j = np.arange(n)
+        return (cum[np.minimum(n - 1 + hi - j, m - 1) + 1] -
+                cum[np.maximum(hi - j, 0)])
+    return template_cached(_template_masses, template, (n,), factory)
+
+def sparse_window(positions, m, n):
+    '''
+    Indices of the coefficients within a length-m template window of each
+    position in a length-n block, as for np.convolve(..., mode='same'), with a
+    mask of those inside the block. Out-of-block indices are set to 0.
+    '''
+    index = positions[:,np.newaxis] + (m - 1) // 2 - np.arange(m)
+    valid = (index >= 0) & (index < n)
+    return np.where(valid, index, 0), valid
+
+class BlockWorkspace(object):
+    '''
+    Reusable workspace for repeated log-target evaluations on one block.
+
+    Holds the block's counts and region types and the prior parameters
+    gathered by base pair, which set_params refreshes whenever (mu, sigmasq)
+    change. Counts are also kept as (positions, counts) of nonzero entries;
+    blocks with at most SPARSE_MAX_DENSITY nonzero counts are flagged to use
+    the sparse-count kernels. log_target and grad cache the value and gradient
+    at the block's current state, so they can be carried between steps instead
+    of recomputed.
+
+    Kernels given a workspace compute in its dtype. With np.float32, counts
+    and gathered parameters are stored in single precision, halving memory
+    traffic in the convolutions; log_det is kept in double precision.
+    '''
+    __slots__ = ('y', 'region_types', 'dtype', 'positions', 'counts', 'sparse',
+                 'mu', 'sigmasq', 'log_det', 'version', 'log_target', 'grad')
+
+    def __init__(self, y, region_types, dtype=np.float64):
+        self.dtype = np.dtype(dtype)
+        self.y = np.asarray(y, dtype=self.dtype)
+        self.region_types = region_types
+        self.positions = np.flatnonzero(y)
+        self.counts = self.y[self.positions]
+        self.sparse = (self.positions.size <= SPARSE_MAX_DENSITY*y.size)
+        self.version = None
+        self.log_target = None
+        self.grad = None
+
+    def set_params(self, mu, sigmasq, version=None):
+        sigmasq = sigmasq[self.region_types]
+        self.mu = mu[self.region_types].astype(self.dtype)
+        self.sigmasq = sigmasq.astype(self.dtype)
+        self.log_det = np.log(sigmasq).sum()/2.0
+        self.version = version
+        self.log_target = None
+        self.grad = None
+
+def cached(cache, key, factory, max_size=None):
+    '''
+    Entry for key in cache, an OrderedDict, created by factory() if missing.
+    Beyond max_size entries, the least recently used ones are evicted, so
+    caches by block start do not grow with chromosome length.
+    '''
+    if key in cache:
+        value = cache.pop(key)
+    else:
+        value = factory()
+    cache[key] = value
+    if max_size is not None:
+        while len(cache) > max_size:
+            cache.popitem(last=False)
+    return value
+
 def l2_error(x1, x2):
     return np.sqrt( np.mean( (x1 - x2)**2 ) )
 
@@ -24,7 +248,7 @@ def l1_error(x1, x2):
     return np.mean(np.abs(x1-x2))
 
 def loglik(theta, y, region_types, X, Xt, subset, theta0,
-           mu, sigmasq, omega=1.0, log=False):
+           mu, sigmasq, omega=1.0, log=False, beta=1.0):
     b = theta0.copy()
     b[subset] = theta
     logb = b
@@ -35,25 +259,26 @@ def loglik(theta, y, region_types, X, Xt, subset, theta0,
     
     u = logb - mu[region_types]
     
-    val = np.sum(lam) - np.sum( y * np.log(lam) )
+    val = beta * (np.sum(lam) - np.sum( y * np.log(lam) ))
     val += np.sum(u*u/sigmasq[region_types])/2.0
     val += np.log(sigmasq[region_types]).sum()/2.0
     return val
 
 def loglik_convolve(theta, y, region_types, template, subset, theta0,
-                    mu, sigmasq, omega=1.0, log=False):
+                    mu, sigmasq, omega=1.0, log=False, beta=1.0):
     b = theta0.copy()
     b[subset] = theta
     logb = b
     if log: b = np.exp(logb)
     else: logb = np.log(b)
     
-    lam = omega * np.convolve(b, template, mode='same')
+    lam = omega * convolve_same(b, template)
     lam += SQRT_EPS
     
     u = logb - mu[region_types]
     
-    val = np.sum(lam) - np.sum( y * np.log(lam) )
+    # Likelihood is tempered by inverse temperature beta; prior is not
+    val = beta * (np.sum(lam) - np.sum( y * np.log(lam) ))
     val += np.sum(u*u/sigmasq[region_types])/2.0
     val += np.log(sigmasq[region_types]).sum()/2.0
     if not log:
@@ -62,7 +287,7 @@ def loglik_convolve(theta, y, region_types, template, subset, theta0,
     return val
 
 def dloglik(theta, y, region_types, X, Xt, subset, theta0,
-            mu, sigmasq, omega=1.0, log=False):
+            mu, sigmasq, omega=1.0, log=False, beta=1.0):
     b = theta0.copy()
     b[subset] = theta
     logb = b
@@ -73,66 +298,258 @@ def dloglik(theta, y, region_types, X, Xt, subset, theta0,
     #
     u = logb - mu[region_types]
     #
-    grad = Xt * omega*(1.-y/lam)
+    grad = Xt * beta*omega*(1.-y/lam)
     grad += u/sigmasq[region_types]/b
     if log: grad *= b
     #
     return grad[subset]
 
 def dloglik_convolve(theta, y, region_types, template, subset, theta0,
-                     mu, sigmasq, omega=1.0, log=False):
-    b = theta0.copy()
+                     mu, sigmasq, omega=1.0, log=False, beta=1.0,
+                     workspace=None):
+    if workspace is None:
+        b = theta0.copy()
+        mu = mu[region_types]
+        sigmasq = sigmasq[region_types]
+    else:
+        b = theta0.astype(workspace.dtype)
+        template = cast_template(template, workspace.dtype)
+        y = workspace.y
+        mu = workspace.mu
+        sigmasq = workspace.sigmasq
     b[subset] = theta
     logb = b
     if log: b = np.exp(logb)
     else: logb = np.log(b)
     
-    lam = omega * np.convolve(b, template, mode='same')
+    # The gradient on subset only needs lam within one template width of it
+    outer, inner = subset_reach(subset, b.size, template.size)
+    if outer is None:
+        outer, inner = slice(None), subset
+    
+    lam = omega * convolve_same(b, template, outer)
     lam += SQRT_EPS
     
-    u = logb - mu[region_types]
+    b = b[subset]
+    u = logb[subset] - mu[subset]
     
-    grad = omega * np.convolve(1.-y/lam, template, mode='same')
+    grad = beta * omega * convolve_same(1.-y[outer]/lam, template, inner)
     if log:
         grad *= b
-        grad += u/sigmasq[region_types]
-        return grad[subset]
+        grad += u/sigmasq[subset]
+        return grad
     
     # Adjustments for unlogged case
-    grad += u/sigmasq[region_types]/b
+    grad += u/sigmasq[subset]/b
     grad += 1./b
-    return grad[subset]
+    return grad
+
+def loglik_dloglik_convolve(theta, y, region_types, template, subset, theta0,
+                            mu, sigmasq, omega=1.0, log=False, beta=1.0,
+                            workspace=None):
+    '''
+    Value and gradient of the log-target, as from loglik_convolve and
+    dloglik_convolve, sharing lam between them. If a BlockWorkspace is given,
+    its counts and gathered prior parameters are used in place of y, mu and
+    sigmasq, and the computation runs in its dtype.
+    '''
+    if workspace is None:
+        workspace = BlockWorkspace(y, region_types)
+        workspace.set_params(mu, sigmasq)
+    elif workspace.sparse:
+        return loglik_dloglik_convolve_sparse(theta, y, region_types, template,
+                                              subset, theta0, mu, sigmasq,
+                                              omega, log, beta, workspace)
+    y = workspace.y
+    template = cast_template(template, workspace.dtype)
+    
+    b = theta0.astype(workspace.dtype)
+    b[subset] = theta
+    logb = b
+    if log: b = np.exp(logb)
+    else: logb = np.log(b)
+    
+    lam = omega * convolve_same(b, template)
+    lam += SQRT_EPS
+    
+    u = logb - workspace.mu
+    
+    val = beta * (np.sum(lam) - np.sum( y * np.log(lam) ))
+    val += np.sum(u*u/workspace.sigmasq)/2.0
+    val += workspace.log_det
+    if not log:
+        val += np.sum(logb)
+    
+    grad = beta * omega * convolve_same(1.-y/lam, template, subset)
+    b = b[subset]
+    u = u[subset]
+    sigmasq_subset = workspace.sigmasq[subset]
+    if log:
+        grad *= b
+        grad += u/sigmasq_subset
+        return val, grad
+    
+    # Adjustments for unlogged case
+    grad += u/sigmasq_subset/b
+    grad += 1./b
+    return val, grad
+
+def loglik_dloglik_convolve_sparse(theta, y, region_types, template, subset,
+                                   theta0, mu, sigmasq, omega=1.0, log=False,
+                                   beta=1.0, workspace=None):
+    '''
+    As loglik_dloglik_convolve, but evaluating the data term only at nonzero
+    counts from the workspace. The rates sum to a fixed linear function of b
+    (template_mass), and the gradient is that constant minus a sparse scatter
+    of the template around each read, so the convolutions cost O(reads) rather
+    than O(block).
+    '''
+    if workspace is None:
+        workspace = BlockWorkspace(y, region_types)
+        workspace.set_params(mu, sigmasq)
+    template = cast_template(template, workspace.dtype)
+    
+    b = theta0.astype(workspace.dtype)
+    b[subset] = theta
+    logb = b
+    if log: b = np.exp(logb)
+    else: logb = np.log(b)
+    n = b.size
+    
+    # Rates at nonzero positions only
+    index, valid = sparse_window(workspace.positions, template.size, n)
+    template_window = template * valid
+    lam = omega * np.sum(b[index] * template_window, 1)
+    lam += SQRT_EPS
+    
+    mass = template_mass(template, n)
+    u = logb - workspace.mu
+    
+    val = beta * (omega*np.dot(mass, b) + n*SQRT_EPS -
+                  np.sum(workspace.counts * np.log(lam)))
+    val += np.sum(u*u/workspace.sigmasq)/2.0
+    val += workspace.log_det
+    if not log:
+        val += np.sum(logb)
+    
+    grad = mass - np.bincount(index.ravel(),
+                              weights=((workspace.counts/lam)[:,np.newaxis] *
+                                       template_window).ravel(),
+                              minlength=n)
+    grad = beta * omega * grad[subset]
+    b = b[subset]
+    u = u[subset]
+    sigmasq_subset = workspace.sigmasq[subset]
+    if log:
+        grad *= b
+        grad += u/sigmasq_subset
+        return val, grad
+    
+    # Adjustments for unlogged case
+    grad += u/sigmasq_subset/b
+    grad += 1./b
+    return val, grad
 
 def ddloglik_diag_convolve(theta, y, region_types, template, subset, theta0, mu,
-                           sigmasq, omega=1.0, log=False):
+                           sigmasq, omega=1.0, log=False, beta=1.0):
     b = theta0.copy()
     b[subset] = theta
     logb = b
     if log: b = np.exp(logb)
     else: logb = np.log(b)
     
-    lam = omega * np.convolve(b, template, mode='same')
-    u = logb - mu[region_types]
+    # The diagonal on subset only needs lam within one template width of it
+    outer, inner = subset_reach(subset, b.size, template.size)
+    if outer is None:
+        outer, inner = slice(None), subset
+    
+    lam = omega * convolve_same(b, template, outer)
+    
+    b = b[subset]
+    u = logb[subset] - mu[region_types[subset]]
     
     # First component from second derivative of log-likelihood wrt b, rescaled
     # as needed for log-transformation
-    dd = omega*np.convolve(y/lam**2, template**2, mode='same')
+    dd = beta*omega*convolve_same(y[outer]/lam**2, template**2, inner)
 
     if log:
         # Rescale for chain rule
         dd *= b**2
 
         # Add gradient component from chain rule
-        dd += omega * np.convolve(1.-y/lam, template, mode='same') * b
+        dd += beta * omega * convolve_same(1.-y[outer]/lam, template, inner) * b
 
         # Second derivative of log-normal prior wrt log(b)
-        dd += 1/sigmasq[region_types]
-        return dd[subset]
+        dd += 1/sigmasq[region_types[subset]]
+        return dd
 
     # Adjustments for unlogged case
     # Don't need to worry about the gradient, but log-prior needs adjustment
-    dd += (1. - u)/sigmasq[region_types]/b**2
-    return dd[subset]
+    dd += (1. - u)/sigmasq[region_types[subset]]/b**2
+    return dd
+
+def affine_centering(mu, sigmasq, region_types, centering):
+    '''
+    Location and scale vectors for the reparameterization
+    theta = loc + scale * u of log-coefficients, with centering weights by
+    region. A weight of 1 gives the centered parameterization (u = theta); a
+    weight of 0 gives the non-centered one (u = (theta - mu) / sigma).
+    '''
+    c = centering[region_types]
+    loc = (1. - c) * mu[region_types]
+    scale = sigmasq[region_types]**((1. - c) / 2.)
+    return loc, scale
+
+def loglik_convolve_affine(u, y, region_types, template, subset, u0,
+                           mu, sigmasq, loc, scale, omega=1.0, beta=1.0):
+    theta = loc + scale*u0
+    theta[subset] = loc[subset] + scale[subset]*u
+
+    val = loglik_convolve(theta=theta, y=y, region_types=region_types,
+                          template=template, subset=None, theta0=theta,
+                          mu=mu, sigmasq=sigmasq, omega=omega, log=True,
+                          beta=beta)
+
+    # Jacobian of transformation from theta to u
+    val -= np.sum(np.log(scale))
+    return val
+
+def dloglik_convolve_affine(u, y, region_types, template, subset, u0,
+                            mu, sigmasq, loc, scale, omega=1.0, beta=1.0,
+                            workspace=None):
+    theta = loc + scale*u0
+    theta[subset] = loc[subset] + scale[subset]*u
+
+    if workspace is not None and workspace.sparse:
+        grad = loglik_dloglik_convolve_sparse(
+            theta=theta[subset], y=y, region_types=region_types,
+            template=template, subset=subset, theta0=theta, mu=mu,
+            sigmasq=sigmasq, omega=omega, log=True, beta=beta,
+            workspace=workspace)[1]
+    else:
+        grad = dloglik_convolve(theta=theta[subset], y=y,
+                                region_types=region_types, template=template,
+                                subset=subset, theta0=theta, mu=mu,
+                                sigmasq=sigmasq, omega=omega, log=True,
+                                beta=beta, workspace=workspace)
+    return grad * scale[subset]
+
+def loglik_dloglik_convolve_affine(u, y, region_types, template, subset, u0,
+                                   mu, sigmasq, loc, scale, omega=1.0,
+                                   beta=1.0, workspace=None):
+    theta = loc + scale*u0
+    theta[subset] = loc[subset] + scale[subset]*u
+
+    val, grad = loglik_dloglik_convolve(theta=theta[subset], y=y,
+                                        region_types=region_types,
+                                        template=template, subset=subset,
+                                        theta0=theta, mu=mu, sigmasq=sigmasq,
+                                        omega=omega, log=True, beta=beta,
+                                        workspace=workspace)
+
+    # Jacobian of transformation from theta to u
+    val -= np.sum(np.log(scale))
+    return val, grad * scale[subset]
 
 def ddloglik(theta, y, region_types, X, Xt, subset, theta0,
              mu, sigmasq, omega=1.0, log=True):
@@ -221,6 +638,130 @@ def ddloglik_p(theta, p, y, region_types, X, Xt, subset, theta0,
     #
     return H * p
 
+def ddloglik_p_convolve(theta, p, y, region_types, template, subset, theta0,
+                        mu, sigmasq, omega=1.0, log=False, beta=1.0,
+                        workspace=None):
+    '''
+    Product of the Hessian of the log-target over subset with p, computed by
+    convolutions in O(block) memory without forming the Hessian. Consistent
+    with loglik_convolve and dloglik_convolve.
+    '''
+    if workspace is None:
+        workspace = BlockWorkspace(y, region_types)
+        workspace.set_params(mu, sigmasq)
+    y = workspace.y
+    template = cast_template(template, workspace.dtype)
+    
+    b = theta0.astype(workspace.dtype)
+    b[subset] = theta
+    logb = b
+    if log: b = np.exp(logb)
+    else: logb = np.log(b)
+    
+    lam = omega * convolve_same(b, template)
+    lam += SQRT_EPS
+    
+    # Direction on the full block, zero outside of subset
+    v = np.zeros(b.size, dtype=b.dtype)
+    v[subset] = p
+    if log:
+        v *= b
+    
+    # Gauss-Newton component from the likelihood
+    hp = beta * omega**2 * convolve_same(y/lam**2 * convolve_same(v, template),
+                                         template, subset)
+    
+    b = b[subset]
+    u = logb[subset] - workspace.mu[subset]
+    sigmasq_subset = workspace.sigmasq[subset]
+    if log:
+        # Rescale for chain rule and add first-order component
+        hp *= b
+        hp += (beta * omega * convolve_same(1.-y/lam, template, subset) *
+               b * p)
+        hp += p/sigmasq_subset
+        return hp
+    
+    # Adjustments for unlogged case from the log-normal prior
+    hp += ((1. - u)/sigmasq_subset - 1.)/b**2 * p
+    return hp
+
+def ddloglik_banded_convolve(theta, y, region_types, template, mu, sigmasq,
+                             omega=1.0, beta=1.0, gauss_newton=False):
+    '''
+    Hessian of the log-target with respect to log-occupancies theta over the
+    full vector, in upper banded storage for use with scipy.linalg, computed
+    by convolutions without forming a basis matrix. Consistent with ddloglik
+    with log=True. Each of the template.size diagonals costs one convolution
+    with the product of the template and its shift, so memory is
+    O(template.size * N) for the result only.
+
+    If gauss_newton, the first-order term from the log-transformation is
+    dropped, giving a positive definite approximation away from the mode.
+
+    Returns H with shape (template.size, N); H[template.size - 1 - d, j]
+    holds entry (j - d, j).
+    '''
+    n = theta.size
+    m = template.size
+    b = np.exp(theta)
+    
+    lam = omega * convolve_same(b, template)
+    lam += SQRT_EPS
+    g = beta * omega**2 * y / lam**2
+    
+    H = np.zeros((m, n))
+    for d in xrange(min(m, n)):
+        # Entry (j, j + d) of the likelihood term sums g over reads covered
+        # by both coefficients
+        shifted = np.zeros(m)
+        shifted[d:] = template[d:] * template[:m-d]
+        H[m-1-d, d:] = (convolve_same(g, shifted[::-1])[:n-d] *
+                        b[:n-d] * b[d:])
+    
+    # First-order term from the chain rule and prior precision on the diagonal
+    if not gauss_newton:
+        H[m-1] += beta * omega * convolve_same(1. - y/lam, template) * b
+    H[m-1] += 1./sigmasq[region_types]
+    return H
+
+def inverse_diag_banded(U):
+    '''
+    Diagonal of the inverse of H = U'U from its upper banded Cholesky factor
+    U, in the storage of scipy.linalg.cholesky_banded, by Takahashi's
+    selected inversion. Entries of the inverse within the band are computed
+    backwards from the last coefficient, each row from the previous
+    bandwidth rows only, so time is O(N * bandwidth**2) and only a
+    bandwidth x bandwidth window of the inverse is held.
+    '''
+    p = U.shape[0] - 1
+    n = U.shape[1]
+    
+    # Pad with zero columns so rows near the end have full-width bands
+    U_pad = np.zeros((p + 1, n + p))
+    U_pad[:, :n] = U
+    band_rows = p - np.arange(1, p + 1)
+    band_cols = np.arange(1, p + 1)
+    
+    # Sigma holds entries (i + j, i + k) of the inverse for j, k in 0..p
+    Sigma = np.zeros((p + 1, p + 1))
+    var = np.empty(n)
+    for i in xrange(n - 1, -1, -1):
+        u_ii = U_pad[p, i]
+        u = U_pad[band_rows, i + band_cols]
+        
+        # Shift the window back by one coefficient
+        Sigma[1:, 1:] = Sigma[:p, :p].copy()
+        
+        # Off-diagonal entries of row i, then the diagonal entry
+        row = -np.dot(Sigma[1:, 1:], u) / u_ii
+        Sigma[0, 1:] = row
+        Sigma[1:, 0] = row
+        Sigma[0, 0] = (1. / u_ii - np.dot(u, row)) / u_ii
+        var[i] = Sigma[0, 0]
+    
+    return var
+
 def ddloglik_diag(theta, y, region_types, X, Xt, subset, theta0,
                   mu, sigmasq, omega=1.0, log=True):
     b = theta0.copy()
@@ -254,32 +795,376 @@ def ddloglik_diag(theta, y, region_types, X, Xt, subset, theta0,
     Hdiag = Hdiag + Sigma_inv_diag
     return Hdiag
 
-# Identify active components of basis
+# Identify active components of basis, i.e. those with any reads within
+# y[n-w+1:n+w], in linear time from prefix counts of nonzero positions
 def find_active(y, w=38):
     N = y.shape[0]
-    active = np.zeros(N, np.bool)
-    for n in range(N):
-        active[n] = (y[ np.maximum(0,n-w+1):np.minimum(n+w,N) ].max() > 0)
+    n_nonzero = np.zeros(N + 1, dtype=np.int)
+    np.cumsum(y != 0, out=n_nonzero[1:])
+    n = np.arange(N)
+    active = (n_nonzero[np.minimum(n + w, N)] -
+              n_nonzero[np.maximum(n - w + 1, 0)]) > 0
     return active
 
+def inactive_weights(template, n, omega=1.0):
+    '''
+    Total template mass contributed to the block's rates by each coefficient.
+    For coefficients with no reads in their footprint, this is the only way
+    they enter the likelihood.
+    '''
+    return omega * np.convolve(np.ones(n), template, mode='same')
+
+def inactive_mode(mu, sigmasq, weight, log=False):
+    '''
+    Closed-form conditional mode of coefficients with no reads in their
+    footprint. These decouple from the rest of the block, leaving
+    weight*b + (log(b) - mu)**2 / (2*sigmasq) (+ log(b) if unlogged) to be
+    minimized coordinate-wise, which is solved by the Lambert W function.
+    '''
+    if log:
+        loc = mu
+    else:
+        loc = mu - sigmasq
+    logb = loc - np.real(special.lambertw(weight*sigmasq*np.exp(loc)))
+    if log: return logb
+    return np.exp(logb)
+
+def rinactive(theta, mu, sigmasq, weight):
+    '''
+    Independence Metropolis-Hastings update of log-coefficients with no reads in
+    their footprint. Proposes from the log-normal prior, so the acceptance
+    ratio involves only the Poisson mass term. Exact for the block conditional
+    and linear in the number of coefficients.
+
+    Returns the updated log-coefficients and a boolean vector of acceptances.
+    '''
+    theta_prop = mu + np.sqrt(sigmasq)*np.random.randn(np.size(theta))
+    log_accept_prob = -weight*(np.exp(theta_prop) - np.exp(theta))
+    accept = np.log(np.random.uniform(size=np.size(theta))) < log_accept_prob
+    return np.where(accept, theta_prop, theta), accept
+
+def newton_cg(fun, hessp, x0, lower_bound, args=(), max_iter=100, gtol=1e-5,
+              max_cg=None, messages=0):
+    '''
+    Truncated Newton-CG minimization subject to x >= lower_bound, using only
+    Hessian-vector products.
+
+    Each outer iteration approximately solves (H + damping*I) d = -g over
+    free variables (those not held at the bound by the gradient) by conjugate
+    gradients, stopping once the residual is small relative to the gradient,
+    then takes a projected backtracking line search along d. Where CG meets
+    negative curvature, damping is raised past it and CG restarted, as in
+    Levenberg-Marquardt, so indefinite Hessians far from the mode give short
+    steps instead of unscaled ones; damping is relaxed after full steps.
+
+    Parameters
+    ----------
+        - fun : function
+            Returns value and gradient at x, called as fun(x, *args).
+        - hessp : function
+            Returns Hessian-vector product, called as hessp(x, p, *args).
+        - x0 : ndarray
+            Starting value.
+        - lower_bound : float
+            Lower bound for all entries of x.
+        - args : tuple
+            Additional arguments for fun and hessp.
+        - max_iter : int
+            Maximum number of Newton iterations.
+        - gtol : float
+            Tolerance for maximum absolute projected gradient.
+        - max_cg : int
+            Maximum number of CG iterations per Newton iteration. Defaults to
+            the number of variables.
+        - messages : int
+            If nonzero, print progress by iteration to stderr.
+
+    Returns
+    -------
+        Tuple (x, n_eval, rc) as from optimize.fmin_tnc, with rc 0 on
+        convergence, 1 if max_iter was reached, and 2 if the line search
+        failed.
+    '''
+    x = np.maximum(x0, lower_bound)
+    f, g = fun(x, *args)
+    n_eval = 1
+    if max_cg is None:
+        max_cg = x.size
+    damping = 0.
+    
+    for iteration in xrange(max_iter):
+        # Variables at the bound with gradient pushing into it are fixed
+        free = (x > lower_bound) | (g < 0)
+        g_free = g * free
+        g_norm = np.sqrt(np.dot(g_free, g_free))
+        if messages:
+            print >> sys.stderr, ('Newton-CG %d: f = %g, max |g| = %g, '
+                                  'damping = %g' % (iteration, f,
+                                                    np.max(np.abs(g_free)),
+                                                    damping))
+        if np.max(np.abs(g_free)) < gtol:
+            return x, n_eval, 0
+        
+        # Truncated CG for H d = -g over free variables with forcing term
+        # giving superlinear convergence
+        tol_cg = min(0.5, np.sqrt(g_norm)) * g_norm
+        while True:
+            d = np.zeros(x.size)
+            r = -g_free
+            q = r.copy()
+            rr = np.dot(r, r)
+            qHq = 1.
+            for k in xrange(max_cg):
+                Hq = hessp(x, q, *args) * free + damping * q
+                qHq = np.dot(q, Hq)
+                if qHq <= 0:
+                    break
+                alpha = rr / qHq
+                d += alpha * q
+                r -= alpha * Hq
+                rr_new = np.dot(r, r)
+                if np.sqrt(rr_new) < tol_cg:
+                    break
+                q = r + (rr_new / rr) * q
+                rr = rr_new
+            if qHq > 0:
+                break
+            # Negative curvature along q; at least double the damping past
+            # it and restart
+            damping = 2.*(damping - qHq/np.dot(q, q)) + SQRT_EPS
+        
+        # Projected backtracking line search
+        step = 1.
+        while True:
+            x_new = np.maximum(x + step*d, lower_bound)
+            f_new, g_new = fun(x_new, *args)
+            n_eval += 1
+            if np.isfinite(f_new) and f_new <= f + 1e-4*np.dot(g, x_new - x):
+                break
+            step /= 2.
+            if step < 1e-10:
+                return x, n_eval, 2
+        if step == 1.:
+            damping /= 4.
+        x, f, g = x_new, f_new, g_new
+    
+    return x, n_eval, 1
+
 def deconvolve(loglik, dloglik, y, region_types, template,
                mu, sigmasq,
                subset=slice(None), theta0=None, omega=1.0, log=False, 
-               lower_bound = np.sqrt( np.finfo(float).eps ),
+               lower_bound = np.sqrt( np.finfo(float).eps ), beta=1.0,
+               workspace=None, method='tnc', active=None, hessp_workspace=None,
                **kwargs):
-    m = subset.stop - subset.start
-    
+    # If dloglik is None, loglik returns both value and gradient (e.g.
+    # loglik_dloglik_convolve), optionally using a BlockWorkspace. With
+    # method='newton-cg' and log, the block is solved by truncated Newton-CG
+    # using convolution-based Hessian-vector products instead of fmin_tnc.
+    # These only steer the inner CG iterations, so they can be computed with
+    # a separate (e.g. single-precision) hessp_workspace while values and
+    # gradients stay in the precision of workspace. If Newton-CG does not
+    # converge, fmin_tnc finishes from where it stopped, so callers always
+    # get a converged mode or fmin_tnc's result. On the unlogged scale,
+    # where the target is far from convex, Newton-CG (in b or in log(b))
+    # settles in markedly worse local modes than fmin_tnc, so fmin_tnc is
+    # always used; see check_solver in deconvolve_em.
+    #
+    # If active (a boolean vector over subset) is given, only active
+    # coordinates are optimized and the rest are held at theta0, e.g. at
+    # their closed-form modes from inactive_mode. The full solution over
+    # subset is returned.
     if theta0 is None:
         theta0 = y + 1
         if log: theta0 = np.log(theta0)
+    
+    if active is not None:
+        result = deconvolve(loglik, dloglik, y, region_types, template, mu,
+                            sigmasq,
+                            subset=np.arange(subset.start, subset.stop)[active],
+                            theta0=theta0, omega=omega, log=log,
+                            lower_bound=lower_bound, beta=beta,
+                            workspace=workspace, method=method,
+                            hessp_workspace=hessp_workspace, **kwargs)
+        theta = theta0[subset].copy()
+        theta[active] = result[0]
+        return (theta,) + tuple(result[1:])
+    
     if log:
         lower_bound = np.log(lower_bound)
+    m = theta0[subset].size
+    
+    args = (y, region_types, template, subset, theta0, mu, sigmasq, omega, log,
+            beta)
+    if workspace is not None:
+        args += (workspace,)
+    
+    if method == 'newton-cg' and log:
+        if dloglik is None:
+            fun = loglik
+        else:
+            fun = lambda theta, *args: (loglik(theta, *args),
+                                        dloglik(theta, *args))
+        if hessp_workspace is None:
+            hessp = ddloglik_p_convolve
+        else:
+            hessp = lambda theta, p, *args: ddloglik_p_convolve(
+                theta, p, *(args[:10] + (hessp_workspace,)))
+        x, n_eval, rc = newton_cg(fun, hessp, theta0[subset], lower_bound,
+                                  args=args, **kwargs)
+        if rc == 0:
+            return x, n_eval, rc
+        
+        # Newton-CG reached max_iter or its line search failed; finish with
+        # fmin_tnc from where it stopped
+        theta_tnc = theta0.copy()
+        theta_tnc[subset] = x
+        result = deconvolve(loglik, dloglik, y, region_types, template, mu,
+                            sigmasq, subset=subset, theta0=theta_tnc,
+                            omega=omega, log=True,
+                            lower_bound=np.exp(lower_bound), beta=beta,
+                            workspace=workspace, method='tnc',
+                            messages=kwargs.get('messages', 0))
+        return (result[0], n_eval + result[1], result[2])
     
     result = optimize.fmin_tnc( loglik, theta0[subset], dloglik,
-                                args=(y, region_types, template, subset, theta0,
-                                      mu, sigmasq, omega, log),
+                                args=args,
                                 bounds = zip( np.ones(m)*lower_bound,
                                               np.ones(m)*np.Inf ),
                                 **kwargs )
     return result
 
+def region_stats(logb, var_theta, region_types, n_regions):
+    '''
+    Sufficient statistics for the M-step by region id: sums of log-occupancies,
+    their squares, and their approximate variances, as an (n_regions, 3)
+    array. Coordinates are given by region_types, so any subset of the
+    chromosome can be summarized and added to or subtracted from totals.
+    '''
+    stats = np.empty((n_regions, 3))
+    stats[:,0] = np.bincount(region_types, weights=logb, minlength=n_regions)
+    stats[:,1] = np.bincount(region_types, weights=logb**2,
+                             minlength=n_regions)
+    stats[:,2] = np.bincount(region_types, weights=var_theta,
+                             minlength=n_regions)
+    return stats
+
+def update_region_params_stats(stats, r, mu, sigmasq, prior_mean, region_size,
+                               k0, a0, b0, fix_mu=False, fix_sigmasq=False):
+    '''
+    M-step for the parameters of a single region from the sufficient
+    statistics of region_stats. Updates mu[r] and sigmasq[r] in place.
+    '''
+    mean_logb = stats[r,0] / region_size
+    
+    if not fix_mu:
+        mu[r] = mean_logb + prior_mean[r]*k0
+        mu[r] /= 1.0 + k0
+    
+    if not fix_sigmasq:
+        sigmasq[r] = max(stats[r,1] / region_size - 2.*mu[r]*mean_logb +
+                         mu[r]**2, 0.)
+        sigmasq[r] += stats[r,2] / region_size
+        sigmasq[r] += k0*(mu[r]-prior_mean[r])**2
+        sigmasq[r] += 2.*b0/region_size
+        sigmasq[r] /= (1 + 3./region_size + 2.*a0/region_size)
+
+def coarsen(y, region_types, template, factor):
+    '''
+    Bin reads and template by factor for multiresolution initialization.
+    Reads are summed within bins of factor base pairs and each bin takes the
+    region type of its first base pair. Occupancies are held constant within
+    bins, so the coarse template sums the template over all pairs of base
+    pairs in two bins: entry D weights the template at offset e by
+    max(factor - |e - D*factor|, 0). Occupancies on the coarse scale are in
+    the same units as at full resolution.
+
+    Returns the coarse (y, region_types, template).
+    '''
+    n_coarse = (y.size + factor - 1) / factor
+    y_pad = np.zeros(n_coarse*factor)
+    y_pad[:y.size] = y
+    y_coarse = y_pad.reshape((n_coarse, factor)).sum(1)
+    
+    region_types_coarse = region_types[::factor]
+    
+    h = template.size/2
+    h_coarse = (h + factor - 1) / factor
+    offsets = np.arange(-h, h+1)
+    template_coarse = np.empty(2*h_coarse + 1)
+    for d in xrange(-h_coarse, h_coarse+1):
+        weight = np.maximum(factor - np.abs(offsets - d*factor), 0)
+        template_coarse[d + h_coarse] = np.dot(template, weight)
+    
+    return y_coarse, region_types_coarse, template_coarse
+
+def prolong(theta, factor, n):
+    '''
+    Extend coarse coefficients theta to a grid finer by factor, holding them
+    constant within bins, and truncate to length n.
+    '''
+    return np.repeat(theta, factor)[:n]
+
+def multiresolution_init(y, region_types, template, mu, sigmasq, levels,
+                         block_width, method='tnc', log=True):
+    '''
+    Coarse-to-fine starting values for occupancies. Reads and template are
+    binned by 2**levels, ..., 4, 2 (see coarsen); at each level, one sweep of
+    block conditional modes given (mu, sigmasq) is run from the solution of
+    the previous, coarser level, prolonged to the current one. Blocks follow
+    the 2-iteration scan of the EM E-step, with block_width counted in coarse
+    bins; if block_width is None, each level is solved as a single block.
+
+    Each coarse level is the full-resolution problem restricted to
+    occupancies constant within bins, so the prior precision of a coarse
+    coefficient is factor/sigmasq. If log is False, modes are for the
+    occupancies themselves rather than their logs, as in the unlogged phase
+    of the EM; for the log-Normal prior, this shifts mu by -sigmasq.
+
+    Returns occupancies (not logged) at full resolution.
+    '''
+    if not log:
+        mu = mu - sigmasq
+    
+    theta = None
+    for level in xrange(levels, 0, -1):
+        factor = 2**level
+        y_coarse, region_types_coarse, template_coarse = coarsen(
+                y, region_types, template, factor)
+        n = y_coarse.size
+        w = template_coarse.size/2 + 1
+        
+        if theta is None:
+            theta = np.log(y_coarse/float(factor) + 1.)
+        else:
+            theta = prolong(theta, 2, n)
+        
+        if block_width is None:
+            width = n
+            starts = [0]
+        else:
+            width = block_width
+            starts = np.concatenate([np.arange(0, n, width),
+                                     np.arange(width/2, n, width)])
+        for start in starts:
+            end = min(n, start + width)
+            block = slice(max(start-w, 0), min(end+w, n))
+            size_block = block.stop - block.start
+            subset = slice(w*(start!=0)+start-block.start,
+                           size_block-w*(end!=n) - (block.stop-end))
+            if subset.stop <= subset.start:
+                continue
+            
+            workspace = BlockWorkspace(y_coarse[block],
+                                       region_types_coarse[block])
+            workspace.set_params(mu, sigmasq/factor)
+            theta_block = theta[block].copy()
+            result = deconvolve(loglik_dloglik_convolve, None, y_coarse[block],
+                                region_types_coarse[block], template_coarse,
+                                mu, sigmasq/factor, subset=subset,
+                                theta0=theta_block, log=True,
+                                workspace=workspace, method=method,
+                                messages=0)
+            theta_block[subset] = result[0]
+            theta[block] = theta_block
+    
+    return np.exp(prolong(theta, 2, y.size))
@@ -0,0 +1,477 @@
+import sys
+import time
+import multiprocessing
+
+import numpy as np
+from scipy import linalg
+
+import lib_deconvolve_em as lib
+import lib_warm_start
+
+def make_data(y, template, region_types=None, chrom=1):
+    '''
+    Setup data for estimation from arrays, as load_data in deconvolve_em does
+    from files.
+
+    Parameters
+    ----------
+        - y : ndarray
+            Counts of read centers per base pair.
+        - template : ndarray
+            Template for the distribution of read centers about a nucleosome.
+        - region_types : integer ndarray
+            Vector of region types by base pair. If None, the whole sequence
+            is a single region.
+        - chrom : int
+            Index of chromosome (or gene), used to match previous runs for
+            warm starts.
+
+    Returns
+    -------
+        Dictionary of data as output from load_data.
+    '''
+    y = np.asarray(y, dtype=np.float)
+    if region_types is None:
+        region_types = np.zeros(y.size, dtype=np.int)
+    else:
+        region_types = np.asarray(region_types, dtype=np.int)
+
+    # Get length of chromosome; important if regions and reads disagree
+    chrom_length = min(region_types.size, y.size)
+
+    # Truncate region types to chromosome length
+    region_types = region_types[:chrom_length]
+
+    # Set region types to start at 0 for consistent array indexing
+    region_types = region_types - region_types.min()
+
+    # Get unique region identifiers
+    n_regions = region_types.max() + 1
+    region_ids = np.unique(region_types)
+
+    # Build map of regions by r
+    region_list = [None]*n_regions
+    region_sizes = np.ones(n_regions, dtype=np.int)
+    for r in region_ids:
+        region = np.where(region_types==r)[0]
+        region_list[r] = slice(region.min(), region.max()+1)
+        region_sizes[r] = region.size
+
+    # Build dictionary of data to return
+    data = {'chrom' : chrom,
+            'y' : y[:chrom_length],
+            'template' : template,
+            'region_types' : region_types,
+            'region_list' : region_list,
+            'region_sizes' : region_sizes,
+            'region_ids' : region_ids
+            }
+    return data
+
+def initialize(data, cfg, null=False, master=True):
+    '''
+    Initialize parameters: occupancies from the reads (or multiresolution
+    initialization), mu by method of moments, and sigmasq at its prior mean,
+    unless warm-started from a previous run. Occupancies are not logged.
+
+    Multiresolution initialization is skipped if a previous run is found for
+    the warm start. If master is False (on MPI workers, which receive
+    parameters from the master and do not use the initial occupancies), both
+    are skipped. Other parameters and the return value are as for initialize
+    in deconvolve_em.
+    '''
+    # Create references to frequently-accessed config information
+    # Prior on 1 / sigmasq
+    a0  = cfg['prior']['a0']
+    b0  = cfg['prior']['b0']
+    # Verbosity
+    verbose = cfg['estimation_params']['verbose']
+    # Number of coarse levels for multiresolution initialization
+    levels = cfg['estimation_params'].get('multiresolution_levels', 0)
+    block_width = cfg['estimation_params']['block_width']
+    solver = cfg['estimation_params'].get('solver', 'tnc')
+    # Patterns for manifests of previous runs to warm start from
+    warm_start = cfg['estimation_params'].get('warm_start', None)
+
+    # Create references to relevant data entries in local namespace
+    y            = data['y']
+    region_list  = data['region_list']
+    region_ids   = data['region_ids']
+
+    # Compute needed data properties
+    n_regions = region_ids.size
+
+    # Look up the previous run with the best-matching inputs, if any
+    manifest = None
+    if warm_start is not None and master:
+        manifest = lib_warm_start.previous_run(warm_start, data, cfg,
+                                               null=null, verbose=verbose)
+
+    # Initialize nucleotide-level occupancies
+    theta = (y+1.0)
+
+    # Initialize mu using method-of-moments estimator based on prior variance
+    sigmasq0 = b0 / a0
+    mu = np.ones(n_regions)
+    mu[region_ids] = np.array([np.log(theta[region_list[r]].mean()) -
+                              sigmasq0 / 2.0 for r in region_ids])
+
+    # Initialize sigmasq based upon prior mean
+    sigmasq = np.ones(n_regions)*sigmasq0
+
+    # Refine occupancies from coarse-to-fine solutions given these
+    # parameters. Estimation starts on the unlogged scale.
+    if levels > 0 and master and manifest is None:
+        theta = lib.multiresolution_init(y, data['region_types'],
+                                         data['template'], mu, sigmasq,
+                                         levels, block_width, method=solver,
+                                         log=False)
+
+    # Start from the previous run, if found
+    if manifest is not None:
+        state = lib_warm_start.warm_start(manifest, data, np.log(theta), mu,
+                                          sigmasq)
+        theta = np.exp(state[0])
+        mu, sigmasq = state[1:]
+
+    # Build dictionary of initial params to return
+    init = {'theta' : theta,
+            'mu' : mu,
+            'sigmasq' : sigmasq}
+    return init
+
+def banded_var_theta(logb, y, region_types, template, mu, sigmasq,
+                     verbose=0):
+    '''
+    Approximate variances of log-occupancies conditional on (mu, sigmasq)
+    from selected inversion of the banded Hessian. Falls back to the
+    Gauss-Newton approximation if the Hessian is not positive definite.
+    '''
+    try:
+        U = linalg.cholesky_banded(
+                lib.ddloglik_banded_convolve(logb, y, region_types, template,
+                                             mu, sigmasq),
+                lower=False)
+    except linalg.LinAlgError:
+        if verbose: print 'Cholesky fail'
+        U = linalg.cholesky_banded(
+                lib.ddloglik_banded_convolve(logb, y, region_types, template,
+                                             mu, sigmasq, gauss_newton=True),
+                lower=False)
+    return lib.inverse_diag_banded(U)
+
+def update_params(stats, region_ids, mu, sigmasq, prior_mean, region_sizes,
+                  k0, a0, b0, fix_mu=False, fix_sigmasq=False):
+    '''
+    M-step for the parameters of all regions from the sufficient statistics
+    of region_stats. Updates mu and sigmasq in place.
+    '''
+    for r in region_ids:
+        lib.update_region_params_stats(stats, r, mu=mu, sigmasq=sigmasq,
+                                       prior_mean=prior_mean,
+                                       region_size=region_sizes[r], k0=k0,
+                                       a0=a0, b0=b0, fix_mu=fix_mu,
+                                       fix_sigmasq=fix_sigmasq)
+
+def switch_scale(theta, logb, iter, log, last_switch, b_last_switch, tol,
+                 verbose=0):
+    '''
+    Switch between optimizing over log(b) and b once the EM has converged on
+    the current scale. After the first switch, scales are only switched again
+    if the last switch moved b by at least tol (in L_2); otherwise the EM has
+    converged.
+
+    Returns (theta, log, converged, last_switch, b_last_switch), with theta
+    on the new scale if switched.
+    '''
+    if last_switch >= 0:
+        # Check if switching space helped
+        delta = lib.l2_error( np.exp(logb), b_last_switch )
+        if delta < tol:
+            return theta, log, True, last_switch, b_last_switch
+    
+    # If it did help, or on the first switch, keep going
+    b_last_switch = np.exp(logb)
+    last_switch = iter
+    log = not log
+    
+    if log: theta = np.log(theta)
+    else: theta = np.exp(theta)
+    
+    if verbose:
+        print 'Last switch: %d' % last_switch
+        print 'Log: %s' % str(log)
+    
+    return theta, log, False, last_switch, b_last_switch
+
+def estimate(data, init, cfg):
+    '''
+    Single-process EM. Each E-step finds the conditional mode of all
+    occupancies jointly, using the fused value and gradient kernel over the
+    whole sequence instead of blocks, so no workers are needed. Intended for
+    sequences of a few kb, such as single genes; the M-step, convergence
+    criterion and switching between optimization over b and log(b) are as
+    in master of deconvolve_em.
+
+    Parameters
+    ----------
+        - data : dictionary
+            Data as output from load_data or make_data.
+        - init : dictionary
+            Initial parameter values as output from initialize.
+        - cfg : dictionary
+            Dictionary containing (at least) prior and estimation_params
+            sections with appropriate entries.
+
+    Returns
+    -------
+        Dictionary of results as output from master in deconvolve_em.
+    '''
+    # Create references to frequently-accessed config information
+    # Prior on mu - sigmasq / 2
+    mu0 = cfg['prior']['mu0']
+    k0  = cfg['prior']['k0']
+    # Prior on 1 / sigmasq
+    a0  = cfg['prior']['a0']
+    b0  = cfg['prior']['b0']
+    # Tolerance for convergence
+    tol = cfg['estimation_params']['tol']
+    # Iteration limits
+    min_iter = cfg['estimation_params']['min_iter']
+    max_iter = cfg['estimation_params']['max_iter']
+    # Verbosity
+    verbose = cfg['estimation_params']['verbose']
+    timing = cfg['estimation_params']['timing']
+    # Use diagonal approximation when inverting Hessian?
+    diag_approx = cfg['estimation_params']['diag_approx']
+    # Debugging flags to fix hyperparameters
+    fix_mu = cfg['estimation_params']['fix_mu']
+    fix_sigmasq = cfg['estimation_params']['fix_sigmasq']
+    # Set coefficients without reads in their footprint in closed form?
+    fast_inactive = cfg['estimation_params'].get('fast_inactive', True)
+    # Solver: 'tnc' (scipy) or 'newton-cg' (matrix-free)
+    solver = cfg['estimation_params'].get('solver', 'tnc')
+    # Compute Newton-CG Hessian-vector products in single precision?
+    hessp_dtype = np.dtype(cfg['estimation_params'].get('precision',
+                                                        'float64'))
+
+    # Compute derived quantities from config information
+    sigmasq0 = b0 / a0
+    adapt_prior = (mu0 is None)
+
+    # Create references to relevant data entries in local scope
+    y           = data['y']
+    template    = data['template']
+    region_types = data['region_types']
+    region_list  = data['region_list']
+    region_sizes = data['region_sizes']
+    region_ids   = data['region_ids']
+
+    # Compute needed data properties
+    chrom_length = y.size
+    n_regions = region_ids.size
+    w = template.size/2 + 1
+
+    # Reference copies of initialized quantities in local scope
+    theta   = init['theta'].copy()
+    mu      = init['mu'].copy()
+    sigmasq = init['sigmasq'].copy()
+
+    # Setup prior means
+    prior_mean = np.zeros(n_regions)
+    if adapt_prior:
+        # Adapt prior means if requested
+        # Get coverage by region
+        coverage = np.zeros(n_regions)
+        for i in region_ids:
+            coverage[i] = np.mean(y[region_list[i]])
+
+        # Translate to prior means
+        prior_mean[coverage>0] = np.log(coverage[coverage>0]) - sigmasq0 / 2.0
+    else:
+         prior_mean += mu0
+
+    # Coefficients with no reads in their footprint decouple from the rest;
+    # they are set to their conditional modes and the optimization runs over
+    # the active ones only
+    if fast_inactive:
+        active = lib.find_active(y, w=w)
+    else:
+        active = np.ones(chrom_length, dtype=np.bool)
+    inactive = np.flatnonzero(~active)
+    weight = lib.inactive_weights(template, chrom_length)[inactive]
+
+    # Workspaces for the whole sequence, refreshed after each M-step
+    workspace = lib.BlockWorkspace(y, region_types)
+    hessp_workspace = None
+    if solver == 'newton-cg' and hessp_dtype != np.float64:
+        hessp_workspace = lib.BlockWorkspace(y, region_types,
+                                             dtype=hessp_dtype)
+
+    # Start with optimization on unlogged scale
+    iter = 0
+    last_switch = -1
+    b_last_switch = None
+    log = False
+    converged = False
+    var_theta = sigmasq[region_types]
+
+    while iter < max_iter and (not converged or iter < min_iter):
+        # Store estimates from last iteration for convergence check
+        if log: b_previous_iteration = np.exp(theta)
+        else:   b_previous_iteration = theta.copy()
+
+        # E-step: joint conditional mode of all occupancies
+        if verbose and timing: tme = time.clock()
+        workspace.set_params(mu, sigmasq)
+        if hessp_workspace is not None:
+            hessp_workspace.set_params(mu, sigmasq)
+
+        if inactive.size > 0:
+            region_inactive = region_types[inactive]
+            theta[inactive] = lib.inactive_mode(mu[region_inactive],
+                                                sigmasq[region_inactive],
+                                                weight, log=log)
+        if np.any(active):
+            result = lib.deconvolve(lib.loglik_dloglik_convolve, None, y,
+                                    region_types, template, mu, sigmasq,
+                                    subset=slice(0, chrom_length),
+                                    theta0=theta, log=log,
+                                    workspace=workspace, method=solver,
+                                    active=(None if inactive.size == 0
+                                            else active),
+                                    hessp_workspace=hessp_workspace,
+                                    messages=0)
+            theta = result[0]
+
+        if log:
+            logb = theta
+        else:
+            logb = np.log(theta)
+
+        if verbose and timing:
+            print >> sys.stderr, "E-step time: %s" % (time.clock() - tme)
+            tme = time.clock()
+
+        # M-step from approximate variances of log-occupancies conditional on
+        # (mu, sigmasq), skipped after the first E-step as in master
+        if iter > 0:
+            if fix_sigmasq:
+                var_theta = np.zeros(chrom_length)
+            elif diag_approx:
+                var_theta = 1.0/lib.ddloglik_diag_convolve(
+                        logb, y, region_types, template, slice(None), logb, mu,
+                        sigmasq, log=True)
+            else:
+                var_theta = banded_var_theta(logb, y, region_types, template,
+                                             mu, sigmasq, verbose=verbose)
+
+            stats = lib.region_stats(logb, var_theta, region_types, n_regions)
+            update_params(stats, region_ids, mu, sigmasq, prior_mean,
+                          region_sizes, k0, a0, b0, fix_mu=fix_mu,
+                          fix_sigmasq=fix_sigmasq)
+
+            if verbose:
+                if timing: print >> sys.stderr, ( "M-step time: %s" %
+                                                  (time.clock() - tme) )
+                if verbose > 1: print mu, sigmasq
+
+        # Using L_2 convergence criterion on estimated parameters of interest
+        # (theta)
+        iter += 1
+        delta = lib.l2_error( np.exp(logb), b_previous_iteration )
+        converged = (delta < tol)
+
+        if verbose:
+            print delta
+            print iter
+
+        # Switch between optimizing over log(b) and b
+        if converged:
+            theta, log, converged, last_switch, b_last_switch = switch_scale(
+                theta, logb, iter, log, last_switch, b_last_switch, tol,
+                verbose=verbose)
+
+    # Exponentiate coefficients, if needed
+    if log: theta = np.exp(theta)
+
+    # Return results
+    out = {'theta' : theta,
+           'var_theta' : var_theta,
+           'mu' : mu,
+           'sigmasq' : sigmasq,
+           'region_ids' : region_ids}
+    return out
+
+def deconvolve_gene(y, template, cfg, region_types=None, chrom=1, null=False):
+    '''
+    Run single-process EM on one sequence given as arrays; see make_data for
+    arguments.
+
+    Returns a dictionary of results as output from estimate.
+    '''
+    data = make_data(y, template, region_types=region_types, chrom=chrom)
+    init = initialize(data, cfg, null=null)
+    return estimate(data, init, cfg)
+
+def deconvolve_gene_tuple(arg_tuple):
+    '''
+    Utility function to run deconvolve_gene given y, template, cfg,
+    region_types, chrom, and null.
+    Needed to use multiprocessing.Pool.map; that provides the odd argument
+    syntax
+    '''
+    y, template, cfg, region_types, chrom, null = arg_tuple
+    return deconvolve_gene(y, template, cfg, region_types=region_types,
+                           chrom=chrom, null=null)
+
+def deconvolve_genes(y_list, template, cfg, region_types_list=None,
+                     chrom_list=None, null=False, n_proc=None):
+    '''
+    Run single-process EM on many short sequences, such as genes, with a pool
+    of n_proc processes. If n_proc is None, sequences are run in turn in this
+    process.
+
+    Parameters
+    ----------
+        - y_list : list of ndarrays
+            Counts of read centers per base pair, one array per sequence.
+        - template : ndarray
+            Template shared by all sequences.
+        - cfg : dictionary
+            Dictionary containing (at least) prior and estimation_params
+            sections with appropriate entries.
+        - region_types_list : list of integer ndarrays
+            Region types by base pair for each sequence. If None, each
+            sequence is a single region.
+        - chrom_list : list of ints
+            Index of each sequence, used to match previous runs for warm
+            starts. If None, sequences are numbered from 1 in the order of
+            y_list.
+        - null : bool
+            If null, warm starts use previous runs on null reads.
+        - n_proc : int
+            Number of processes.
+
+    Returns
+    -------
+        List of dictionaries of results as output from estimate, in the order
+        of y_list.
+    '''
+    if region_types_list is None:
+        region_types_list = [None]*len(y_list)
+    if chrom_list is None:
+        chrom_list = range(1, len(y_list) + 1)
+
+    args = [(y, template, cfg, region_types, chrom, null) for
+            y, region_types, chrom in
+            zip(y_list, region_types_list, chrom_list)]
+
+    if n_proc is None:
+        return map(deconvolve_gene_tuple, args)
+
+    pool = multiprocessing.Pool(processes=n_proc)
+    results = pool.map(deconvolve_gene_tuple, args)
+    pool.close()
+    pool.join()
+    return results
@@ -0,0 +1,288 @@
+import glob
+import hashlib
+import json
+import os
+import tarfile
+
+import numpy as np
+
+# Version of manifest format
+MANIFEST_VERSION = 2
+
+# Inputs identified by content hashes in manifests. Previous runs must share
+# at least one of the data inputs to be used for warm starts.
+INPUT_KEYS = ('reads', 'template', 'regions', 'prior')
+DATA_KEYS = ('reads', 'template', 'regions')
+
+def hash_array(x):
+    '''
+    SHA-1 hex digest of the contents of an array, independent of its dtype
+    for numeric data.
+    '''
+    x = np.ascontiguousarray(x, dtype=np.float)
+    digest = hashlib.sha1(str(x.shape))
+    digest.update(x.tostring())
+    return digest.hexdigest()
+
+def hash_file(path, chunk_size=2**20):
+    '''
+    SHA-1 hex digest of the contents of a file, read in chunks.
+    '''
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def file_stats(path):
+    '''
+    Size and modification time of a file, to check cheaply whether it has
+    changed since a manifest was written.
+    '''
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime]
+
+def input_hashes(data, cfg):
+    '''
+    Content hashes of the inputs to a run for one chromosome: reads,
+    template, region types by base pair, and prior settings.
+    '''
+    prior = json.dumps(cfg['prior'], sort_keys=True)
+    return {'reads' : hash_array(data['y']),
+            'template' : hash_array(data['template']),
+            'regions' : hash_array(data['region_types']),
+            'prior' : hashlib.sha1(prior).hexdigest()}
+
+def encode_regions(region_types):
+    '''
+    Run-length encoding of region types by base pair as a list of
+    [start, region_type] pairs.
+    '''
+    starts = np.flatnonzero(np.diff(region_types)) + 1
+    starts = np.r_[0, starts]
+    return [[int(s), int(region_types[s])] for s in starts]
+
+def decode_regions(runs, n):
+    '''
+    Region types by base pair for a chromosome of length n from the output of
+    encode_regions.
+    '''
+    region_types = np.empty(n, dtype=np.int)
+    bounds = [s for s, r in runs[1:]] + [n]
+    for (start, r), stop in zip(runs, bounds):
+        region_types[start:stop] = r
+    return region_types
+
+def write_manifest(path, method, data, cfg, null, outputs):
+    '''
+    Write a manifest for the results of a run to path as JSON.
+
+    Parameters
+    ----------
+        - path : string
+            Path for manifest.
+        - method : string
+            'em', or 'mcmc', 'laplace' or 'vb' for draws.
+        - data : dictionary
+            Data as output from load_data.
+        - cfg : dictionary
+            Configuration of the run.
+        - null : bool
+            Whether the run used null reads.
+        - outputs : dictionary
+            Paths to results by name; 'coef' and 'param' for EM, 'draws'
+            otherwise. Their sizes, modification times and content hashes are
+            recorded so that stale results are not used.
+    '''
+    manifest = {'version' : MANIFEST_VERSION,
+                'method' : method,
+                'chrom' : int(data['chrom']),
+                'null' : bool(null),
+                'chrom_length' : int(data['y'].size),
+                'inputs' : input_hashes(data, cfg),
+                'regions' : encode_regions(data['region_types']),
+                'outputs' : {},
+                'output_stats' : {},
+                'output_hashes' : {}}
+    for name, output_path in outputs.iteritems():
+        manifest['outputs'][name] = os.path.abspath(output_path)
+        manifest['output_stats'][name] = file_stats(output_path)
+        manifest['output_hashes'][name] = hash_file(output_path)
+
+    with open(path, 'wb') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+def find_manifest(patterns, data, cfg, null=False):
+    '''
+    Locate the manifest of the previous run whose inputs best match the
+    current ones. Candidates are the files matching any of the glob patterns,
+    formatted as pattern.format(**cfg), for the same chromosome and null
+    setting, sharing at least one of DATA_KEYS, and with results of unchanged
+    size and modification time. They are ranked by the number of matching
+    input hashes, then by equal chromosome length, then by modification time.
+    Only the results of the best candidate are checked against their content
+    hashes, falling back to the next candidate if they have changed.
+
+    Returns (path, manifest), or (None, None) if no usable manifest is found.
+    '''
+    if isinstance(patterns, basestring):
+        patterns = [patterns]
+
+    hashes = input_hashes(data, cfg)
+
+    candidates = []
+    for pattern in patterns:
+        for path in glob.glob(pattern.strip().format(**cfg)):
+            try:
+                with open(path, 'rb') as f:
+                    manifest = json.load(f)
+            except (IOError, ValueError):
+                continue
+
+            if (manifest.get('version') != MANIFEST_VERSION or
+                manifest['chrom'] != data['chrom'] or
+                manifest['null'] != null):
+                continue
+
+            # Skip runs on unrelated data
+            match = dict((k, manifest['inputs'][k] == hashes[k]) for k in
+                         INPUT_KEYS)
+            if not any(match[k] for k in DATA_KEYS):
+                continue
+
+            # Skip runs whose results have since been removed or overwritten
+            try:
+                current = all(file_stats(manifest['outputs'][name]) == stats
+                              for name, stats in
+                              manifest['output_stats'].iteritems())
+            except OSError:
+                current = False
+            if not current:
+                continue
+
+            key = (sum(match.values()),
+                   manifest['chrom_length'] == data['y'].size,
+                   os.path.getmtime(path))
+            candidates.append((key, path, manifest))
+
+    candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+    for key, path, manifest in candidates:
+        try:
+            if all(hash_file(manifest['outputs'][name]) == h for name, h in
+                   manifest['output_hashes'].iteritems()):
+                return path, manifest
+        except IOError:
+            pass
+
+    return None, None
+
+def read_last_row(archive, name):
+    '''
+    Last row of a C-ordered array saved as name.npy in a tar archive, read
+    without loading the full array.
+    '''
+    f = archive.extractfile(name + '.npy')
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+
+    row_size = int(np.prod(shape[1:]))
+    f.seek((shape[0] - 1) * row_size * dtype.itemsize, os.SEEK_CUR)
+    row = f.read(row_size * dtype.itemsize)
+    return np.frombuffer(row, dtype=dtype).copy()
+
+def load_state(manifest):
+    '''
+    Final state of a previous run from its manifest: log-occupancies, and mu
+    and sigmasq by the run's region ids. For EM, these are the estimates; for
+    draws from MCMC, Laplace or VB, the last draw.
+    '''
+    outputs = manifest['outputs']
+    if manifest['method'] == 'em':
+        theta = np.log(np.loadtxt(outputs['coef']))
+        param_dtype = [('region_type', np.int), ('mu', np.float),
+                       ('sigmasq', np.float)]
+        params = np.loadtxt(outputs['param'], skiprows=1, dtype=param_dtype,
+                            ndmin=1)
+        n_regions = params['region_type'].max() + 1
+        mu = np.zeros(n_regions)
+        sigmasq = np.ones(n_regions)
+        mu[params['region_type']] = params['mu']
+        sigmasq[params['region_type']] = params['sigmasq']
+    else:
+        archive = tarfile.open(name=outputs['draws'], mode='r:*')
+        theta = read_last_row(archive, 'theta')
+        mu = read_last_row(archive, 'mu')
+        sigmasq = read_last_row(archive, 'sigmasq')
+        archive.close()
+
+    return theta, mu, sigmasq
+
+def remap_state(manifest, theta, mu, sigmasq, data, theta0, mu0, sigmasq0):
+    '''
+    Map the state (theta, mu, sigmasq) of a previous run onto the current
+    data. Log-occupancies are kept by position; positions beyond the previous
+    chromosome keep their default values from theta0. Each current region
+    takes the base-pair weighted averages of the previous mu and sigmasq over
+    the positions it shares with the previous regions; regions without
+    overlap keep their defaults from mu0 and sigmasq0.
+
+    Returns (theta, mu, sigmasq), with theta on the log scale.
+    '''
+    n_old = min(manifest['chrom_length'], theta0.size)
+
+    theta_new = theta0.copy()
+    theta_new[:n_old] = theta[:n_old]
+
+    region_types_old = decode_regions(manifest['regions'],
+                                      manifest['chrom_length'])[:n_old]
+    region_types = data['region_types'][:n_old]
+    n_regions = mu0.size
+
+    overlap = np.bincount(region_types, minlength=n_regions)
+    mapped = overlap > 0
+    mu_new = mu0.copy()
+    mu_new[mapped] = (np.bincount(region_types,
+                                  weights=mu[region_types_old],
+                                  minlength=n_regions)[mapped] /
+                      overlap[mapped])
+    sigmasq_new = sigmasq0.copy()
+    sigmasq_new[mapped] = (np.bincount(region_types,
+                                       weights=sigmasq[region_types_old],
+                                       minlength=n_regions)[mapped] /
+                           overlap[mapped])
+    return theta_new, mu_new, sigmasq_new
+
+def previous_run(patterns, data, cfg, null=False, verbose=0):
+    '''
+    Manifest of the best-matching previous run to warm start from (see
+    find_manifest). It is looked up before other initialization, so that
+    costlier starting values need not be computed when it is found.
+
+    Returns the manifest, or None if no previous run is found.
+    '''
+    path, manifest = find_manifest(patterns, data, cfg, null=null)
+    if manifest is None:
+        if verbose: print 'No previous run found for warm start'
+        return None
+
+    if verbose:
+        hashes = input_hashes(data, cfg)
+        changed = [k for k in INPUT_KEYS if manifest['inputs'][k] != hashes[k]]
+        print 'Warm start from %s; changed inputs: %s' % (
+            path, ', '.join(changed) if changed else 'none')
+    return manifest
+
+def warm_start(manifest, data, theta0, mu0, sigmasq0):
+    '''
+    Starting values from the previous run with the given manifest (see
+    previous_run), remapped onto the current data by remap_state with
+    defaults theta0 (on the log scale), mu0 and sigmasq0.
+
+    Returns (theta, mu, sigmasq), with theta on the log scale.
+    '''
+    theta, mu, sigmasq = load_state(manifest)
+    return remap_state(manifest, theta, mu, sigmasq, data, theta0, mu0,
+                       sigmasq0)
@@ -716,6 +716,16 @@ def get_cluster_centers(x, window, min_spacing, edge_correction=True):
     # Return their locations, not indicators
     return clusters
 
+def stored_n_burnin(scratch, names_npy, n_burnin):
+    '''
+    Number of burnin draws to remove from results extracted to scratch: the
+    value stored with the draws by deconvolve_mcmc.save_results if present
+    (zero for methods other than MCMC), else n_burnin from the configuration.
+    '''
+    if 'n_burnin.npy' in names_npy:
+        return int(np.load(scratch + '/n_burnin.npy'))
+    return n_burnin
+
 def summarise(cfg, chrom=1, null=False, mmap=False, detect_fmt=("%.1f", "%d")):
     '''
     Coordinate summarisation of MCMC results.
@@ -782,7 +792,8 @@ def summarise(cfg, chrom=1, null=False, mmap=False, detect_fmt=("%.1f", "%d")):
     theta   = np.load(scratch + '/theta.npy', mmap_mode=mmap_mode)
     mu      = np.load(scratch + '/mu.npy')
 
-    # Remove burnin
+    # Remove burnin, as recorded with the draws if available
+    n_burnin = stored_n_burnin(scratch, names_npy, n_burnin)
     if n_burnin > 0:
         mu = mu[n_burnin:]
         theta = theta[n_burnin:]
@@ -1000,7 +1011,8 @@ def summarise_clusters(cfg, chrom=1, null=False):
     theta   = np.load(scratch + '/theta.npy', mmap_mode='r')
     mu      = np.load(scratch + '/mu.npy', mmap_mode='r')
 
-    # Remove burnin
+    # Remove burnin, as recorded with the draws if available
+    n_burnin = stored_n_burnin(scratch, names_npy, n_burnin)
     if n_burnin > 0:
         mu = mu[n_burnin:]
         theta = theta[n_burnin:]
@@ -1159,7 +1171,8 @@ def summarise_params(cfg, chrom=1, null=False):
     sigmasq = np.load(scratch + '/sigmasq.npy')
     region_ids = np.load(scratch + '/region_ids.npy')
 
-    # Remove burnin
+    # Remove burnin, as recorded with the draws if available
+    n_burnin = stored_n_burnin(scratch, names_npy, n_burnin)
     if n_burnin > 0:
         mu = mu[n_burnin:]
         sigmasq = sigmasq[n_burnin:]
@@ -12,7 +12,9 @@ REQUIRES = ['numpy(>=1.6)','scipy(>=0.9)', 'yaml', 'mpi4py']
 
 PACKAGE_DIR = {'': 'lib'}
 PACKAGES = ['cplate']
-SCRIPTS = ('deconvolve_em', 'deconvolve_mcmc', 'detect_em', 'detect_mcmc',
+SCRIPTS = ('deconvolve_em', 'deconvolve_mcmc', 'deconvolve_laplace',
+           'deconvolve_vb',
+           'detect_em', 'detect_mcmc',
            'summarise_mcmc', 'summarise_clusters_mcmc', 'summarise_params_mcmc',
            'estimate_template', 'estimate_digestion_dist', 'segment_genome',
            'simulate_null', 'betas_to_bed.py', 'clusters_to_bed.py',